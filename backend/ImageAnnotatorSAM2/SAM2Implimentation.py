@@ -1,12 +1,23 @@
 import os
 os.environ["PYTORCH_ENABLE_MPS_FALLBACK"] = "1"
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
 import torch
 import numpy as np
 from PIL import Image
+from django.conf import settings
 
-from sam2.build_sam import build_sam2
 from sam2.sam2_image_predictor import SAM2ImagePredictor
 
+from .auto_masks import generate_candidates
+from .caches import LRUCache
+from .disk_cache import DiskCache
+from .embedding_store import read_embedding, write_embedding
+from .inference_profile import configure_cpu
+from .inference_scheduler import InferenceScheduler
+from .model_registry import ModelRegistry, model_device
+
 curr_dir = os.path.dirname(os.path.abspath(__file__))
 
 SAM2_LARGE_CHECKPOINT_PATH = os.path.join(curr_dir, 'checkpoints', 'sam2.1_hiera_large.pt')
@@ -41,18 +52,123 @@ elif device.type == "mps":
         "give numerically different outputs and sometimes degraded performance on MPS. "
         "See e.g. https://github.com/pytorch/pytorch/issues/84936 for a discussion."
     )
+else:
+    # sized so several worker processes can share the machine's cores
+    print(f"using {configure_cpu()} CPU threads")
+
+# Models are loaded on first use, indexed by the `model` value of the /sam2/ API
+MODEL_SPECS = [
+    {"name": "tiny", "config": SAM2_TINY_CONFIG_FILE, "checkpoint": SAM2_TINY_CHECKPOINT_PATH},
+    {"name": "small", "config": SAM2_SMALL_CONFIG_FILE, "checkpoint": SAM2_SMALL_CHECKPOINT_PATH},
+    {"name": "base_plus", "config": SAM2_BASE_PLUS_CONFIG_FILE, "checkpoint": SAM2_BASE_PLUS_CHECKPOINT_PATH},
+    {"name": "large", "config": SAM2_LARGE_CONFIG_FILE, "checkpoint": SAM2_LARGE_CHECKPOINT_PATH},
+    # the same models with dynamic int8 Linear layers, for CPU serving; built
+    # from the float checkpoints and cached next to them (see quantization.py)
+    {"name": "tiny_int8", "config": SAM2_TINY_CONFIG_FILE, "checkpoint": SAM2_TINY_CHECKPOINT_PATH, "quantized": True},
+    {"name": "small_int8", "config": SAM2_SMALL_CONFIG_FILE, "checkpoint": SAM2_SMALL_CHECKPOINT_PATH, "quantized": True},
+    {"name": "base_plus_int8", "config": SAM2_BASE_PLUS_CONFIG_FILE, "checkpoint": SAM2_BASE_PLUS_CHECKPOINT_PATH, "quantized": True},
+    {"name": "large_int8", "config": SAM2_LARGE_CONFIG_FILE, "checkpoint": SAM2_LARGE_CHECKPOINT_PATH, "quantized": True},
+]
+
+# index of the float model each quantised variant was built from
+QUANTIZED_BASE = {
+    index: next(base for base, other in enumerate(MODEL_SPECS) if other["name"] == spec["name"][:-len("_int8")])
+    for index, spec in enumerate(MODEL_SPECS) if spec.get("quantized")
+}
+
+model_registry = ModelRegistry(
+    MODEL_SPECS,
+    device,
+    max_bytes=getattr(settings, 'SAM2_MODEL_MEMORY_BYTES', 2 * 1024 * 1024 * 1024)
+)
+
+
+def embedding_nbytes(entry):
+    features = entry["features"]
+    tensors = [features["image_embed"], *features["high_res_feats"]]
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+# Image embeddings keyed by (Image.file_hash, model index), so follow-up clicks
+# on the same image only run the prompt decoder
+embedding_cache = LRUCache(
+    max_bytes=getattr(settings, 'SAM2_EMBEDDING_CACHE_BYTES', 512 * 1024 * 1024),
+    sizeof=embedding_nbytes
+)
+
+# Embeddings are also written to disk, one file per file_hash/model, so they
+# survive restarts and are shared between workers
+embedding_store = DiskCache(
+    os.path.join(settings.MEDIA_ROOT, 'embeddings'),
+    max_bytes=getattr(settings, 'SAM2_EMBEDDING_STORE_BYTES', 10 * 1024 * 1024 * 1024)
+)
+
 
-sam2_model_large = build_sam2(SAM2_LARGE_CONFIG_FILE, SAM2_LARGE_CHECKPOINT_PATH, device=device)
-sam2_large = SAM2ImagePredictor(sam2_model_large) 
+def stack_masks(masks):
+    # The predictor squeezes its batch dimension, so single-output masks come
+    # back as 1xHxW for one prompt but Bx1xHxW for several; flatten either to
+    # one HxW mask per prompt
+    masks = np.asarray(masks)
+    return masks.reshape(-1, *masks.shape[-2:])
+
+
+def embedding_filename(model):
+    return f"{MODEL_SPECS[model]['name']}.npy"
+
+
+def load_embedding(imageHash, model):
+    # memory cache first, then the on-disk store
+    entry = embedding_cache.get((imageHash, model))
+    if entry is not None or not embedding_store.enabled:
+        return entry
+    path = embedding_store.get(imageHash, embedding_filename(model))
+    if path is None:
+        return None
+    try:
+        entry = read_embedding(path, model_device(MODEL_SPECS[model], device))
+    except (OSError, ValueError) as e:
+        print(f"Discarding unreadable embedding {path}: {e}")
+        embedding_store.purge(imageHash)
+        return None
+    embedding_cache.put((imageHash, model), entry)
+    return entry
+
+
+def store_embedding(imageHash, model, entry):
+    embedding_cache.put((imageHash, model), entry)
+    if embedding_store.enabled:
+        embedding_store.put(imageHash, embedding_filename(model), lambda path: write_embedding(path, entry))
+
+
+def purge_embeddings(imageHash):
+    embedding_cache.discard_where(lambda key: key[0] == imageHash)
+    embedding_store.purge(imageHash)
+
+
+# Tracks interactive requests in flight, so background work such as embedding
+# precomputation can wait for a quiet moment instead of competing with annotators
+class InteractiveGate:
+    def __init__(self) -> None:
+        self._active = 0
+        self._idle = threading.Condition()
 
-sam2_model_base_plus = build_sam2(SAM2_BASE_PLUS_CONFIG_FILE, SAM2_BASE_PLUS_CHECKPOINT_PATH, device=device)
-sam2_base_plus = SAM2ImagePredictor(sam2_model_base_plus) 
+    @contextmanager
+    def busy(self):
+        with self._idle:
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._idle:
+                self._active -= 1
+                self._idle.notify_all()
 
-sam2_model_small = build_sam2(SAM2_SMALL_CONFIG_FILE, SAM2_SMALL_CHECKPOINT_PATH, device=device)
-sam2_small = SAM2ImagePredictor(sam2_model_small) 
+    def wait_until_idle(self) -> None:
+        with self._idle:
+            self._idle.wait_for(lambda: self._active == 0)
 
-sam2_model_tiny = build_sam2(SAM2_TINY_CONFIG_FILE, SAM2_TINY_CHECKPOINT_PATH, device=device)
-sam2_tiny = SAM2ImagePredictor(sam2_model_tiny) 
+
+interactive_gate = InteractiveGate()
 
 
 class AutoSegmentTool:
@@ -69,7 +185,7 @@ class AutoSegmentTool:
 
     def generateMask(
             self,
-            # PIL image object
+            # PIL image object, or HxWx3 RGB array
             image: Image,
             # list of coords of form [x, y]
             inclusionPoints: list[list[float, float]] = [],
@@ -78,13 +194,322 @@ class AutoSegmentTool:
             # list of coords of form [x, y]
             exclusionPoints: list[list[float, float]] = [],
             # specifies the model checkpoint to use, where
-            # 0 = tiny, 1 = small, 2 = base_plus, 3 = large
-            model: int = 3
-        ) -> list[list[int]]:
+            # 0 = tiny, 1 = small, 2 = base_plus, 3 = large,
+            # 4 to 7 = the same models quantised to int8
+            model: int = 3,
+            # hash of the image, used to reuse its embedding between requests
+            imageHash: str = None,
+            # (height, width) the masks are returned at, and that the points and
+            # boxes are given in; defaults to the size of `image`. Lets inference
+            # run on a downsized copy of the image while masks come out at full size
+            outputSize: tuple[int, int] = None,
+            # for ambiguous prompts (a single box or one set of points): return
+            # SAM2's three alternative masks and their scores, as (masks, scores),
+            # instead of the single best mask
+            multimask: bool = False
+        ) -> np.ndarray:
+            # returns an NxHxW array of boolean masks, one per bounding box, or
+            # a 1xHxW array for a set of points
             
-            sam2 = [sam2_tiny, sam2_small, sam2_base_plus, sam2_large][model]
+            with interactive_gate.busy():
+                return self.submitMask(image, inclusionPoints, boundingBoxes, exclusionPoints, model, imageHash, outputSize, multimask).result()
+
+
+    def submitMask(
+            self,
+            image: Image,
+            inclusionPoints: list[list[float, float]] = [],
+            boundingBoxes: list[list[float, float, float, float]] = [],
+            exclusionPoints: list[list[float, float]] = [],
+            model: int = 3,
+            imageHash: str = None,
+            outputSize: tuple[int, int] = None,
+            multimask: bool = False
+        ) -> Future:
+            # queues the same work as generateMask and returns a Future of its
+            # result, which can be awaited or cancelled while still queued
+            model_registry.check_index(model)
+            prompt = {
+                "inclusionPoints": inclusionPoints,
+                "boundingBoxes": boundingBoxes,
+                "exclusionPoints": exclusionPoints
+            }
+            if multimask:
+                if len(boundingBoxes) > 1 or (boundingBoxes and inclusionPoints + exclusionPoints):
+                    raise ValueError("Multimask prompts must be a single bounding box or a set of points.")
+                key = (imageHash or id(image), outputSize, "multimask", id(prompt))
+            else:
+                key = self.batchKey(image, imageHash, prompt, outputSize)
+            return inference_scheduler.submit(model, key, (image, imageHash, prompt, outputSize))
+
+
+    def generateMasks(
+            self,
+            # PIL image object, or HxWx3 RGB array
+            image: Image,
+            # one prompt per mask, each either {"boundingBoxes": [box]} or
+            # {"inclusionPoints": [...], "exclusionPoints": [...]}
+            prompts: list[dict],
+            # see generateMask
+            model: int = 3,
+            imageHash: str = None,
+            outputSize: tuple[int, int] = None
+        ) -> list:
+            # returns a list of one HxW mask per prompt, in order, decoded
+            # against a single embedding
+            with interactive_gate.busy():
+                return self.submitMasks(image, prompts, model, imageHash, outputSize).result()
+
+
+    def submitMasks(
+            self,
+            image: Image,
+            prompts: list[dict],
+            model: int = 3,
+            imageHash: str = None,
+            outputSize: tuple[int, int] = None
+        ) -> Future:
+            # Future version of generateMasks, see submitMask
+            model_registry.check_index(model)
+            prompts = [
+                {
+                    "inclusionPoints": prompt.get("inclusionPoints", []),
+                    "boundingBoxes": prompt.get("boundingBoxes", []),
+                    "exclusionPoints": prompt.get("exclusionPoints", [])
+                }
+                for prompt in prompts
+            ]
+            for prompt in prompts:
+                if len(prompt["boundingBoxes"]) > 1 or (prompt["boundingBoxes"] and prompt["inclusionPoints"] + prompt["exclusionPoints"]):
+                    raise ValueError("Each prompt must be a single bounding box or a set of points.")
+            key = (imageHash or id(image), outputSize, "many", id(prompts))
+            return inference_scheduler.submit(model, key, (image, imageHash, prompts, outputSize))
+
+
+    def generateAllMasks(
+            self,
+            # HxWx3 RGB array; masks are generated at its size
+            image: np.ndarray,
+            # see generateMask
+            model: int = 3,
+            imageHash: str = None,
+            # options for auto_masks.generate_candidates: points_per_side,
+            # points_per_batch, pred_iou_thresh, stability_score_thresh, nms_thresh
+            options: dict = None
+        ) -> list[dict]:
+            # "segment everything": returns SAM2AutomaticMaskGenerator records
+            # for every object found, reusing the image's cached embedding
+            with interactive_gate.busy():
+                return self.submitAllMasks(image, model, imageHash, options).result()
+
+
+    def submitAllMasks(self, image: np.ndarray, model: int = 3, imageHash: str = None, options: dict = None) -> Future:
+            # Future version of generateAllMasks, see submitMask
+            model_registry.check_index(model)
+            outputSize = tuple(image.shape[:2])
+            key = (imageHash or id(image), outputSize, "all", id(options))
+            return inference_scheduler.submit(model, key, (image, imageHash, options or {}, outputSize))
 
-            sam2.set_image(np.array(image.convert("RGB")))
+
+    def generateRefinedMask(
+            self,
+            # PIL image object, or HxWx3 RGB array
+            image: Image,
+            # see generateMask
+            inclusionPoints: list[list[float, float]] = [],
+            exclusionPoints: list[list[float, float]] = [],
+            # 1x256x256 low resolution logits of an earlier prediction for the
+            # same object, given to the decoder as a mask prompt
+            maskInput: np.ndarray = None,
+            model: int = 3,
+            imageHash: str = None,
+            outputSize: tuple[int, int] = None
+        ) -> tuple:
+            # for click refinement: returns the 1xHxW mask and the low resolution
+            # logits to pass as maskInput with the next click
+            with interactive_gate.busy():
+                return self.submitRefinedMask(
+                    image, inclusionPoints, exclusionPoints, maskInput, model, imageHash, outputSize
+                ).result()
+
+
+    def submitRefinedMask(
+            self,
+            image: Image,
+            inclusionPoints: list[list[float, float]] = [],
+            exclusionPoints: list[list[float, float]] = [],
+            maskInput: np.ndarray = None,
+            model: int = 3,
+            imageHash: str = None,
+            outputSize: tuple[int, int] = None
+        ) -> Future:
+            # Future version of generateRefinedMask, see submitMask
+            model_registry.check_index(model)
+            prompt = {
+                "inclusionPoints": inclusionPoints,
+                "exclusionPoints": exclusionPoints,
+                "maskInput": maskInput
+            }
+            key = (imageHash or id(image), outputSize, "refine", id(prompt))
+            return inference_scheduler.submit(model, key, (image, imageHash, prompt, outputSize))
+
+
+    def batchKey(self, image: Image, imageHash: str, prompt: dict, outputSize: tuple[int, int] = None) -> tuple:
+            # requests can share a decoder call when they are for the same image
+            # and output size, and their prompts stack into one tensor: any
+            # number of boxes, or point sets of the same length
+            numPoints = len(prompt["inclusionPoints"]) + len(prompt["exclusionPoints"])
+            if prompt["boundingBoxes"] and numPoints:
+                kind = ("mixed", id(prompt))
+            elif prompt["boundingBoxes"]:
+                kind = ("boxes",)
+            else:
+                kind = ("points", numPoints)
+            return (imageHash or id(image), outputSize) + kind
+
+
+    def runBatch(self, model: int, key: tuple, jobs: list) -> list:
+            # called on the scheduler's worker thread for this model, with jobs
+            # of (image, imageHash, prompt, outputSize) that share one batch key
+            image, imageHash, _, outputSize = jobs[0]
+            prompts = [prompt for _, _, prompt, _ in jobs]
+            # inference_mode skips autograd's version counting and view
+            # tracking, which no_grad (as used inside the predictor) still does
+            with model_registry.lock(model), torch.inference_mode():
+                sam2 = model_registry.get(model)
+                self.setImage(sam2, image, model, imageHash, outputSize)
+                if key[2] == "many":
+                    return [self._predictMany(sam2, item_prompts) for item_prompts in prompts]
+                if key[2] == "all":
+                    return [generate_candidates(sam2, image, **options) for options in prompts]
+                if key[2] == "multimask":
+                    return [self._predictMultimask(sam2, **prompt) for prompt in prompts]
+                if key[2] == "refine":
+                    return [self._predictRefined(sam2, **prompt) for prompt in prompts]
+                if len(prompts) == 1:
+                    return [self._predict(sam2, **prompts[0])]
+                if key[2] == "boxes":
+                    return self._predictBoxes(sam2, prompts)
+                return self._predictPoints(sam2, prompts)
+
+
+    def precomputeEmbedding(self, image: Image, model: int, imageHash: str) -> None:
+            # runs the image encoder ahead of the first prompt, unless the
+            # embedding is already cached
+            with model_registry.lock(model), torch.inference_mode():
+                sam2 = model_registry.get(model)
+                self.setImage(sam2, image, model, imageHash)
+
+
+    def setImage(self, sam2: SAM2ImagePredictor, image: Image, model: int, imageHash: str = None, outputSize: tuple[int, int] = None) -> None:
+            # restores a cached embedding onto the predictor if there is one,
+            # otherwise runs the image encoder and caches the result
+            cached = load_embedding(imageHash, model) if imageHash else None
+            if cached is None:
+                # RGB arrays (e.g. from the decoded image cache) are used as they are
+                if not isinstance(image, np.ndarray):
+                    image = np.array(image.convert("RGB"))
+                sam2.set_image(image)
+                if imageHash:
+                    store_embedding(imageHash, model, {
+                        "features": sam2._features,
+                        "orig_hw": tuple(sam2._orig_hw[0])
+                    })
+            else:
+                sam2.reset_predictor()
+                sam2._features = cached["features"]
+                sam2._orig_hw = [cached["orig_hw"]]
+                sam2._is_image_set = True
+
+            # The predictor scales prompts from, and the low resolution mask
+            # logits up to, its original size. The encoder only ever sees a
+            # 1024x1024 resize, so that size can be the requested output size
+            # rather than the size of the image that was encoded
+            if outputSize is not None:
+                sam2._orig_hw = [tuple(outputSize)]
+
+
+    def _predictBoxes(self, sam2, prompts):
+            # stacks every prompt's boxes into one decoder call, then hands each
+            # prompt back its own slice
+            boxes = [box for prompt in prompts for box in prompt["boundingBoxes"]]
+            masks, _, _ = sam2.predict(box=boxes, multimask_output=False)
+            masks = stack_masks(masks)
+            results = []
+            start = 0
+            for prompt in prompts:
+                end = start + len(prompt["boundingBoxes"])
+                results.append(masks[start:end])
+                start = end
+            return results
+
+
+    def _predictPoints(self, sam2, prompts):
+            # prompts have the same number of points, so they stack into BxNx2
+            point_coords = [prompt["inclusionPoints"] + prompt["exclusionPoints"] for prompt in prompts]
+            point_labels = [
+                [1] * len(prompt["inclusionPoints"]) + [0] * len(prompt["exclusionPoints"])
+                for prompt in prompts
+            ]
+            masks, _, _ = sam2.predict(
+                point_coords=point_coords,
+                point_labels=point_labels,
+                multimask_output=False
+            )
+            # each prompt's mask as 1xHxW, as it would come back on its own
+            return list(stack_masks(masks)[:, None])
+
+
+    def _predictMany(self, sam2, prompts):
+            # all box prompts go through one decoder call, and point prompts
+            # through one call per distinct number of points. Point sets are not
+            # padded to a common length, since padding changes the masks SAM2
+            # produces compared to prompting with each set on its own
+            masks = [None] * len(prompts)
+            groups = {}
+            for idx, prompt in enumerate(prompts):
+                if prompt["boundingBoxes"]:
+                    groups.setdefault("boxes", []).append(idx)
+                else:
+                    groups.setdefault(len(prompt["inclusionPoints"]) + len(prompt["exclusionPoints"]), []).append(idx)
+
+            for group, indices in groups.items():
+                if group == "boxes":
+                    groupMasks, _, _ = sam2.predict(
+                        box=[prompts[idx]["boundingBoxes"][0] for idx in indices],
+                        multimask_output=False
+                    )
+                else:
+                    groupMasks = self._predictPoints(sam2, [prompts[idx] for idx in indices])
+                groupMasks = stack_masks(groupMasks)
+                for idx, mask in zip(indices, groupMasks):
+                    masks[idx] = mask
+            return masks
+
+
+    def _predictMultimask(self, sam2, inclusionPoints, boundingBoxes, exclusionPoints):
+            masks, scores, _ = sam2.predict(
+                point_coords=inclusionPoints + exclusionPoints or None,
+                point_labels=[1] * len(inclusionPoints) + [0] * len(exclusionPoints) or None,
+                box=boundingBoxes[0] if boundingBoxes else None,
+                multimask_output=True
+            )
+            return masks, scores
+
+
+    def _predictRefined(self, sam2, inclusionPoints, exclusionPoints, maskInput):
+            # all points so far, plus the previous logits as a dense prompt, so
+            # each click corrects the last mask rather than starting again
+            masks, _, logits = sam2.predict(
+                point_coords=inclusionPoints + exclusionPoints,
+                point_labels=[1] * len(inclusionPoints) + [0] * len(exclusionPoints),
+                mask_input=maskInput,
+                multimask_output=False
+            )
+            return masks, logits
+
+
+    def _predict(self, sam2, inclusionPoints, boundingBoxes, exclusionPoints):
             if inclusionPoints and boundingBoxes:
                 print("WARNING: Inclusion points and bounding boxes are not meant to be used together. Using both can cause errors and unexpected behaviour.")
             
@@ -99,4 +524,11 @@ class AutoSegmentTool:
                 box=box,
                 multimask_output=False
             )
-            return masks#.tolist()
\ No newline at end of file
+            return stack_masks(masks)
+
+
+inference_scheduler = InferenceScheduler(
+    run_batch=AutoSegmentTool().runBatch,
+    window=getattr(settings, 'SAM2_BATCH_WINDOW_MS', 5) / 1000,
+    max_batch_size=getattr(settings, 'SAM2_MAX_BATCH_SIZE', 8)
+)
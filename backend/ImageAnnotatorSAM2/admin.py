@@ -1,9 +1,10 @@
 from django.contrib import admin
-from .models import Word, Image, Mask
+from .models import Word, Image, Mask, CandidateMask
 
 
 # Register your models here.
 
 admin.site.register(Word)
 admin.site.register(Image)
-admin.site.register(Mask)
\ No newline at end of file
+admin.site.register(Mask)
+admin.site.register(CandidateMask)
@@ -0,0 +1,142 @@
+import os
+
+import numpy as np
+from django.conf import settings
+from PIL import Image as PILImage
+from sam2.automatic_mask_generator import SAM2AutomaticMaskGenerator
+
+
+def available_memory():
+    # bytes of memory available to allocate without swapping, or None if unknown
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def adaptive_points_per_batch(points_per_batch, height, width, multimask=True):
+    """Lower points_per_batch until one batch fits in SAM2_AUTO_MEMORY_FRACTION of free memory.
+
+    Each point of a batch holds float32 logits at the image size for each of
+    its masks, plus about as much again for the stability scores and
+    thresholded masks computed from them.
+    """
+    free = available_memory()
+    if free is None:
+        return points_per_batch
+    budget = free * getattr(settings, 'SAM2_AUTO_MEMORY_FRACTION', 0.25)
+    per_point = (3 if multimask else 1) * height * width * 4 * 2
+    return int(max(1, min(points_per_batch, budget // per_point)))
+
+
+def mask_nms(masks, scores, iou_threshold, max_side=256):
+    """Indices of the masks to keep, most confident first, dropping any whose
+    IoU with a better scoring mask is above iou_threshold.
+
+    Box NMS misses duplicates whose boxes differ (a mask with a stray speck),
+    so this compares the masks themselves. All pairwise IoUs come from one
+    matrix product of the masks, downsampled so their long side is at most
+    max_side.
+    """
+    if not len(masks):
+        return np.zeros(0, dtype=np.int64)
+    masks = np.asarray(masks, dtype=bool)
+    step = max(1, -(-max(masks.shape[1:]) // max_side))
+    flat = masks[:, ::step, ::step].reshape(len(masks), -1).astype(np.float32)
+    intersections = flat @ flat.T
+    areas = np.diag(intersections)
+    unions = areas[:, None] + areas[None, :] - intersections
+    ious = np.divide(intersections, unions, out=np.zeros_like(intersections), where=unions > 0)
+
+    order = np.argsort(-np.asarray(scores), kind='stable')
+    suppressed = np.zeros(len(masks), dtype=bool)
+    keep = []
+    for idx in order:
+        if suppressed[idx]:
+            continue
+        keep.append(idx)
+        suppressed |= ious[idx] > iou_threshold
+    return np.array(keep, dtype=np.int64)
+
+
+# Stands in for a SAM2ImagePredictor whose image (or cached embedding) is
+# already set, so SAM2AutomaticMaskGenerator decodes against it rather than
+# running the image encoder again
+class PresetPredictor:
+    def __init__(self, predictor):
+        self._predictor = predictor
+
+    def set_image(self, image):
+        pass
+
+    def reset_predictor(self):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self._predictor, name)
+
+
+# Options of generate_candidates and the settings they default to
+AUTO_MASK_OPTIONS = {
+    'points_per_side': ('SAM2_AUTO_POINTS_PER_SIDE', 32),
+    'points_per_batch': ('SAM2_AUTO_POINTS_PER_BATCH', 64),
+    'pred_iou_thresh': ('SAM2_AUTO_PRED_IOU_THRESH', 0.8),
+    'stability_score_thresh': ('SAM2_AUTO_STABILITY_SCORE_THRESH', 0.95),
+    'nms_thresh': ('SAM2_AUTO_NMS_THRESH', 0.7),
+}
+
+
+def auto_mask_option(name, value=None):
+    if value is not None:
+        return value
+    setting, default = AUTO_MASK_OPTIONS[name]
+    return getattr(settings, setting, default)
+
+
+def generate_candidates(sam2, image, points_per_side=None, points_per_batch=None, pred_iou_thresh=None,
+                        stability_score_thresh=None, nms_thresh=None):
+    """Segment everything in `image` with a predictor that already has it set.
+
+    Runs SAM2's automatic mask generator over a points_per_side grid (on the
+    whole image, so a single embedding is needed), then removes duplicates
+    with mask_nms. Returns its mask records, best first. Options left as None
+    come from settings (see AUTO_MASK_OPTIONS).
+    """
+    points_per_side = auto_mask_option('points_per_side', points_per_side)
+    points_per_batch = auto_mask_option('points_per_batch', points_per_batch)
+    pred_iou_thresh = auto_mask_option('pred_iou_thresh', pred_iou_thresh)
+    stability_score_thresh = auto_mask_option('stability_score_thresh', stability_score_thresh)
+    nms_thresh = auto_mask_option('nms_thresh', nms_thresh)
+    height, width = image.shape[:2]
+    generator = SAM2AutomaticMaskGenerator(
+        sam2.model,
+        points_per_side=points_per_side,
+        points_per_batch=adaptive_points_per_batch(points_per_batch, height, width),
+        pred_iou_thresh=pred_iou_thresh,
+        stability_score_thresh=stability_score_thresh,
+        crop_n_layers=0
+    )
+    generator.predictor = PresetPredictor(sam2)
+    records = generator.generate(image)
+    keep = mask_nms(
+        [record["segmentation"] for record in records],
+        [record["predicted_iou"] for record in records],
+        nms_thresh
+    )
+    return [records[idx] for idx in keep]
+
+
+def scale_mask(mask, height, width):
+    # a candidate mask resized to the image's size; resized as greyscale and
+    # thresholded at half, so its edges stay smooth rather than blocky
+    if mask.shape == (height, width):
+        return mask.astype(np.uint8)
+    resized = PILImage.fromarray(mask.astype(np.uint8) * 255).resize((width, height), PILImage.Resampling.BILINEAR)
+    return (np.asarray(resized) > 127).astype(np.uint8)
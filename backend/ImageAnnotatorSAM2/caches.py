@@ -0,0 +1,87 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+# Thread-safe LRU cache bounded by the total size of its values in bytes
+# `sizeof` is called once per value on insertion to work out how much of the
+# budget it uses. With a `ttl` (in seconds), entries also expire that long
+# after they were put
+class LRUCache:
+    def __init__(self, max_bytes, sizeof, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._sizeof = sizeof
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._expires = {}
+        self._current_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries or self._expired(key):
+                self._remove(key)
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        size = self._sizeof(value)
+        with self._lock:
+            self._remove(key)
+            if self.ttl is not None:
+                for expired in [k for k in self._entries if self._expired(k)]:
+                    self._remove(expired)
+            # values bigger than the whole budget are never worth keeping
+            if size > self.max_bytes:
+                return False
+            self._entries[key] = value
+            self._sizes[key] = size
+            self._current_bytes += size
+            if self.ttl is not None:
+                self._expires[key] = time.monotonic() + self.ttl
+            # evict least recently used entries until we are back under budget
+            while self._current_bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+            return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            value = default if self._expired(key) else self._entries.get(key, default)
+            self._remove(key)
+            return value
+
+    def discard_where(self, predicate):
+        # drop every entry whose key matches, e.g. all models for one image
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._expires.clear()
+            self._current_bytes = 0
+
+    @property
+    def current_bytes(self):
+        return self._current_bytes
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries and not self._expired(key)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        if key in self._entries:
+            del self._entries[key]
+            self._current_bytes -= self._sizes.pop(key)
+            self._expires.pop(key, None)
+
+    def _expired(self, key):
+        return key in self._expires and time.monotonic() >= self._expires[key]
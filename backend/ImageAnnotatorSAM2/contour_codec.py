@@ -0,0 +1,102 @@
+import struct
+
+import numpy as np
+
+
+# Compact binary encoding of a mask's contours, used instead of JSON lists of
+# float points:
+#   header   - magic, quantum (points per pixel) and number of contours
+#   counts   - number of points in each contour, as uint32
+#   points   - (row, col) of every point, quantised to 1/quantum of a pixel,
+#              as the difference from the previous point (across contours),
+#              zigzag encoded into unsigned LEB128 varints
+# Contours from find_contours on a binary mask lie on a half pixel grid, so the
+# default quantum of 2 is lossless.
+MAGIC = b'SCT1'
+HEADER = struct.Struct('<4sHI')
+CONTENT_TYPE = 'application/x-sam2-contours'
+DEFAULT_QUANTUM = 2
+
+
+def encode_contours(contours, quantum=DEFAULT_QUANTUM):
+    counts = np.array([len(contour) for contour in contours], dtype='<u4')
+    if len(contours) and counts.sum():
+        points = np.concatenate([np.asarray(contour, dtype=np.float64).reshape(-1, 2) for contour in contours])
+    else:
+        points = np.zeros((0, 2))
+    quantised = np.rint(points * quantum).astype(np.int64)
+    deltas = np.diff(quantised, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+    return b''.join([
+        HEADER.pack(MAGIC, quantum, len(contours)),
+        counts.tobytes(),
+        encode_varints(zigzag_encode(deltas)),
+    ])
+
+
+def decode_contours(data):
+    magic, quantum, num_contours = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not an encoded contour blob.")
+    counts_end = HEADER.size + 4 * num_contours
+    counts = np.frombuffer(data, dtype='<u4', count=num_contours, offset=HEADER.size)
+    deltas = zigzag_decode(decode_varints(np.frombuffer(data, dtype=np.uint8, offset=counts_end)))
+    points = np.cumsum(deltas.reshape(-1, 2), axis=0) / quantum
+    return np.split(points, np.cumsum(counts)[:-1]) if num_contours else []
+
+
+def zigzag_encode(values):
+    # maps signed to unsigned so small negative deltas stay small
+    return ((values << 1) ^ (values >> 63)).astype(np.uint64)
+
+
+def zigzag_decode(values):
+    return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+
+
+def encode_varints(values):
+    # 7 bits per byte, least significant first, high bit set on all but the last byte
+    if not len(values):
+        return b''
+    lengths = np.ones(len(values), dtype=np.int64)
+    for shift in range(7, 64, 7):
+        lengths += values >= np.uint64(1 << shift)
+    max_length = int(lengths.max())
+    positions = np.arange(max_length)
+    groups = (values[:, None] >> (7 * positions).astype(np.uint64)) & np.uint64(0x7f)
+    continues = positions[None, :] < (lengths[:, None] - 1)
+    encoded = (groups | (continues * np.uint64(0x80))).astype(np.uint8)
+    return encoded[positions[None, :] < lengths[:, None]].tobytes()
+
+
+def decode_varints(data):
+    if not len(data):
+        return np.zeros(0, dtype=np.uint64)
+    ends = np.flatnonzero(data < 0x80)
+    data = data[:ends[-1] + 1]
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    # position of each byte within its varint
+    value_index = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    shifts = (7 * (np.arange(len(data)) - starts[value_index])).astype(np.uint64)
+    groups = (data & 0x7f).astype(np.uint64) << shifts
+    return np.add.reduceat(groups, starts)
+
+
+# Streams of several masks' contours are a sequence of frames, each holding the
+# mask's word and its encoded contours, prefixed by their lengths in bytes
+FRAME = struct.Struct('<HI')
+
+
+def encode_frame(label, data):
+    label = label.encode('utf-8')
+    return FRAME.pack(len(label), len(data)) + label + data
+
+
+def decode_frames(data):
+    offset = 0
+    while offset < len(data):
+        label_length, data_length = FRAME.unpack_from(data, offset)
+        offset += FRAME.size
+        label = bytes(data[offset:offset + label_length]).decode('utf-8')
+        offset += label_length
+        yield label, decode_contours(bytes(data[offset:offset + data_length]))
+        offset += data_length
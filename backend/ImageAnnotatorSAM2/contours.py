@@ -0,0 +1,115 @@
+import math
+
+import numpy as np
+from skimage import measure
+
+
+# Tolerances tried when a contour has too many points, as in the original
+# retry loop: start at the requested tolerance and step by TOLERANCE_STEP until
+# the contour fits or MAX_TOLERANCE is reached
+TOLERANCE_STEP = 0.5
+MAX_TOLERANCE = 10
+
+
+def find_contours(mask_array):
+    return measure.find_contours(np.squeeze(mask_array), level=0.5)
+
+
+def simplify_contours(contours, max_points_per_contour=None, tolerance=0.5):
+    """Simplify each contour to at most `max_points_per_contour` points.
+
+    Returns the simplified contours and the tolerance used for each (None for
+    contours that were already small enough). Gives the same result as calling
+    skimage's approximate_polygon with increasing tolerances until the contour
+    fits, but each contour only needs a single Douglas-Peucker pass: the pass
+    ranks every vertex by the largest tolerance that keeps it, and the point
+    count at every tolerance is then read off the ranks for all contours at once.
+    """
+    simplified = list(contours)
+    tolerances = [None] * len(contours)
+    if not max_points_per_contour or not contours:
+        return simplified, tolerances
+
+    # only contours over the budget need any work
+    lengths = np.fromiter((len(contour) for contour in contours), dtype=np.int64, count=len(contours))
+    over_budget = np.flatnonzero(lengths > max_points_per_contour)
+    if not len(over_budget):
+        return simplified, tolerances
+
+    # tolerance grid: tolerance, tolerance + step, ... up to the first value
+    # that reaches MAX_TOLERANCE
+    last = max(0, math.ceil((MAX_TOLERANCE - tolerance) / TOLERANCE_STEP))
+    grid = tolerance + np.arange(last + 1) * TOLERANCE_STEP
+
+    ranks = [douglas_peucker_ranks(contours[idx], tolerance) for idx in over_budget]
+    all_ranks = np.concatenate(ranks)
+    starts = np.concatenate(([0], np.cumsum([len(r) for r in ranks])[:-1]))
+    # points kept by each contour (rows) at each tolerance (columns)
+    counts = np.add.reduceat((all_ranks[:, None] > grid[None, :]).astype(np.int64), starts, axis=0)
+
+    fits = counts <= max_points_per_contour
+    # first tolerance that fits, or the largest one if none do
+    steps = np.where(fits.any(axis=1), fits.argmax(axis=1), last)
+    for idx, contour_ranks, step in zip(over_budget, ranks, steps):
+        simplified[idx] = contours[idx][contour_ranks > grid[step]]
+        tolerances[idx] = float(grid[step])
+    return simplified, tolerances
+
+
+def douglas_peucker_ranks(coords, tolerance):
+    """Rank each vertex by the tolerance at which Douglas-Peucker drops it.
+
+    approximate_polygon(coords, t) keeps exactly the vertices whose rank is
+    greater than t, for any t >= tolerance. The splits Douglas-Peucker makes do
+    not depend on the tolerance, only whether it makes them does, so a vertex
+    survives while both its own distance and its parent split's rank exceed t.
+    Distances are calculated as in skimage so results match exactly.
+    """
+    ranks = np.zeros(coords.shape[0])
+    ranks[0] = ranks[-1] = np.inf
+    stack = [(0, coords.shape[0] - 1, np.inf)]
+
+    while stack:
+        start, end, parent_rank = stack.pop()
+        if end - start < 2:
+            continue
+        # determine properties of current line segment
+        r0, c0 = coords[start, :]
+        r1, c1 = coords[end, :]
+        dr = r1 - r0
+        dc = c1 - c0
+        segment_angle = -np.arctan2(dr, dc)
+        segment_dist = c0 * np.sin(segment_angle) + r0 * np.cos(segment_angle)
+
+        segment_coords = coords[start + 1 : end, :]
+        segment_dists = np.empty(end - start - 1)
+
+        # perpendicular distance for points that project onto the segment,
+        # otherwise distance to the nearest end point
+        dr0 = segment_coords[:, 0] - r0
+        dc0 = segment_coords[:, 1] - c0
+        dr1 = segment_coords[:, 0] - r1
+        dc1 = segment_coords[:, 1] - c1
+        projected_lengths0 = dr0 * dr + dc0 * dc
+        projected_lengths1 = -dr1 * dr - dc1 * dc
+        perp = np.logical_and(projected_lengths0 > 0, projected_lengths1 > 0)
+        eucl = np.logical_not(perp)
+        segment_dists[perp] = np.abs(
+            segment_coords[perp, 0] * np.cos(segment_angle)
+            + segment_coords[perp, 1] * np.sin(segment_angle)
+            - segment_dist
+        )
+        segment_dists[eucl] = np.minimum(
+            np.sqrt(dc0[eucl] ** 2 + dr0[eucl] ** 2),
+            np.sqrt(dc1[eucl] ** 2 + dr1[eucl] ** 2),
+        )
+
+        split = np.argmax(segment_dists)
+        # below the smallest tolerance of interest nothing in here is kept
+        if segment_dists[split] > tolerance:
+            new_end = start + split + 1
+            ranks[new_end] = min(segment_dists[split], parent_rank)
+            stack.append((new_end, end, ranks[new_end]))
+            stack.append((start, new_end, ranks[new_end]))
+
+    return ranks
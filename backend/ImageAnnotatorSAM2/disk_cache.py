@@ -0,0 +1,128 @@
+import os
+import shutil
+import threading
+import uuid
+
+
+# Size-capped cache of files on disk, laid out as <root>/<key>/<name>
+# Keys are usually an image's file_hash, so everything derived from one image
+# can be purged together. The least recently used files are deleted once the
+# directory grows past max_bytes.
+# The directory's size is kept as a running total, counted from disk on first
+# use and updated by this process's writes, so a write only walks the cache
+# when it takes the total over the limit. Other processes' writes to the same
+# directory are picked up by a recount every RECOUNT_EVERY writes.
+class DiskCache:
+    RECOUNT_EVERY = 1000
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # bytes in the cache, None until first counted
+        self._total = None
+        self._writes = 0
+
+    @property
+    def enabled(self):
+        return bool(self.max_bytes)
+
+    def path(self, key, name):
+        return os.path.join(self.root, key, name)
+
+    def get(self, key, name):
+        # returns the path of a cached file, or None if it is not cached
+        path = self.path(key, name)
+        try:
+            # mark as recently used
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def put(self, key, name, write, enforce_limit=True):
+        # write(tmp_path) produces the file, which is then moved into place so
+        # readers never see a partially written file. Writers of many files at
+        # once can pass enforce_limit=False and call enforce_limit() at the end,
+        # as each call walks the whole cache
+        path = self.path(key, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            write(tmp_path)
+            added = os.path.getsize(tmp_path) - self._file_size(path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        with self._lock:
+            self._writes += 1
+            if self._total is not None:
+                self._total += added
+        if enforce_limit:
+            self.enforce_limit()
+        return path
+
+    def purge(self, key):
+        if not key:
+            return
+        directory = os.path.join(self.root, key)
+        removed = sum(size for _, size, _ in self._files(directory))
+        shutil.rmtree(directory, ignore_errors=True)
+        with self._lock:
+            if self._total is not None:
+                self._total = max(0, self._total - removed)
+
+    def size(self):
+        return sum(size for _, size, _ in self._files())
+
+    def enforce_limit(self):
+        with self._lock:
+            recount = self._total is None or self._writes >= self.RECOUNT_EVERY
+            if not recount and self._total <= self.max_bytes:
+                return
+            files = self._files()
+            total = sum(size for _, size, _ in files)
+            self._writes = 0
+            self._total = total
+            if total <= self.max_bytes:
+                return
+            # oldest first
+            for path, size, _ in sorted(files, key=lambda f: f[2]):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                self._total = total
+                # tidy up the key directory, which only succeeds once it is empty
+                try:
+                    os.rmdir(os.path.dirname(path))
+                except OSError:
+                    pass
+
+    def _file_size(self, path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    def _files(self, root=None):
+        # (path, size, last used) of every completed file in the cache, or under `root`
+        root = root or self.root
+        files = []
+        if not os.path.isdir(root):
+            return files
+        for directory, _, names in os.walk(root):
+            for name in names:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((path, stat.st_size, stat.st_mtime))
+        return files
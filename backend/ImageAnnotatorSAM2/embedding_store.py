@@ -0,0 +1,45 @@
+import numpy as np
+import torch
+
+
+# Image embeddings are written as a single .npy file holding one structured
+# record, so a stored embedding can be memory-mapped back without parsing or
+# copying it:
+#   orig_hw     - (height, width) of the image the embedding was computed for
+#   image_embed - lowest resolution feature map
+#   high_res_N  - higher resolution feature maps used by the mask decoder
+
+
+def embedding_dtype(features):
+    fields = [
+        ('orig_hw', '<i8', (2,)),
+        ('image_embed', '<f4', tuple(features["image_embed"].shape)),
+    ]
+    for idx, feat in enumerate(features["high_res_feats"]):
+        fields.append((f'high_res_{idx}', '<f4', tuple(feat.shape)))
+    return np.dtype(fields)
+
+
+def write_embedding(path, entry):
+    features = entry["features"]
+    record = np.lib.format.open_memmap(path, mode='w+', dtype=embedding_dtype(features), shape=(1,))
+    record['orig_hw'][0] = entry["orig_hw"]
+    record['image_embed'][0] = features["image_embed"].detach().float().cpu().numpy()
+    for idx, feat in enumerate(features["high_res_feats"]):
+        record[f'high_res_{idx}'][0] = feat.detach().float().cpu().numpy()
+    record.flush()
+    del record
+
+
+def read_embedding(path, device):
+    # copy-on-write mapping: pages are read lazily and the file is never modified
+    record = np.load(path, mmap_mode='c')
+    names = record.dtype.names
+    high_res_names = sorted(name for name in names if name.startswith('high_res_'))
+    return {
+        "features": {
+            "image_embed": torch.from_numpy(record['image_embed'][0]).to(device),
+            "high_res_feats": [torch.from_numpy(record[name][0]).to(device) for name in high_res_names]
+        },
+        "orig_hw": tuple(int(v) for v in record['orig_hw'][0])
+    }
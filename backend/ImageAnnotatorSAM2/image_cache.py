@@ -0,0 +1,119 @@
+import os
+
+import numpy as np
+from django.conf import settings
+from PIL import Image as PILImage
+
+from .caches import LRUCache
+from .disk_cache import DiskCache
+
+
+# Pillow refuses to open images much larger than its default limit of ~89 MP as
+# a guard against decompression bombs; uploads here can be a few hundred MP
+PILImage.MAX_IMAGE_PIXELS = getattr(settings, 'SAM2_MAX_IMAGE_PIXELS', PILImage.MAX_IMAGE_PIXELS)
+
+# EXIF tag holding how the camera was rotated
+EXIF_ORIENTATION = 0x0112
+
+# Decoded RGB pixels of recently used images, keyed by file_hash, so repeated
+# prompts on the same image skip reading and decoding its file. The arrays are
+# shared between requests, so callers must not modify them.
+decoded_image_cache = LRUCache(
+    max_bytes=getattr(settings, 'SAM2_DECODED_IMAGE_CACHE_BYTES', 256 * 1024 * 1024),
+    sizeof=lambda arr: arr.nbytes
+)
+
+# Copies of images downsized to SAM2's encoder resolution, which is all that
+# inference needs: SAM2 resizes every image to 1024x1024 before encoding it.
+# Each is made once per image and kept in memory and, as a raw array, under
+# MEDIA_ROOT/inference_images, keyed by file_hash.
+inference_image_cache = LRUCache(
+    max_bytes=getattr(settings, 'SAM2_INFERENCE_IMAGE_CACHE_BYTES', 128 * 1024 * 1024),
+    sizeof=lambda arr: arr.nbytes
+)
+inference_image_store = DiskCache(
+    os.path.join(settings.MEDIA_ROOT, 'inference_images'),
+    getattr(settings, 'SAM2_INFERENCE_IMAGE_STORE_BYTES', 2 * 1024 * 1024 * 1024)
+)
+
+
+def read_image_metadata(f):
+    # width, height, mode and EXIF orientation from the image header, without
+    # decoding any pixels; empty if the file cannot be read as an image
+    try:
+        with PILImage.open(f) as img:
+            return {
+                "width": img.width,
+                "height": img.height,
+                "mode": img.mode,
+                "orientation": img.getexif().get(EXIF_ORIENTATION)
+            }
+    except Exception as e:
+        print(f"Error reading image metadata: {e}")
+        return {}
+
+
+def load_image_rgb(image):
+    """Return an Image's pixels as an HxWx3 uint8 RGB array, decoding its file if not cached."""
+    arr = decoded_image_cache.get(image.file_hash) if image.file_hash else None
+    if arr is None:
+        with image.file.open('rb') as img:
+            arr = np.array(PILImage.open(img).convert('RGB'))  # Ensure image is in RGB
+        if image.file_hash:
+            decoded_image_cache.put(image.file_hash, arr)
+    return arr
+
+
+def inference_size():
+    return getattr(settings, 'SAM2_INFERENCE_SIZE', 1024)
+
+
+def load_inference_image(image):
+    """Return an Image's pixels as an RGB array whose long side is at most SAM2_INFERENCE_SIZE."""
+    size = inference_size()
+    name = f"{size}.npy"
+    arr = inference_image_cache.get((image.file_hash, size)) if image.file_hash else None
+    if arr is not None:
+        return arr
+
+    path = inference_image_store.get(image.file_hash, name) if image.file_hash else None
+    if path is not None:
+        try:
+            arr = np.load(path)
+        except (OSError, ValueError) as e:
+            print(f"Discarding unreadable inference image {path}: {e}")
+            inference_image_store.purge(image.file_hash)
+    if arr is None:
+        arr = downsize_image(image, size)
+        if image.file_hash and inference_image_store.enabled:
+            inference_image_store.put(image.file_hash, name, lambda tmp_path: write_array(tmp_path, arr))
+    if image.file_hash:
+        inference_image_cache.put((image.file_hash, size), arr)
+    return arr
+
+
+def downsize_image(image, size):
+    # already decoded images are resized as they are, otherwise JPEGs are
+    # decoded straight at a fraction of their size
+    arr = decoded_image_cache.get(image.file_hash) if image.file_hash else None
+    if arr is not None:
+        img = PILImage.fromarray(arr)
+        img.thumbnail((size, size), PILImage.Resampling.BILINEAR)
+        return np.asarray(img)
+    with image.file.open('rb') as f:
+        img = PILImage.open(f)
+        # a reducing_gap of 1 lets draft() pick the smallest JPEG scale that is
+        # still at least `size`, which the resize then finishes
+        img.thumbnail((size, size), PILImage.Resampling.BILINEAR, reducing_gap=1.0)
+        return np.array(img.convert('RGB'))
+
+
+def write_array(path, arr):
+    # a file object, as np.save would add .npy to the temporary path
+    with open(path, 'wb') as f:
+        np.save(f, arr)
+
+
+def purge_inference_images(file_hash):
+    inference_image_cache.discard_where(lambda key: key[0] == file_hash)
+    inference_image_store.purge(file_hash)
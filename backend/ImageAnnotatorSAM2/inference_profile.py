@@ -0,0 +1,101 @@
+import os
+import threading
+
+import numpy as np
+import torch
+from django.conf import settings
+
+
+def available_cpus():
+    # CPUs this process may run on, which in a container can be fewer than the machine has
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def cpu_threads():
+    """Intra-op threads for each worker process: SAM2_CPU_THREADS, or the
+    available CPUs shared between SAM2_CPU_WORKERS processes (by default
+    WEB_CONCURRENCY, as gunicorn reads it), so workers do not oversubscribe
+    the cores and slow each other down."""
+    threads = getattr(settings, 'SAM2_CPU_THREADS', None)
+    if threads:
+        return threads
+    workers = getattr(settings, 'SAM2_CPU_WORKERS', None) or int(os.environ.get('WEB_CONCURRENCY', 1))
+    return max(1, available_cpus() // max(1, workers))
+
+
+def configure_cpu(threads=None):
+    threads = threads or cpu_threads()
+    torch.set_num_threads(threads)
+    try:
+        # inter-op parallelism does little for SAM2's sequential layers, and
+        # its pool's threads would compete with the intra-op ones
+        torch.set_num_interop_threads(getattr(settings, 'SAM2_CPU_INTEROP_THREADS', 1))
+    except RuntimeError:
+        # can only be set before any parallel work has run in the process
+        pass
+    return threads
+
+
+def optimise_model(model, channels_last=None, compile=None):
+    """Apply the optional SAM2_CHANNELS_LAST and SAM2_COMPILE settings (or the
+    given values) to a built SAM2 model's image encoder, which is where nearly
+    all of its time goes. channels_last converts the encoder's weights and the
+    image batch it is given; the prompt encoder and mask decoder run on small
+    inputs of varying shape, so they are left alone."""
+    if channels_last is None:
+        channels_last = getattr(settings, 'SAM2_CHANNELS_LAST', False)
+    if compile is None:
+        compile = getattr(settings, 'SAM2_COMPILE', False)
+    if channels_last:
+        encoder = model.image_encoder
+        encoder.to(memory_format=torch.channels_last)
+        forward = encoder.forward
+        # with only the weights converted, each convolution would convert its
+        # input there and its output back
+        encoder.forward = lambda sample: forward(sample.contiguous(memory_format=torch.channels_last))
+    if compile:
+        # as SAM2's own compile_image_encoder option does; the encoder input is
+        # always image_size x image_size, so one static graph serves every image
+        model.image_encoder.forward = torch.compile(
+            model.image_encoder.forward,
+            mode=getattr(settings, 'SAM2_COMPILE_MODE', 'max-autotune'),
+            fullgraph=True,
+            dynamic=False
+        )
+    return model
+
+
+def warmup_predictor(predictor):
+    # one encode and one decode on a blank image, so the first real request
+    # does not pay for allocator growth, kernel selection or compilation
+    size = predictor.model.image_size
+    with torch.inference_mode():
+        predictor.set_image(np.zeros((size, size, 3), dtype=np.uint8))
+        predictor.predict(point_coords=[[size / 2, size / 2]], point_labels=[1], multimask_output=False)
+    predictor.reset_predictor()
+
+
+def start_warmup():
+    """Load and warm up the models in SAM2_WARMUP_MODELS on a background
+    thread. Called by the WSGI and ASGI entry points, so only servers (not
+    management commands) load models at startup."""
+    models = getattr(settings, 'SAM2_WARMUP_MODELS', [])
+    if not models:
+        return None
+
+    def run():
+        from .SAM2Implimentation import model_registry
+        for index in models:
+            try:
+                with model_registry.lock(index):
+                    warmup_predictor(model_registry.get(index))
+                print(f"warmed up SAM2 model {index}")
+            except Exception as e:
+                print(f"Error warming up SAM2 model {index}: {e}")
+
+    thread = threading.Thread(target=run, name='sam2-warmup', daemon=True)
+    thread.start()
+    return thread
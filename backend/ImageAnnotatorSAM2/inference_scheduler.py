@@ -0,0 +1,73 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+# Queues inference requests per model and hands them to a single worker thread
+# per model, which owns that model's predictor. Requests arriving within
+# `window` seconds of each other are collected into one batch, and requests
+# with the same batch key (e.g. same image and prompt shape) are run together
+# through `run_batch(model, key, payloads)`, which returns one result per payload.
+class InferenceScheduler:
+    def __init__(self, run_batch, window, max_batch_size):
+        self.run_batch = run_batch
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def submit(self, model, key, payload) -> Future:
+        future = Future()
+        self._queue_for(model).put((key, payload, future))
+        return future
+
+    def _queue_for(self, model):
+        with self._lock:
+            if model not in self._queues:
+                self._queues[model] = queue.Queue()
+                worker = threading.Thread(
+                    target=self._worker,
+                    args=(model, self._queues[model]),
+                    name=f"sam2-scheduler-{model}",
+                    daemon=True
+                )
+                worker.start()
+            return self._queues[model]
+
+    def _worker(self, model, jobs):
+        while True:
+            batch = self._collect(jobs)
+            # group by key, keeping arrival order
+            groups = {}
+            for key, payload, future in batch:
+                # skips requests that were cancelled while queued
+                if future.set_running_or_notify_cancel():
+                    groups.setdefault(key, []).append((payload, future))
+            for key, group in groups.items():
+                self._run_group(model, key, group)
+
+    def _collect(self, jobs):
+        batch = [jobs.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(jobs.get(timeout=remaining))
+                else:
+                    # window is over, but still take anything already queued
+                    batch.append(jobs.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run_group(self, model, key, group):
+        try:
+            results = self.run_batch(model, key, [payload for payload, _ in group])
+        except Exception as e:
+            for _, future in group:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(group, results):
+            future.set_result(result)
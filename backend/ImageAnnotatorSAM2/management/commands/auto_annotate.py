@@ -0,0 +1,223 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+
+# Worker processes are spawned and import this module before Django is set up,
+# so models and views are only imported inside functions
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.tif', '.tiff'}
+
+
+def init_worker(threads):
+    django.setup()
+    # importing the model module sizes threads for a web worker, so this
+    # worker's share of the cores is set after it
+    import ImageAnnotatorSAM2.SAM2Implimentation  # noqa: F401
+    from ImageAnnotatorSAM2.inference_profile import configure_cpu
+    configure_cpu(threads)
+
+
+def annotate_image(image, parsed, model):
+    # Runs in a worker process: segments an image's items and builds their
+    # Mask fields, leaving the database writes to the main process.
+    # Returns (image pk, [(index, word, mask_content)], seconds spent)
+    from ImageAnnotatorSAM2.views import mask_content, merge_item_masks, open_inference_image, submit_bulk_items
+
+    start = time.perf_counter()
+    size, inference_img = open_inference_image(image)
+    masks = submit_bulk_items(image.file_hash, size, inference_img, parsed, model).result()
+    contents = [
+        (idx, word, mask_content(image, word, total_mask))
+        for (idx, _, _), (word, total_mask) in zip(parsed, merge_item_masks(parsed, masks))
+    ]
+    return image.pk, contents, time.perf_counter() - start
+
+
+# Pre-labels images with SAM2 ahead of human review. Prompts come from a JSON
+# file mapping image names (file paths relative to --dir) or file hashes to
+# items in the /sam2/bulk/ format; items under "*" apply to every image:
+#   {"*": [{"word": "object", "bounding_box": [[0, 0, 1, 1]]}],
+#    "street/001.jpg": [{"word": "car", "inclusion_points": [{"x": 0.4, "y": 0.6}]}]}
+# Images are segmented in a pool of worker processes, each with its own copy of
+# the model, and each image's masks are written in one transaction. The pool
+# defaults to two workers (one on a single core), as every worker holds its own
+# model and activations in memory; raise --workers where memory allows.
+# Finished images are recorded in a checkpoint file, so a killed run picks up
+# where it stopped; words that already have a mask are skipped either way.
+class Command(BaseCommand):
+    help = "Segment a directory of images, or images already uploaded, with SAM2 prompts from a JSON file"
+
+    # segments one image in a worker; see annotate_image
+    worker = staticmethod(annotate_image)
+
+    def add_arguments(self, parser):
+        source = parser.add_mutually_exclusive_group(required=True)
+        source.add_argument('--dir', help="Directory of images to upload and annotate")
+        source.add_argument('--hash', nargs='+', help="file_hash of uploaded images to annotate")
+        source.add_argument('--all', action='store_true', help="Annotate every uploaded image")
+        parser.add_argument('--prompts', required=True, help="JSON file of items per image")
+        parser.add_argument('--model', type=int, default=3, help="0 = tiny, 1 = small, 2 = base_plus, 3 = large, 4-7 = the same quantised to int8")
+        parser.add_argument('--workers', type=int, default=min(2, os.cpu_count() or 1),
+                            help="Worker processes (default: 2, or 1 on a single core); each loads its own "
+                                 "copy of the model, so memory use grows with every worker")
+        parser.add_argument('--checkpoint', help="Progress file (default: the prompts file with .progress)")
+        parser.add_argument('--restart', action='store_true', help="Ignore progress from earlier runs")
+
+    def handle(self, *args, **options):
+        try:
+            with open(options['prompts']) as f:
+                prompts = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            raise CommandError(f"Could not read prompts from {options['prompts']}: {e}")
+        if not isinstance(prompts, dict):
+            raise CommandError("The prompts file must map image names or hashes to lists of items.")
+
+        checkpoint = options['checkpoint'] or f"{options['prompts']}.progress"
+        done = set() if options['restart'] else self.read_checkpoint(checkpoint)
+        workers = max(1, options['workers'])
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        self.stdout.write(f"{workers} workers with {threads} threads each, {len(done)} images already done")
+
+        executor = self.make_executor(workers, threads)
+        stats = {"images": 0, "masks": 0, "failed": 0, "skipped": 0, "busy": 0.0, "start": time.perf_counter()}
+        pending = {}
+        try:
+            for image, name in self.images(options):
+                if image.file_hash in done:
+                    stats["skipped"] += 1
+                    continue
+                parsed = self.parse_items(image, prompts.get(name, []) + prompts.get(image.file_hash, []) + prompts.get('*', []))
+                if not parsed:
+                    self.finish(image, checkpoint, done)
+                    continue
+                # keep every worker busy without decoding the whole directory up front
+                while len(pending) >= 2 * workers:
+                    self.collect(pending, checkpoint, done, stats, return_when=FIRST_COMPLETED)
+                pending[executor.submit(self.worker, image, parsed, options['model'])] = image
+            while pending:
+                self.collect(pending, checkpoint, done, stats, return_when=FIRST_COMPLETED)
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+        elapsed = time.perf_counter() - stats["start"]
+        self.stdout.write(self.style.SUCCESS(
+            f"Annotated {stats['images']} images with {stats['masks']} masks in {elapsed:.1f} s "
+            f"({stats['failed']} failed, {stats['skipped']} already done)"
+        ))
+
+    def make_executor(self, workers, threads):
+        # spawned, so workers do not inherit the parent's database connections
+        return ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_worker,
+            initargs=(threads,)
+        )
+
+    def images(self, options):
+        # (Image, name its prompts are listed under), uploading files from --dir
+        from ImageAnnotatorSAM2.models import Image
+
+        if options['dir']:
+            root = options['dir']
+            for dirpath, _, filenames in sorted(os.walk(root)):
+                for filename in sorted(filenames):
+                    if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS:
+                        path = os.path.join(dirpath, filename)
+                        name = os.path.relpath(path, root).replace(os.sep, '/')
+                        yield self.ingest(path, name), name
+            return
+
+        images = Image.objects.exclude(file='').order_by('id')
+        if options['hash']:
+            images = images.filter(file_hash__in=options['hash'])
+        for image in images.iterator():
+            yield image, image.name
+
+    def ingest(self, path, name):
+        # the Image for a file, uploading it unless an image with the same
+        # content has been uploaded already
+        from django.core.files import File
+        from ImageAnnotatorSAM2.image_cache import read_image_metadata
+        from ImageAnnotatorSAM2.models import Image
+
+        hasher = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                hasher.update(chunk)
+        image = Image.objects.filter(file_hash=hasher.hexdigest()).first()
+        if image is not None:
+            return image
+
+        with open(path, 'rb') as f:
+            metadata = read_image_metadata(f)
+            f.seek(0)
+            image = Image(name=name, file_hash=hasher.hexdigest(), **metadata)
+            image.file.save(os.path.basename(path), File(f), save=False)
+        image.save()
+        return image
+
+    def parse_items(self, image, items):
+        # items for the words the image has no mask for yet, with prompts scaled
+        # to the image; the size is read here so workers never touch the database
+        from ImageAnnotatorSAM2.models import Mask
+        from ImageAnnotatorSAM2.views import parse_bulk_items
+
+        try:
+            width, height = image.get_size()
+        except Exception as e:
+            self.stderr.write(f"{image.name}: could not read image size: {e}")
+            return []
+        existing = Mask.objects.filter(image=image).values_list('word__word', flat=True)
+        parsed, errors = parse_bulk_items(items, (height, width), existing)
+        for idx, e in errors.items():
+            if e.status_code != 409:
+                self.stderr.write(f"{image.name}: item {idx}: {e.message}")
+        return parsed
+
+    def collect(self, pending, checkpoint, done, stats, return_when):
+        from ImageAnnotatorSAM2.views import insert_masks
+
+        finished, _ = wait(pending, return_when=return_when)
+        for future in finished:
+            image = pending.pop(future)
+            try:
+                _, contents, seconds = future.result()
+                masks = insert_masks(image, [(word, content) for _, word, content in contents])
+            except Exception as e:
+                # left out of the checkpoint, so the next run tries it again
+                stats["failed"] += 1
+                self.stderr.write(f"{image.name}: {getattr(e, 'message', e)}")
+                continue
+            self.finish(image, checkpoint, done)
+            stats["images"] += 1
+            stats["masks"] += len(masks)
+            stats["busy"] += seconds
+            elapsed = time.perf_counter() - stats["start"]
+            self.stdout.write(
+                f"{image.name}: {len(masks)} masks in {seconds:.2f} s | "
+                f"{stats['images'] / elapsed:.2f} images/s, {stats['masks'] / elapsed:.2f} masks/s, "
+                f"{stats['busy'] / stats['images']:.2f} s/image per worker"
+            )
+
+    def read_checkpoint(self, checkpoint):
+        # one finished file_hash per line
+        try:
+            with open(checkpoint) as f:
+                return {line.strip() for line in f if line.strip()}
+        except FileNotFoundError:
+            return set()
+
+    def finish(self, image, checkpoint, done):
+        # appended and flushed per image, so a kill loses at most the images in flight
+        done.add(image.file_hash)
+        with open(checkpoint, 'a') as f:
+            f.write(f"{image.file_hash}\n")
+            f.flush()
+            os.fsync(f.fileno())
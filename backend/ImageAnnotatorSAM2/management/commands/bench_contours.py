@@ -0,0 +1,72 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from skimage import filters, measure
+
+from ImageAnnotatorSAM2.contours import find_contours, simplify_contours
+
+
+def legacy_simplify_contours(contours, max_points_per_contour=None, tolerance=0.5):
+    # the retry loop previously used by visualize_contours, minus its logging
+    simplified_contours = []
+    for contour in contours:
+        current_tolerance = tolerance
+        if max_points_per_contour and len(contour) > max_points_per_contour:
+            simplified = measure.approximate_polygon(contour, tolerance=current_tolerance)
+            while len(simplified) > max_points_per_contour and current_tolerance < 10:
+                current_tolerance += 0.5
+                simplified = measure.approximate_polygon(contour, tolerance=current_tolerance)
+            contour = simplified
+        simplified_contours.append(contour)
+    return simplified_contours
+
+
+def synthetic_mask(height, width, blur, seed):
+    # smoothed noise thresholded into irregular blobs, which gives long, wiggly
+    # contours like those of real segmentation masks
+    rng = np.random.default_rng(seed)
+    noise = filters.gaussian(rng.random((height, width)), sigma=blur)
+    return (noise > np.median(noise)).astype(np.uint8)
+
+
+class Command(BaseCommand):
+    help = "Benchmark contour simplification against the original tolerance retry loop"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--width', type=int, default=4000)
+        parser.add_argument('--height', type=int, default=3000)
+        parser.add_argument('--max-points', type=int, default=1000)
+        parser.add_argument('--blur', type=float, nargs='+', default=[40.0, 15.0, 6.0],
+                            help="Noise blur per test mask; smaller gives more, shorter contours")
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        for seed, blur in enumerate(options['blur']):
+            mask = synthetic_mask(options['height'], options['width'], blur, seed)
+            contours = find_contours(mask)
+            points = sum(len(contour) for contour in contours)
+            self.stdout.write(
+                f"{options['width']}x{options['height']} mask, blur {blur}: "
+                f"{len(contours)} contours, {points} points"
+            )
+
+            legacy_time, legacy = self.time(legacy_simplify_contours, contours, options)
+            new_time, (simplified, _) = self.time(simplify_contours, contours, options)
+
+            identical = all(np.array_equal(a, b) for a, b in zip(legacy, simplified))
+            self.stdout.write(
+                f"  retry loop {legacy_time * 1000:8.1f} ms  "
+                f"ranked pass {new_time * 1000:8.1f} ms  "
+                f"speedup {legacy_time / new_time:5.1f}x  "
+                f"identical output: {identical}"
+            )
+
+    def time(self, simplify, contours, options):
+        best = None
+        for _ in range(options['repeat']):
+            start = time.perf_counter()
+            result = simplify(contours, options['max_points'], 0.5)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best, result
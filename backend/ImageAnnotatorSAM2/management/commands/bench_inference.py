@@ -0,0 +1,85 @@
+import contextlib
+import os
+import time
+
+import numpy as np
+import torch
+from django.core.management.base import BaseCommand
+from PIL import Image as PILImage
+from sam2.sam2_image_predictor import SAM2ImagePredictor
+
+from ImageAnnotatorSAM2.inference_profile import configure_cpu, optimise_model
+from ImageAnnotatorSAM2.model_registry import build_model
+from ImageAnnotatorSAM2.SAM2Implimentation import MODEL_SPECS, device
+
+
+# (inference_mode, channels_last, compile) of each execution path compared; each
+# builds on inference_mode, and no_grad is how the predictor runs on its own
+VARIANTS = {
+    'no_grad': (False, False, False),
+    'inference_mode': (True, False, False),
+    'channels_last': (True, True, False),
+    'compile': (True, False, True),
+}
+
+
+class Command(BaseCommand):
+    help = "Benchmark SAM2 image encoding and prompt decoding per model size and execution path"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--models', type=int, nargs='+', default=list(range(len(MODEL_SPECS))),
+                            help="0 = tiny, 1 = small, 2 = base_plus, 3 = large, 4-7 = the same quantised to int8")
+        parser.add_argument('--variants', nargs='+', choices=list(VARIANTS),
+                            default=['no_grad', 'inference_mode', 'channels_last'],
+                            help="compile is left out by default, as compiling takes minutes per model")
+        parser.add_argument('--threads', type=int, help="Intra-op threads (default: as configured for a worker)")
+        parser.add_argument('--image', help="Image to encode (default: random pixels)")
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--random-weights', action='store_true',
+                            help="Build models without their checkpoints; timings are the same, masks are not")
+
+    def handle(self, *args, **options):
+        threads = configure_cpu(options['threads']) if device.type == 'cpu' else None
+        self.stdout.write(f"device {device}" + (f", {threads} threads" if threads else ""))
+        if options['image']:
+            image = np.array(PILImage.open(options['image']).convert('RGB'))
+        else:
+            image = np.random.default_rng(0).integers(0, 256, (1024, 1024, 3), dtype=np.uint8)
+        height, width = image.shape[:2]
+        point = [[width / 2, height / 2]]
+
+        for index in options['models']:
+            spec = MODEL_SPECS[index]
+            checkpoint = None if options['random_weights'] else spec['checkpoint']
+            if checkpoint and not os.path.isfile(checkpoint):
+                self.stdout.write(f"{spec['name']}: checkpoint {checkpoint} not found, skipped")
+                continue
+            baseline = None
+            for name in options['variants']:
+                inference_mode, channels_last, compile = VARIANTS[name]
+                model = optimise_model(build_model({**spec, 'checkpoint': checkpoint}, device),
+                                       channels_last=channels_last, compile=compile)
+                predictor = SAM2ImagePredictor(model)
+                context = torch.inference_mode if inference_mode else contextlib.nullcontext
+
+                with context():
+                    # the first encode includes one-off costs: allocator growth,
+                    # kernel selection and, with compile, compilation
+                    first, _ = self.time(predictor.set_image, image)
+                    encode = min(self.time(predictor.set_image, image)[0] for _ in range(options['repeat']))
+                    decode = np.median([
+                        self.time(predictor.predict, point_coords=point, point_labels=[1], multimask_output=False)[0]
+                        for _ in range(options['repeat'])
+                    ])
+                baseline = baseline or encode
+                self.stdout.write(
+                    f"{spec['name']:>14} {name:>14}  first encode {first * 1000:8.1f} ms  "
+                    f"encode {encode * 1000:8.1f} ms  decode {decode * 1000:7.1f} ms  "
+                    f"encode speedup {baseline / encode:5.2f}x"
+                )
+                del predictor, model
+
+    def time(self, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        return time.perf_counter() - start, result
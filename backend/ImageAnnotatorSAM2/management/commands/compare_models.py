@@ -0,0 +1,121 @@
+import time
+
+import numpy as np
+import torch
+from django.core.management.base import BaseCommand, CommandError
+from PIL import Image as PILImage
+
+from ImageAnnotatorSAM2.image_cache import load_inference_image
+from ImageAnnotatorSAM2.mask_codec import decode_mask, encode_mask
+from ImageAnnotatorSAM2.models import Image, Mask
+from ImageAnnotatorSAM2.SAM2Implimentation import (AutoSegmentTool, MODEL_SPECS, QUANTIZED_BASE, model_registry)
+
+
+def stored_mask(mask):
+    # a Mask's pixels as a (height, width) array of 0s and 1s, from whichever
+    # form it was stored in
+    if mask.maskRle is not None:
+        return decode_mask(bytes(mask.maskRle))
+    with mask.maskImage.open('rb') as f:
+        img = PILImage.open(f)
+        pixels = img.getchannel('A') if 'A' in img.getbands() else img.convert('L')
+        return (np.asarray(pixels) > 0).astype(np.uint8)
+
+
+def mask_box(mask):
+    # [[x1, y1], [x2, y2]] pixel corners of a mask's bounding box, or None if empty
+    rows, cols = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+    if not len(rows):
+        return None
+    return [[float(cols[0]), float(rows[0])], [float(cols[-1] + 1), float(rows[-1] + 1)]]
+
+
+def mask_iou(a, b):
+    a, b = a.astype(bool), b.astype(bool)
+    union = np.count_nonzero(a | b)
+    return np.count_nonzero(a & b) / union if union else 1.0
+
+
+# Compares SAM2 models on the masks annotators have already saved: each stored
+# mask's bounding box is used as a box prompt for every model, and the result
+# is scored by IoU against the stored mask and, for int8 models, against the
+# mask their float model produced from the same prompt. Encode and decode
+# times are measured without the embedding cache.
+class Command(BaseCommand):
+    help = "Compare SAM2 models' masks (IoU) and latency, e.g. int8 variants against their float models, on stored masks"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--models', type=int, nargs='+',
+                            help="Model indices (default: every int8 variant and its float model)")
+        parser.add_argument('--hash', nargs='+', help="file_hash of the images to use (default: any with masks)")
+        parser.add_argument('--images', type=int, default=20, help="Most images to use")
+        parser.add_argument('--masks-per-image', type=int, default=10)
+
+    def handle(self, *args, **options):
+        models = options['models'] or sorted({i for pair in QUANTIZED_BASE.items() for i in pair})
+        for model in models:
+            model_registry.check_index(model)
+
+        samples = self.samples(options)
+        if not samples:
+            raise CommandError("No stored masks to compare against.")
+        self.stdout.write(f"{len(samples)} images, {sum(len(prompts) for _, _, prompts in samples)} masks")
+
+        # one model at a time, so each is loaded once; predictions are kept run-length encoded
+        predictions, timings = {}, {}
+        for model in models:
+            predictions[model], timings[model] = self.run_model(model, samples)
+
+        self.stdout.write(f"{'model':>14} {'encode ms':>10} {'decode ms':>10} {'IoU stored':>11} {'IoU float':>10} {'min':>6}")
+        for model in models:
+            stored_ious, float_ious = [], []
+            base = QUANTIZED_BASE.get(model)
+            for _, _, prompts in samples:
+                for mask_pk, _, stored in prompts:
+                    predicted = decode_mask(predictions[model][mask_pk])
+                    stored_ious.append(mask_iou(predicted, decode_mask(stored)))
+                    if base in predictions:
+                        float_ious.append(mask_iou(predicted, decode_mask(predictions[base][mask_pk])))
+            encode, decode = timings[model]
+            self.stdout.write(
+                f"{MODEL_SPECS[model]['name']:>14} {np.mean(encode) * 1000:10.1f} {np.mean(decode) * 1000:10.1f} "
+                f"{np.mean(stored_ious):11.3f} "
+                + (f"{np.mean(float_ious):10.3f} {np.min(float_ious):6.3f}" if float_ious else f"{'-':>10} {'-':>6}")
+            )
+
+    def samples(self, options):
+        # [(image, (height, width), [(mask pk, box prompt, stored mask RLE)])]
+        images = Image.objects.filter(masks__isnull=False).exclude(file='').distinct().order_by('id')
+        if options['hash']:
+            images = images.filter(file_hash__in=options['hash'])
+        samples = []
+        for image in images[:options['images']]:
+            width, height = image.get_size()
+            prompts = []
+            for mask in Mask.objects.filter(image=image).order_by('id')[:options['masks_per_image']]:
+                pixels = stored_mask(mask)
+                box = mask_box(pixels)
+                if box is not None and pixels.shape == (height, width):
+                    prompts.append((mask.pk, box, encode_mask(pixels)))
+            if prompts:
+                samples.append((image, (height, width), prompts))
+        return samples
+
+    def run_model(self, model, samples):
+        tool = AutoSegmentTool()
+        predictions, encode, decode = {}, [], []
+        with model_registry.lock(model), torch.inference_mode():
+            sam2 = model_registry.get(model)
+            for image, size, prompts in samples:
+                inference_img = load_inference_image(image)
+                start = time.perf_counter()
+                # no imageHash, so the encoder runs rather than a cached embedding being used
+                tool.setImage(sam2, inference_img, model, outputSize=size)
+                encode.append(time.perf_counter() - start)
+                for mask_pk, box, _ in prompts:
+                    start = time.perf_counter()
+                    masks, _, _ = sam2.predict(box=box, multimask_output=False)
+                    decode.append(time.perf_counter() - start)
+                    predictions[mask_pk] = encode_mask(masks[0])
+        self.stdout.write(f"ran {MODEL_SPECS[model]['name']}")
+        return predictions, (encode, decode)
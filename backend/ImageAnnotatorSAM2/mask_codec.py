@@ -0,0 +1,67 @@
+import struct
+
+import numpy as np
+
+from .contour_codec import decode_varints, encode_varints
+
+
+# Binary masks are stored run-length encoded, as in COCO: the mask is read in
+# column-major order and stored as alternating runs of 0s and 1s, starting
+# with a (possibly empty) run of 0s. Run lengths are written as varints after
+# a header holding the mask's height and width.
+MAGIC = b'RLE1'
+HEADER = struct.Struct('<4sII')
+
+
+def encode_mask(mask):
+    mask = np.asarray(mask).astype(bool)
+    height, width = mask.shape[:2]
+    flat = mask.reshape(height, width).ravel(order='F')
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], changes, [flat.size])))
+    if flat.size and flat[0]:
+        counts = np.concatenate(([0], counts))
+    return HEADER.pack(MAGIC, height, width) + encode_varints(counts.astype(np.uint64))
+
+
+def decode_mask(data):
+    # returns the mask as a (height, width) uint8 array of 0s and 1s
+    magic, height, width = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not an encoded mask.")
+    counts = decode_varints(np.frombuffer(data, dtype=np.uint8, offset=HEADER.size)).astype(np.int64)
+    values = (np.arange(len(counts)) % 2).astype(np.uint8)
+    return np.repeat(values, counts).reshape((height, width), order='F')
+
+
+def mask_size(data):
+    # (height, width) of an encoded mask, read from its header alone
+    _, height, width = HEADER.unpack_from(data)
+    return height, width
+
+
+def coco_rle(data):
+    # the mask in COCO's uncompressed RLE format
+    _, height, width = HEADER.unpack_from(data)
+    counts = decode_varints(np.frombuffer(data, dtype=np.uint8, offset=HEADER.size))
+    return {"size": [height, width], "counts": counts.tolist()}
+
+
+def decode_mask_columns(data, left, right):
+    # decodes only columns [left, right) of the mask, as a (height, right - left)
+    # uint8 array, without expanding the rest of it
+    magic, height, width = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not an encoded mask.")
+    counts = decode_varints(np.frombuffer(data, dtype=np.uint8, offset=HEADER.size)).astype(np.int64)
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    first, last = left * height, right * height
+    # runs of 1s overlapping the columns, clipped to them and marked as +1 at
+    # their start and -1 at their end
+    ones = np.flatnonzero((np.arange(len(counts)) % 2 == 1) & (ends > first) & (starts < last))
+    edges = np.zeros(last - first + 1, dtype=np.int32)
+    np.add.at(edges, np.maximum(starts[ones], first) - first, 1)
+    np.add.at(edges, np.minimum(ends[ones], last) - first, -1)
+    region = np.cumsum(edges[:-1]).astype(np.uint8)
+    return region.reshape((height, right - left), order='F')
@@ -0,0 +1,75 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .image_cache import load_image_rgb
+from .mask_render import cutout_file, discard_cutout, mask_format, mask_image_file
+from .models import Image, Mask
+
+
+# Encodes mask images on a background thread once the /sam2/ response has been
+# sent, when SAM2_MASK_ENCODE_DEFERRED is set. The Mask is saved with its
+# run-length encoded mask and marked pending; its cutout can already be
+# rendered from that, and is marked ready once the image is written: the mask
+# file for 'png' storage, or the cached cutout for 'rle' storage.
+# Only `max_pending` masks are queued at once, as each holds its full size mask;
+# beyond that masks are encoded straight away by the caller.
+class MaskEncoder:
+    def __init__(self, max_pending):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='mask-encode')
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, mask, img_arr, mask_array):
+        if not self._slots.acquire(blocking=False):
+            return False
+        future = self._executor.submit(self._run, mask.pk, img_arr, mask_array)
+        future.add_done_callback(lambda _: self._slots.release())
+        return True
+
+    def _run(self, mask_id, img_arr, mask_array):
+        try:
+            self.encode(mask_id, img_arr, mask_array)
+        finally:
+            close_old_connections()
+
+    def encode(self, mask_id, img_arr, mask_array):
+        # img_arr is the mask's full size image, if already decoded
+        try:
+            mask = Mask.objects.select_related('image').get(pk=mask_id)
+        except Mask.DoesNotExist:
+            # deleted or replaced before it was encoded
+            return
+
+        try:
+            fmt = mask_format()
+            if getattr(settings, 'SAM2_MASK_STORAGE', 'rle') == 'png':
+                if img_arr is None and fmt != 'png1':
+                    img_arr = load_image_rgb(mask.image)
+                content = mask_image_file(img_arr, mask_array, fmt)
+                storage = mask.maskImage.storage
+                name = storage.save(mask.maskImage.field.generate_filename(mask, content.name), content)
+                updated = Mask.objects.filter(pk=mask_id).update(
+                    maskImage=name,
+                    maskRle=None,
+                    encoding_status=Mask.ENCODING_READY
+                )
+                if not updated:
+                    storage.delete(name)
+                    return
+                # any cutout rendered while it was pending is no longer needed
+                discard_cutout(mask)
+            else:
+                cutout_file(mask, fmt, img_arr).close()
+                Mask.objects.filter(pk=mask_id).update(encoding_status=Mask.ENCODING_READY)
+        except Exception as e:
+            print(f"Error encoding mask {mask_id}: {e}")
+            Mask.objects.filter(pk=mask_id).update(encoding_status=Mask.ENCODING_FAILED)
+        # mask responses include the status and image URL
+        Image.bump_version(mask.image_id)
+
+
+mask_encoder = MaskEncoder(
+    max_pending=getattr(settings, 'SAM2_MASK_ENCODE_MAX_PENDING', 4)
+)
@@ -0,0 +1,100 @@
+import os
+import uuid
+from io import BytesIO
+
+import numpy as np
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image as PILImage
+
+from .disk_cache import DiskCache
+from .image_cache import load_image_rgb
+from .mask_codec import decode_mask
+
+
+# Mask image formats, chosen with SAM2_MASK_FORMAT: (file extension, content type)
+#   png  - RGBA cutout of the image, with the mask as alpha
+#   webp - the same cutout as lossless WebP
+#   png1 - the mask alone as a 1-bit PNG, which does not need the image at all
+MASK_FORMATS = {
+    'png': ('png', 'image/png'),
+    'webp': ('webp', 'image/webp'),
+    'png1': ('png', 'image/png'),
+}
+
+# Cutouts rendered from run-length encoded masks, as <root>/<mask uuid>/<format>.<ext>
+# Masks are never modified (a new mask gets a new uuid), so a cached cutout
+# stays valid until its mask is deleted.
+mask_render_cache = DiskCache(
+    os.path.join(settings.MEDIA_ROOT, 'mask_renders'),
+    getattr(settings, 'SAM2_MASK_RENDER_CACHE_BYTES', 1024 * 1024 * 1024)
+)
+
+
+def mask_format():
+    fmt = getattr(settings, 'SAM2_MASK_FORMAT', 'png')
+    if fmt not in MASK_FORMATS:
+        raise ValueError(f"Unknown SAM2_MASK_FORMAT {fmt!r}, expected one of {', '.join(MASK_FORMATS)}")
+    return fmt
+
+
+def content_type(fmt):
+    return MASK_FORMATS[fmt][1]
+
+
+def cutout_name(fmt):
+    return f"{fmt}.{MASK_FORMATS[fmt][0]}"
+
+
+def render_cutout(img_arr, mask_array, fmt='png'):
+    # Encode the mask in the given format; img_arr is not used for png1
+    buffer = BytesIO()
+    if fmt == 'png1':
+        PILImage.fromarray(np.asarray(mask_array, dtype=bool)).save(buffer, format='PNG')
+        return buffer.getvalue()
+
+    # Cut the masked region out of the image, using the mask as alpha
+    alpha_channel = (mask_array * 255).astype(np.uint8)
+    img_arr_with_alpha = np.dstack((img_arr[..., :3], alpha_channel))
+    cutout = PILImage.fromarray(img_arr_with_alpha, 'RGBA')
+    if fmt == 'webp':
+        cutout.save(buffer, format='WEBP', lossless=True,
+                    method=getattr(settings, 'SAM2_MASK_WEBP_METHOD', 0))
+    else:
+        cutout.save(buffer, format='PNG',
+                    compress_level=getattr(settings, 'SAM2_MASK_PNG_COMPRESS_LEVEL', 1))
+    return buffer.getvalue()
+
+
+def mask_image_file(img_arr, mask_array, fmt):
+    # the mask image as a file to store in Mask.maskImage
+    filename = f"mask_{uuid.uuid4()}.{MASK_FORMATS[fmt][0]}"
+    return ContentFile(render_cutout(img_arr, mask_array, fmt), name=filename)
+
+
+def cutout_file(mask, fmt, img_arr=None):
+    # Returns the mask's cutout as an open file, rendering and caching it if needed
+    # img_arr is the source image, if already decoded
+    key = str(mask.uuid)
+    name = cutout_name(fmt)
+    path = mask_render_cache.get(key, name)
+    if path:
+        try:
+            return open(path, 'rb')
+        except OSError:
+            # evicted in the meantime
+            pass
+
+    if img_arr is None and fmt != 'png1':
+        img_arr = load_image_rgb(mask.image)
+    data = render_cutout(img_arr, decode_mask(bytes(mask.maskRle)), fmt)
+    if mask_render_cache.enabled:
+        def write(tmp_path):
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+        mask_render_cache.put(key, name, write)
+    return BytesIO(data)
+
+
+def discard_cutout(mask):
+    mask_render_cache.purge(str(mask.uuid))
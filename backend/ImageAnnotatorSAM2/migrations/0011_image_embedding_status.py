@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ImageAnnotatorSAM2', '0010_alter_mask_word'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='embedding_model',
+            field=models.IntegerField(blank=True, default=None, help_text='The SAM2 model the precomputed embedding belongs to', null=True),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='embedding_status',
+            field=models.CharField(choices=[('none', 'Not computed'), ('pending', 'Pending'), ('ready', 'Ready'), ('failed', 'Failed')], default='none', help_text='Whether a SAM2 embedding has been precomputed for this image', max_length=10),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ImageAnnotatorSAM2', '0011_image_embedding_status'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='image',
+            name='file_hash',
+            field=models.CharField(blank=True, default=None, help_text='A unique hash representing the content of the image', max_length=64, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ImageAnnotatorSAM2', '0012_unique_image_file_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mask',
+            name='contours_compact',
+            field=models.BinaryField(blank=True, help_text='Quantised, delta encoded contours of the mask', null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ImageAnnotatorSAM2', '0013_mask_contours_compact'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mask',
+            name='maskRle',
+            field=models.BinaryField(blank=True, help_text='The run-length encoded mask', null=True),
+        ),
+        migrations.AlterField(
+            model_name='mask',
+            name='maskImage',
+            field=models.ImageField(blank=True, help_text='The image file representing the mask', upload_to='masks/'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ImageAnnotatorSAM2', '0014_mask_rle'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mask',
+            name='encoding_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('ready', 'Ready'), ('failed', 'Failed')], default='ready', help_text='Whether the mask image has been encoded', max_length=10),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:58
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ImageAnnotatorSAM2', '0016_image_metadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='updated_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, help_text='When the image, its words or masks last changed'),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='version',
+            field=models.PositiveIntegerField(default=0, help_text='Incremented on every change to the image, its words or masks'),
+        ),
+    ]
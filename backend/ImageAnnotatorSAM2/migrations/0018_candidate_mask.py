@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:17
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ImageAnnotatorSAM2', '0017_image_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CandidateMask',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uuid', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('maskRle', models.BinaryField(help_text='The run-length encoded mask, at inference resolution')),
+                ('bbox', models.JSONField(help_text='Bounding box of the mask in image pixels, as [x, y, width, height]')),
+                ('area', models.PositiveIntegerField(help_text='Area of the mask in image pixels')),
+                ('predicted_iou', models.FloatField(help_text="The model's estimate of the mask's quality")),
+                ('stability_score', models.FloatField(help_text='How little the mask changes with the threshold on its logits')),
+                ('point', models.JSONField(help_text='The point prompt the mask was generated from')),
+                ('model', models.IntegerField(help_text='The SAM2 model that generated the mask')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('image', models.ForeignKey(help_text='The image the mask was generated for', on_delete=django.db.models.deletion.CASCADE, related_name='candidate_masks', to='ImageAnnotatorSAM2.image')),
+            ],
+            options={
+                'ordering': ['-predicted_iou'],
+            },
+        ),
+    ]
@@ -0,0 +1,130 @@
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+from sam2.build_sam import build_sam2
+from sam2.sam2_image_predictor import SAM2ImagePredictor
+
+from .inference_profile import optimise_model
+from .quantization import build_quantized_sam2, quantized_checkpoint_path
+
+
+def model_nbytes(model):
+    # from the state dict rather than parameters(), which leaves out the packed
+    # weights of quantised layers
+    nbytes = 0
+    for value in model.state_dict().values():
+        for t in value if isinstance(value, tuple) else (value,):
+            if isinstance(t, torch.Tensor):
+                nbytes += t.numel() * t.element_size()
+    return nbytes
+
+
+def model_device(spec, device):
+    # quantised models always run on the CPU
+    return torch.device('cpu') if spec.get('quantized') else device
+
+
+def build_model(spec, device):
+    if spec.get('quantized'):
+        return build_quantized_sam2(spec['config'], spec['checkpoint'])
+    return build_sam2(spec['config'], spec['checkpoint'], device=device)
+
+
+# Loads SAM2 checkpoints on first use and keeps the loaded models under a RAM
+# ceiling, evicting the least recently used model when another one is needed
+class ModelRegistry:
+    def __init__(self, specs, device, max_bytes):
+        # specs is a list of dicts with 'name', 'config' and 'checkpoint' keys
+        # (and 'quantized' for dynamic int8 variants), indexed by the `model`
+        # value of the /sam2/ API
+        self.specs = specs
+        self.device = device
+        self.max_bytes = max_bytes
+        self._predictors = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+        # held while a model is loaded, so concurrent first requests only load it once
+        self._load_locks = [threading.Lock() for _ in specs]
+        # held while a predictor is in use, since set_image() and predict()
+        # share state on the predictor
+        self._use_locks = [threading.Lock() for _ in specs]
+
+    def lock(self, index):
+        self.check_index(index)
+        return self._use_locks[index]
+
+    def get(self, index) -> SAM2ImagePredictor:
+        self.check_index(index)
+        with self._lock:
+            if index in self._predictors:
+                self._predictors.move_to_end(index)
+                return self._predictors[index]
+
+        with self._load_locks[index]:
+            with self._lock:
+                # another request may have finished loading it while we waited
+                if index in self._predictors:
+                    self._predictors.move_to_end(index)
+                    return self._predictors[index]
+                # free room before loading so peak usage stays under the ceiling,
+                # using the checkpoint size as an estimate of the model size
+                self._evict_for(self._estimate_nbytes(index))
+
+            predictor = self.build(index)
+
+            with self._lock:
+                self._predictors[index] = predictor
+                self._sizes[index] = model_nbytes(predictor.model)
+                self._evict_for(0, keep=index)
+            return predictor
+
+    def build(self, index) -> SAM2ImagePredictor:
+        spec = self.specs[index]
+        print(f"loading SAM2 model '{spec['name']}' on {model_device(spec, self.device)}")
+        model = optimise_model(build_model(spec, self.device))
+        return SAM2ImagePredictor(model)
+
+    def evict(self, index):
+        with self._lock:
+            self._remove(index)
+
+    def is_resident(self, index):
+        with self._lock:
+            return index in self._predictors
+
+    def resident(self):
+        # (index, name, bytes) of every loaded model, least recently used first
+        with self._lock:
+            return [(index, self.specs[index]['name'], self._sizes[index]) for index in self._predictors]
+
+    @property
+    def resident_bytes(self):
+        return sum(self._sizes.values())
+
+    def _estimate_nbytes(self, index):
+        checkpoint = self.specs[index]['checkpoint']
+        if checkpoint and self.specs[index].get('quantized') and os.path.isfile(quantized_checkpoint_path(checkpoint)):
+            checkpoint = quantized_checkpoint_path(checkpoint)
+        return os.path.getsize(checkpoint) if checkpoint and os.path.isfile(checkpoint) else 0
+
+    def _evict_for(self, nbytes, keep=None):
+        # always keeps at least the model being loaded, even if it alone is
+        # over the ceiling
+        for index in list(self._predictors):
+            if self.resident_bytes + nbytes <= self.max_bytes:
+                break
+            if index != keep:
+                self._remove(index)
+
+    def _remove(self, index):
+        if self._predictors.pop(index, None) is not None:
+            del self._sizes[index]
+            print(f"evicted SAM2 model '{self.specs[index]['name']}'")
+            if self.device.type == "cuda":
+                torch.cuda.empty_cache()
+
+    def check_index(self, index):
+        if isinstance(index, bool) or not isinstance(index, int) or not 0 <= index < len(self.specs):
+            raise ValueError(f"Unknown model {index!r}, expected 0 to {len(self.specs) - 1}.")
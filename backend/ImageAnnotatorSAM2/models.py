@@ -1,7 +1,13 @@
 from django.db import models, transaction
+from django.db.models import F
+from django.utils import timezone
 import uuid
 import os
 from django.dispatch import receiver
+from django.urls import reverse
+from .contour_codec import decode_contours, encode_contours
+from .mask_render import discard_cutout
+from .image_cache import read_image_metadata
 
 # Image model for storing images
 # Uses file hash for identification
@@ -30,12 +36,114 @@ class Image(models.Model):
         default=None,
         null=True, 
         blank=True, 
+        unique=True,
         help_text="A unique hash representing the content of the image"
     )
 
+    # Readiness of the precomputed SAM2 embedding for this image
+    EMBEDDING_NONE = 'none'
+    EMBEDDING_PENDING = 'pending'
+    EMBEDDING_READY = 'ready'
+    EMBEDDING_FAILED = 'failed'
+    EMBEDDING_STATUS_CHOICES = [
+        (EMBEDDING_NONE, 'Not computed'),
+        (EMBEDDING_PENDING, 'Pending'),
+        (EMBEDDING_READY, 'Ready'),
+        (EMBEDDING_FAILED, 'Failed'),
+    ]
+    embedding_status = models.CharField(
+        max_length=10,
+        choices=EMBEDDING_STATUS_CHOICES,
+        default=EMBEDDING_NONE,
+        help_text="Whether a SAM2 embedding has been precomputed for this image"
+    )
+
+    # Model index the embedding was precomputed for
+    embedding_model = models.IntegerField(
+        default=None,
+        null=True,
+        blank=True,
+        help_text="The SAM2 model the precomputed embedding belongs to"
+    )
+
+    # Read from the file's header at upload, so the size is known without
+    # decoding the image
+    width = models.PositiveIntegerField(
+        default=None,
+        null=True,
+        blank=True,
+        help_text="Width of the image in pixels"
+    )
+    height = models.PositiveIntegerField(
+        default=None,
+        null=True,
+        blank=True,
+        help_text="Height of the image in pixels"
+    )
+    mode = models.CharField(
+        max_length=10,
+        default=None,
+        null=True,
+        blank=True,
+        help_text="Pillow mode of the image, e.g. RGB"
+    )
+    orientation = models.PositiveSmallIntegerField(
+        default=None,
+        null=True,
+        blank=True,
+        help_text="EXIF orientation of the image, if it has one"
+    )
+
+    # Bumped whenever the image, or any of its words or masks, changes; used
+    # for ETags and Last-Modified headers on the endpoints serving them
+    version = models.PositiveIntegerField(
+        default=0,
+        help_text="Incremented on every change to the image, its words or masks"
+    )
+    updated_at = models.DateTimeField(
+        default=timezone.now,
+        help_text="When the image, its words or masks last changed"
+    )
+
     def __str__(self):
         return self.name if self.name else f"Image {self.id}"
 
+    # Saving an existing image (e.g. renaming it) changes what the API returns
+    # for it too, so it bumps the version in the same UPDATE
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            return super().save(*args, **kwargs)
+        self.version = F('version') + 1
+        self.updated_at = timezone.now()
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'version', 'updated_at'}
+        super().save(*args, **kwargs)
+        self.refresh_from_db(fields=['version'])
+
+    # Updates the given fields (if any) of an image and bumps its version
+    # Anything that changes what the API returns for an image must go through
+    # here (or save a Word/Mask, which does it via the signals below)
+    @staticmethod
+    def bump_version(image_id, **fields):
+        Image.objects.filter(pk=image_id).update(
+            version=F('version') + 1,
+            updated_at=timezone.now(),
+            **fields
+        )
+
+    # (width, height) of the image, read from the file's header and stored if
+    # this image was uploaded before sizes were recorded
+    def get_size(self):
+        if self.width is None or self.height is None:
+            with self.file.open('rb') as f:
+                metadata = read_image_metadata(f)
+            if not metadata:
+                raise ValueError(f"Could not read the size of {self}")
+            Image.bump_version(self.pk, **metadata)
+            for field, value in metadata.items():
+                setattr(self, field, value)
+        return self.width, self.height
+
 
 # Word model for associating words with images
 # Linked to one Image instance using a foreign key relationship
@@ -62,13 +170,21 @@ class Word(models.Model):
 # Each mask has a unique UUID and is associated with an image
 # Masks will be deleted if their associated image is deleted
 class Mask(models.Model):
-    # Required mask image field
+    # Mask image file, for masks stored as PNG cutouts
     maskImage = models.ImageField(
         upload_to='masks/', 
-        blank=False, 
+        blank=True, 
         null=False,  
         help_text="The image file representing the mask"
     )
+
+    # Run-length encoded mask (see mask_codec), for masks stored without a
+    # PNG; the cutout is rendered from it when requested
+    maskRle = models.BinaryField(
+        null=True,
+        blank=True,
+        help_text="The run-length encoded mask"
+    )
     
     # Unique identifier for each mask
     uuid = models.UUIDField(
@@ -93,16 +209,66 @@ class Mask(models.Model):
         blank=False,
         help_text="The word associated with this mask (optional)"
     )
+    # Whether the mask image has been written, when it is encoded after the
+    # response (SAM2_MASK_ENCODE_DEFERRED)
+    ENCODING_PENDING = 'pending'
+    ENCODING_READY = 'ready'
+    ENCODING_FAILED = 'failed'
+    ENCODING_STATUS_CHOICES = [
+        (ENCODING_PENDING, 'Pending'),
+        (ENCODING_READY, 'Ready'),
+        (ENCODING_FAILED, 'Failed'),
+    ]
+    encoding_status = models.CharField(
+        max_length=10,
+        choices=ENCODING_STATUS_CHOICES,
+        default=ENCODING_READY,
+        help_text="Whether the mask image has been encoded"
+    )
+
     contours = models.JSONField(
         null=True, 
         blank=True
     )
+    # Compact binary form of the contours (see contour_codec), stored instead of
+    # or alongside the JSON depending on SAM2_CONTOUR_STORAGE
+    contours_compact = models.BinaryField(
+        null=True,
+        blank=True,
+        help_text="Quantised, delta encoded contours of the mask"
+    )
 
     class Meta:
         unique_together = ('image', 'word')
 
     def __str__(self):
         return f"Mask {self.uuid}"
+
+    # URL of the stored PNG, or of the endpoint rendering one from the run-length encoded mask
+    def get_image_url(self):
+        if self.maskImage:
+            return self.maskImage.url
+        return reverse('render_mask', args=[self.uuid])
+
+    # Contours as JSON, decoded from the compact form if no JSON was stored
+    def get_contours(self):
+        if self.contours is not None or self.contours_compact is None:
+            return self.contours
+        return {
+            "label": self.word.word,
+            "contours": [
+                {"contour_index": idx, "points": points.tolist()}
+                for idx, points in enumerate(decode_contours(bytes(self.contours_compact)))
+            ]
+        }
+
+    # Contours in the compact form, encoded from the JSON if none was stored
+    def get_contours_compact(self):
+        if self.contours_compact is not None:
+            return bytes(self.contours_compact)
+        if self.contours is None:
+            return None
+        return encode_contours([contour["points"] for contour in self.contours["contours"]])
     
     # Override the delete method to ensure image file is deleted
     def delete(self, *args, **kwargs):
@@ -124,10 +290,75 @@ class Mask(models.Model):
                     existing_mask.delete()
             super().save(*args, **kwargs)
 
+# Mask found by automatic ("segment everything") generation, waiting for an
+# annotator to accept it as the mask of a Word or discard it. Stored at the
+# resolution inference ran at, and scaled to the image's size when accepted
+class CandidateMask(models.Model):
+    uuid = models.UUIDField(
+        default=uuid.uuid4,
+        editable=False,
+        unique=True
+    )
+
+    image = models.ForeignKey(
+        Image,
+        on_delete=models.CASCADE,
+        related_name='candidate_masks',
+        help_text="The image the mask was generated for"
+    )
+
+    # Run-length encoded mask (see mask_codec)
+    maskRle = models.BinaryField(
+        help_text="The run-length encoded mask, at inference resolution"
+    )
+
+    # [x, y, width, height] of the mask, in image pixels
+    bbox = models.JSONField(
+        help_text="Bounding box of the mask in image pixels, as [x, y, width, height]"
+    )
+    area = models.PositiveIntegerField(
+        help_text="Area of the mask in image pixels"
+    )
+    predicted_iou = models.FloatField(
+        help_text="The model's estimate of the mask's quality"
+    )
+    stability_score = models.FloatField(
+        help_text="How little the mask changes with the threshold on its logits"
+    )
+    # [x, y] of the grid point that produced the mask, in image pixels
+    point = models.JSONField(
+        help_text="The point prompt the mask was generated from"
+    )
+    model = models.IntegerField(
+        help_text="The SAM2 model that generated the mask"
+    )
+    created_at = models.DateTimeField(
+        auto_now_add=True
+    )
+
+    class Meta:
+        ordering = ['-predicted_iou']
+
+    def __str__(self):
+        return f"Candidate mask {self.uuid}"
+
+
 # Signal to delete image file when mask is deleted
 @receiver(models.signals.post_delete, sender=Mask)
 def auto_delete_mask_image_on_delete(sender, instance, **kwargs):
     """Deletes mask image from filesystem when the corresponding `Mask` object is deleted."""
     if instance.maskImage:
         if os.path.isfile(instance.maskImage.path):
-            os.remove(instance.maskImage.path)
\ No newline at end of file
+            os.remove(instance.maskImage.path)
+    # and any cutout rendered from its run-length encoded mask
+    if instance.maskRle is not None:
+        discard_cutout(instance)
+
+
+# Keep the image's version current as its words and masks change
+@receiver(models.signals.post_save, sender=Word)
+@receiver(models.signals.post_delete, sender=Word)
+@receiver(models.signals.post_save, sender=Mask)
+@receiver(models.signals.post_delete, sender=Mask)
+def bump_image_version(sender, instance, **kwargs):
+    Image.bump_version(instance.image_id)
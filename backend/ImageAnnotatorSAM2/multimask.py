@@ -0,0 +1,41 @@
+import uuid
+
+from django.conf import settings
+
+from .caches import LRUCache
+from .mask_codec import encode_mask
+
+
+def candidates_nbytes(entry):
+    return 1024 + sum(len(mask) for mask in entry["masks"])
+
+
+# The alternative masks of ambiguous /sam2/ clicks (multimask mode), keyed by a
+# random id sent back to the annotator, who picks one with /sam2/multimask/<id>/.
+# Masks are kept run-length encoded, best scoring first, for SAM2_MULTIMASK_TTL
+# seconds
+multimask_cache = LRUCache(
+    max_bytes=getattr(settings, 'SAM2_MULTIMASK_CACHE_BYTES', 64 * 1024 * 1024),
+    sizeof=candidates_nbytes,
+    ttl=getattr(settings, 'SAM2_MULTIMASK_TTL', 300)
+)
+
+
+def store_candidates(image, word, model, masks, scores):
+    """Cache the candidate masks of one click, returning the id to choose one
+    of them by and the cached entry."""
+    order = sorted(range(len(scores)), key=lambda idx: -float(scores[idx]))
+    entry = {
+        "image_id": image.pk,
+        "word": word,
+        "model": model,
+        "masks": [encode_mask(masks[idx]) for idx in order],
+        "scores": [float(scores[idx]) for idx in order]
+    }
+    candidates_id = str(uuid.uuid4())
+    multimask_cache.put(candidates_id, entry)
+    return candidates_id, entry
+
+
+def get_candidates(candidates_id):
+    return multimask_cache.get(str(candidates_id))
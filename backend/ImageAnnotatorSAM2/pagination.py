@@ -0,0 +1,22 @@
+# pagination.py
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+# Cursor pagination over the primary key, so pages stay stable while rows are
+# added and each page costs the same however deep into the results it is
+class IdCursorPagination(CursorPagination):
+    ordering = 'id'
+    page_size = getattr(settings, 'API_PAGE_SIZE', 100)
+    page_size_query_param = 'page_size'
+    max_page_size = getattr(settings, 'API_MAX_PAGE_SIZE', 1000)
+
+
+# Only paginates when the client asks to, with ?cursor= or ?page_size=, for
+# endpoints whose existing clients expect the whole list
+class OptionalCursorPagination(IdCursorPagination):
+    def paginate_queryset(self, queryset, request, view=None):
+        params = request.query_params
+        if self.cursor_query_param not in params and self.page_size_query_param not in params:
+            return None
+        return super().paginate_queryset(queryset, request, view)
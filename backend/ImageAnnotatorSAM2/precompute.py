@@ -0,0 +1,59 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .image_cache import load_inference_image
+from .models import Image
+from .SAM2Implimentation import AutoSegmentTool, interactive_gate
+
+
+# Precomputes SAM2 embeddings for newly uploaded images on a background thread,
+# so the first segmentation request lands on a warm cache
+# Only `max_pending` images are queued at once; uploads beyond that are left to
+# be encoded on their first /sam2/ request, so a bulk upload cannot build up a
+# backlog that competes with interactive inference
+class EmbeddingPrecomputer:
+    def __init__(self, max_pending):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sam2-precompute')
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, image, model):
+        if not self._slots.acquire(blocking=False):
+            return False
+
+        Image.bump_version(
+            image.pk,
+            embedding_status=Image.EMBEDDING_PENDING,
+            embedding_model=model
+        )
+        image.embedding_status = Image.EMBEDDING_PENDING
+        image.embedding_model = model
+
+        future = self._executor.submit(self._run, image.pk, model)
+        future.add_done_callback(lambda _: self._slots.release())
+        return True
+
+    def _run(self, image_id, model):
+        try:
+            # interactive requests always go first
+            interactive_gate.wait_until_idle()
+            image = Image.objects.get(pk=image_id)
+            self.compute(load_inference_image(image), model, image.file_hash)
+            status = Image.EMBEDDING_READY
+        except Exception as e:
+            print(f"Error precomputing embedding for image {image_id}: {e}")
+            status = Image.EMBEDDING_FAILED
+        try:
+            Image.bump_version(image_id, embedding_status=status)
+        finally:
+            close_old_connections()
+
+    def compute(self, image, model, image_hash):
+        AutoSegmentTool().precomputeEmbedding(image, model, image_hash)
+
+
+embedding_precomputer = EmbeddingPrecomputer(
+    max_pending=getattr(settings, 'SAM2_PRECOMPUTE_MAX_PENDING', 4)
+)
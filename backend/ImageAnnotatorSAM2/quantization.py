@@ -0,0 +1,74 @@
+import os
+import tempfile
+
+import torch
+from sam2.build_sam import build_sam2
+
+# Submodules whose Linear layers are quantised: the image encoder's attention
+# and MLP blocks, where nearly all inference time goes, and the prompt decoder's
+# transformer. Convolutions (patch embedding, FPN neck, mask upscaling) are
+# left in float, as dynamic quantisation only covers Linear layers
+QUANTIZED_MODULES = ('image_encoder', 'sam_mask_decoder')
+
+
+def quantize_model(model):
+    # dynamic int8: weights are stored as int8, activations are quantised on
+    # the fly per batch, so no calibration data is needed
+    for name in QUANTIZED_MODULES:
+        setattr(model, name, torch.ao.quantization.quantize_dynamic(
+            getattr(model, name), {torch.nn.Linear}, dtype=torch.qint8
+        ))
+    return model
+
+
+def quantized_checkpoint_path(checkpoint):
+    base, ext = os.path.splitext(checkpoint)
+    return f"{base}.int8{ext}"
+
+
+def save_state_dict(state, path):
+    # written to a file of its own beside `path`, then renamed over it, so
+    # processes quantising the same checkpoint at once (auto_annotate's
+    # workers, say) never write to the same file and readers never see a
+    # partial one
+    f = tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(path) or '.', prefix=f"{os.path.basename(path)}.", suffix='.tmp', delete=False
+    )
+    try:
+        with f:
+            torch.save(state, f)
+        os.replace(f.name, path)
+    except BaseException:
+        try:
+            os.remove(f.name)
+        except OSError:
+            pass
+        raise
+
+
+def build_quantized_sam2(config, checkpoint):
+    """Build a dynamic int8 SAM2 model from a float checkpoint, on the CPU
+    (quantised kernels only exist there).
+
+    The quantised weights are saved next to the checkpoint (as
+    <name>.int8.pt) and loaded from there while they are newer than it, so
+    later loads skip reading the float weights and quantising them.
+    """
+    cached = quantized_checkpoint_path(checkpoint) if checkpoint else None
+    if cached and os.path.isfile(cached) and os.path.getmtime(cached) >= os.path.getmtime(checkpoint):
+        # the layer structure must match before the quantised weights load into it
+        model = quantize_model(build_sam2(config, None, device='cpu'))
+        try:
+            model.load_state_dict(torch.load(cached, map_location='cpu', weights_only=True))
+            return model
+        except (OSError, RuntimeError, ValueError) as e:
+            print(f"Rebuilding unreadable quantised checkpoint {cached}: {e}")
+
+    model = quantize_model(build_sam2(config, checkpoint, device='cpu'))
+    if cached:
+        try:
+            save_state_dict(model.state_dict(), cached)
+        except OSError as e:
+            # e.g. a read-only checkpoints directory; quantising again next time is fine
+            print(f"Could not save quantised checkpoint {cached}: {e}")
+    return model
@@ -0,0 +1,59 @@
+from django.conf import settings
+
+from .caches import LRUCache
+
+
+def session_nbytes(session):
+    logits = session["logits"]
+    return 1024 + (logits.nbytes if logits is not None else 0)
+
+
+# Click refinement sessions, keyed by (Image.file_hash, word, model index). Each
+# holds the points clicked so far (relative {x, y, include}), the low resolution
+# logits of the last prediction, which are fed back to the decoder as its mask
+# prompt on the next click, and the uuid of the Mask that prediction was saved
+# as. Sessions live in the memory of the worker process; a click that finds no
+# session (or one whose mask has since been replaced or deleted) starts anew
+refinement_sessions = LRUCache(
+    max_bytes=getattr(settings, 'SAM2_REFINEMENT_CACHE_BYTES', 64 * 1024 * 1024),
+    sizeof=session_nbytes
+)
+
+
+def get_session(file_hash, word, model, mask_uuid):
+    """The refinement session for a word's mask, or a new empty one if the
+    word's current mask (`mask_uuid`, None if it has none) is not the one the
+    session last produced."""
+    session = refinement_sessions.get((file_hash, word, model))
+    if session is None or session["mask_uuid"] != mask_uuid:
+        return {"points": [], "logits": None, "mask_uuid": None}
+    return session
+
+
+def edit_points(session, add_point=None, remove_point=None):
+    """Points of a session after adding `add_point` or removing the point at
+    index `remove_point`, and the logits to prompt the decoder with.
+
+    The last logits are only reused when adding a point: they were predicted
+    with every current point, so after removing one they would keep its effect.
+    """
+    if add_point is not None:
+        return session["points"] + [add_point], session["logits"]
+    points = session["points"][:remove_point] + session["points"][remove_point + 1:]
+    return points, None
+
+
+def store_session(file_hash, word, model, points, logits, mask_uuid):
+    refinement_sessions.put((file_hash, word, model), {
+        "points": points,
+        "logits": logits,
+        "mask_uuid": mask_uuid
+    })
+
+
+def discard_session(file_hash, word, model):
+    refinement_sessions.pop((file_hash, word, model))
+
+
+def purge_sessions(file_hash):
+    refinement_sessions.discard_where(lambda key: key[0] == file_hash)
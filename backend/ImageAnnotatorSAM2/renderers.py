@@ -0,0 +1,20 @@
+# renderers.py
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from .contour_codec import CONTENT_TYPE
+
+
+# Lets clients ask for compact binary contours, with an Accept header of
+# application/x-sam2-contours or ?format=contours. Views stream the contours
+# themselves; anything else (e.g. errors) is still rendered as JSON.
+class ContourRenderer(BaseRenderer):
+    media_type = CONTENT_TYPE
+    format = 'contours'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, (bytes, bytearray)):
+            return data
+        if renderer_context and 'response' in renderer_context:
+            renderer_context['response']['Content-Type'] = JSONRenderer.media_type
+        return JSONRenderer().render(data, renderer_context=renderer_context)
@@ -1,11 +1,37 @@
 # serializers.py
 from rest_framework import serializers
-from .models import Image, Word, Mask
+from django.urls import reverse
+from .models import Image, Word, Mask, CandidateMask
+from .mask_codec import coco_rle, mask_size
+
+# ModelSerializer taking a `fields` argument that limits which of its fields are output
+class SelectableFieldsSerializer(serializers.ModelSerializer):
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            unknown = set(fields) - set(self.fields)
+            if unknown:
+                raise serializers.ValidationError({"fields": f"Unknown fields: {', '.join(sorted(unknown))}."})
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+class MaskSerializer(SelectableFieldsSerializer):
+    # JSON contours, whichever form they are stored in
+    contours = serializers.SerializerMethodField()
+    # URL of the mask's cutout, stored or rendered on request
+    maskImage = serializers.SerializerMethodField()
 
-class MaskSerializer(serializers.ModelSerializer):
     class Meta:
         model = Mask
-        fields = ['id', 'uuid', 'maskImage', 'image', 'word', 'contours']
+        fields = ['id', 'uuid', 'maskImage', 'encoding_status', 'image', 'word', 'contours']
+
+    def get_contours(self, obj):
+        return obj.get_contours()
+
+    def get_maskImage(self, obj):
+        url = obj.get_image_url()
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request is not None else url
 
 class WordSerializer(serializers.ModelSerializer):
     associated_masks = MaskSerializer(many=True, read_only=True)
@@ -14,13 +40,39 @@ class WordSerializer(serializers.ModelSerializer):
         model = Word
         fields = ['id', 'word', 'image', 'associated_masks']
 
-class ImageSerializer(serializers.ModelSerializer):
+# URL of a downsized copy of the image, for listings; None when the upload's
+# size could not be read (it is not an image PIL decodes, such as an SVG), so
+# clients show the original file instead
+class ThumbnailField(serializers.Field):
+    def __init__(self, **kwargs):
+        super().__init__(source='*', read_only=True, **kwargs)
+
+    def to_representation(self, image):
+        if not image.file_hash or image.width is None:
+            return None
+        url = reverse('image_thumbnail', args=[image.file_hash])
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request is not None else url
+
+class ImageSerializer(SelectableFieldsSerializer):
     masks = MaskSerializer(many=True, read_only=True)
     word_masks = WordSerializer(many=True, read_only=True)
+    thumbnail = ThumbnailField()
+
+    class Meta:
+        model = Image
+        fields = ['id', 'name', 'file', 'file_hash', 'thumbnail', 'width', 'height', 'mode', 'orientation', 'embedding_status', 'embedding_model', 'masks', 'word_masks']
+
+# Lightweight listing of an image, with counts in place of nested words and masks
+# (word_count and mask_count are annotated on the queryset)
+class ImageSummarySerializer(SelectableFieldsSerializer):
+    word_count = serializers.IntegerField(read_only=True)
+    mask_count = serializers.IntegerField(read_only=True)
+    thumbnail = ThumbnailField()
 
     class Meta:
         model = Image
-        fields = ['id', 'name', 'file', 'file_hash', 'masks', 'word_masks']
+        fields = ['id', 'name', 'file', 'file_hash', 'thumbnail', 'word_count', 'mask_count']
 
 # Serializer for handling only the file field of the Image model
 class ImageFileSerialiser(serializers.ModelSerializer):
@@ -28,3 +80,25 @@ class ImageFileSerialiser(serializers.ModelSerializer):
         model = Image
         fields = ['file']
 
+
+# Mask found by automatic generation, with the mask as COCO-style run lengths.
+# The mask is at inference resolution (see CandidateMask), mask_width x
+# mask_height, while bbox, area and point are in image pixels; clients scale
+# the mask by the image's size over those
+class CandidateMaskSerializer(serializers.ModelSerializer):
+    mask = serializers.SerializerMethodField()
+    mask_width = serializers.SerializerMethodField()
+    mask_height = serializers.SerializerMethodField()
+
+    class Meta:
+        model = CandidateMask
+        fields = ['uuid', 'bbox', 'area', 'predicted_iou', 'stability_score', 'point', 'model', 'mask', 'mask_width', 'mask_height']
+
+    def get_mask(self, obj):
+        return coco_rle(bytes(obj.maskRle))
+
+    def get_mask_width(self, obj):
+        return mask_size(bytes(obj.maskRle))[1]
+
+    def get_mask_height(self, obj):
+        return mask_size(bytes(obj.maskRle))[0]
@@ -1,13 +1,51 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from rest_framework.test import APIClient
 from rest_framework import status
-from .models import Image, Word, Mask
+from .models import Image, Word, Mask, CandidateMask
+from .caches import LRUCache
+from .model_registry import ModelRegistry, model_nbytes
+from .quantization import quantize_model, save_state_dict
+from .disk_cache import DiskCache
+from .embedding_store import read_embedding, write_embedding
+from .precompute import EmbeddingPrecomputer
+from .inference_scheduler import InferenceScheduler
+from .inference_profile import available_cpus, cpu_threads, optimise_model, start_warmup
+from .contours import simplify_contours
+from .contour_codec import decode_contours, decode_frames, encode_contours
+from .mask_codec import coco_rle, decode_mask, encode_mask
+from .mask_render import cutout_name, mask_render_cache
+from .mask_encoder import mask_encoder
+from .views import save_bulk_masks, sam2_async_slots
+from .management.commands import auto_annotate
+from .multimask import multimask_cache, store_candidates
+from .refinement import edit_points, get_session, refinement_sessions, store_session
+from .auto_masks import adaptive_points_per_batch, mask_nms, scale_mask
+from .image_cache import decoded_image_cache, inference_image_store, load_image_rgb, load_inference_image
+from .tiles import tile_pyramid
+from . import SAM2Implimentation
+from .SAM2Implimentation import AutoSegmentTool, embedding_cache, model_registry
+from sam2.sam2_image_predictor import SAM2ImagePredictor
+from django.test import override_settings
+from io import BytesIO
+from PIL import Image as PILImage
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.urls import reverse
+from django.db import IntegrityError
 import hashlib
 import json
 import os
 import uuid
+import tempfile
+import shutil
+from types import SimpleNamespace
+import threading
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+from django.core.management import call_command
+from io import StringIO
+import torch
+import numpy as np
+from skimage import measure
 
 # ------------------- Model Tests --------------------
 
@@ -29,6 +67,13 @@ class ImageModelTest(TestCase):
         self.assertEqual(self.image.file_hash, hashlib.md5(b"file_content").hexdigest())
         print("test_image_file_hash passed")
 
+    def test_image_file_hash_unique(self):
+        self.image.file_hash = hashlib.md5(b"file_content").hexdigest()
+        self.image.save()
+        with self.assertRaises(IntegrityError):
+            Image.objects.create(name='Copy', file_hash=self.image.file_hash)
+        print("test_image_file_hash_unique passed")
+
 
 
 class WordModelTest(TestCase):
@@ -99,6 +144,7 @@ class UploadImageViewTest(TestCase):
 
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertEqual(response.data['message'], 'Uploaded successfully!')
+        self.assertEqual(response.data['file_hash'], hashlib.md5(b"file_content").hexdigest())
         print("test_upload_image_success passed")
 
     def test_upload_image_duplicate(self):
@@ -112,8 +158,23 @@ class UploadImageViewTest(TestCase):
 
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertEqual(response.data['message'], 'This image has already been uploaded.')
+        self.assertEqual(Image.objects.count(), 1)
         print("test_upload_image_duplicate passed")
 
+    def test_upload_records_metadata(self):
+        buffer = BytesIO()
+        exif = PILImage.Exif()
+        exif[0x0112] = 6  # rotated 90 degrees
+        PILImage.new('RGB', (40, 30)).save(buffer, format='JPEG', exif=exif)
+        image = SimpleUploadedFile("photo.jpg", buffer.getvalue(), content_type="image/jpeg")
+        response = self.client.post(self.upload_url, {'image': image, 'name': 'Photo'}, format='multipart')
+
+        upload = Image.objects.get(file_hash=response.data['file_hash'])
+        self.assertEqual((upload.width, upload.height, upload.mode, upload.orientation), (40, 30, 'RGB', 6))
+        self.assertEqual(upload.get_size(), (40, 30))
+        upload.file.delete(save=False)
+        print("test_upload_records_metadata passed")
+
     def test_upload_invalid_file(self):
         invalid_file = SimpleUploadedFile("test.txt", b"invalid content", content_type="text/plain")
         response = self.client.post(self.upload_url, {'image': invalid_file, 'name': 'Invalid Image'}, format='multipart')
@@ -207,3 +268,1714 @@ class WordViewTest(TestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data['message'], 'Word deleted successfully.')
         print("test_delete_word passed")
+
+
+class SAM2maskViewTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.url = reverse('SAM2mask')
+
+    def test_words_must_match_prompts(self):
+        response = self.client.post(self.url, {
+            'file_hash': hashlib.md5(b"test").hexdigest(),
+            'words': json.dumps(['cat', 'dog']),
+            'bounding_box': json.dumps([[0.1, 0.1, 0.5, 0.5]]),
+            'model': '0'
+        }, format='multipart')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        print("test_words_must_match_prompts passed")
+
+    def test_empty_point_set(self):
+        for point_sets in [[{}], [{'inclusion_points': [], 'exclusion_points': []}], [[]]]:
+            response = self.client.post(self.url, {
+                'file_hash': hashlib.md5(b"test").hexdigest(),
+                'words': json.dumps(['cat']),
+                'point_sets': json.dumps(point_sets),
+                'model': '0'
+            }, format='multipart')
+
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, point_sets)
+            self.assertIn("'point_sets'", response.data['error'])
+        print("test_empty_point_set passed")
+
+    def test_missing_prompt(self):
+        response = self.client.post(self.url, {
+            'file_hash': hashlib.md5(b"test").hexdigest(),
+            'word': 'cat',
+            'model': '0'
+        }, format='multipart')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        print("test_missing_prompt passed")
+
+    def test_unknown_model(self):
+        # out of range or not a whole number, rejected before any model is loaded
+        for model in ['9', '-1', '1.5', '"abc"', 'true']:
+            response = self.client.post(self.url, {
+                'file_hash': hashlib.md5(b"test").hexdigest(),
+                'word': 'cat',
+                'bounding_box': json.dumps([0.1, 0.1, 0.5, 0.5]),
+                'model': model
+            }, format='multipart')
+
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, model)
+            self.assertIn("'model'", response.data['error'])
+        self.assertEqual(model_registry.resident(), [])
+        print("test_unknown_model passed")
+
+
+class MultimaskTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.image = Image.objects.create(name='Test Image', file_hash=hashlib.md5(b"multimask").hexdigest(), width=4, height=3)
+        self.masks = np.zeros((3, 3, 4), dtype=bool)
+        self.masks[0, :1] = True
+        self.masks[1, :2] = True
+        self.masks[2, :3] = True
+        self.candidates_id, self.entry = store_candidates(self.image, 'cat', 0, self.masks, np.array([0.5, 0.9, 0.7]))
+
+    def tearDown(self):
+        multimask_cache.clear()
+
+    def test_best_first(self):
+        self.assertEqual(self.entry["scores"], [0.9, 0.7, 0.5])
+        self.assertTrue(np.array_equal(decode_mask(self.entry["masks"][0]), self.masks[1]))
+        print("test_best_first passed")
+
+    def test_choose(self):
+        response = self.client.post(reverse('SAM2mask-multimask', args=[self.candidates_id]), {'index': 1}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        mask = Mask.objects.get(uuid=response.data['mask']['uuid'])
+        self.assertEqual(mask.word.word, 'cat')
+        self.assertTrue(np.array_equal(decode_mask(bytes(mask.maskRle)), self.masks[2]))
+        print("test_choose passed")
+
+    def test_invalid_index(self):
+        response = self.client.post(reverse('SAM2mask-multimask', args=[self.candidates_id]), {'index': 3}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        print("test_invalid_index passed")
+
+    def test_expired(self):
+        multimask_cache.clear()
+        response = self.client.post(reverse('SAM2mask-multimask', args=[self.candidates_id]), {'index': 0}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        print("test_expired passed")
+
+    def test_multimask_needs_single_prompt(self):
+        response = self.client.post(reverse('SAM2mask'), {
+            'file_hash': self.image.file_hash,
+            'word': 'cat',
+            'multimask': 'true',
+            'bounding_box': json.dumps([[0.1, 0.1, 0.5, 0.5], [0.5, 0.5, 0.9, 0.9]]),
+            'model': '0'
+        }, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        print("test_multimask_needs_single_prompt passed")
+
+
+class SAM2RefineViewTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.url = reverse('SAM2mask-refine')
+        self.file_hash = hashlib.md5(b"refine").hexdigest()
+        self.image = Image.objects.create(name='Test Image', file_hash=self.file_hash, width=4, height=4)
+        self.logits = np.zeros((1, 256, 256), dtype=np.float32)
+        self.points = [{"x": 0.1, "y": 0.2, "include": True}, {"x": 0.5, "y": 0.5, "include": False}]
+        store_session(self.file_hash, 'cat', 0, self.points, self.logits, None)
+
+    def tearDown(self):
+        refinement_sessions.clear()
+
+    def test_edit_points(self):
+        session = get_session(self.file_hash, 'cat', 0, None)
+        added = {"x": 0.9, "y": 0.9, "include": True}
+        points, logits = edit_points(session, add_point=added)
+        self.assertEqual(points, self.points + [added])
+        self.assertIs(logits, self.logits)
+        # logits predicted with a removed point are not reused
+        points, logits = edit_points(session, remove_point=0)
+        self.assertEqual(points, self.points[1:])
+        self.assertIsNone(logits)
+        self.assertEqual(session["points"], self.points)
+        print("test_edit_points passed")
+
+    def test_stale_session(self):
+        # the word's mask was replaced since the session last saved it
+        self.assertEqual(get_session(self.file_hash, 'cat', 0, str(uuid.uuid4()))["points"], [])
+        self.assertEqual(get_session(self.file_hash, 'cat', 1, None)["points"], [])
+        print("test_stale_session passed")
+
+    def test_get_and_delete_session(self):
+        url = reverse('SAM2mask-refine-session', args=[self.file_hash, 'cat'])
+        response = self.client.get(url, {'model': 0})
+        self.assertEqual(response.data['points'], self.points)
+        response = self.client.delete(f"{url}?model=0")
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.client.get(url, {'model': 0}).data['points'], [])
+        print("test_get_and_delete_session passed")
+
+    def test_one_edit_required(self):
+        response = self.client.post(self.url, {
+            'file_hash': self.file_hash, 'word': 'cat', 'model': 0,
+            'add_inclusion_point': {'x': 0.1, 'y': 0.1}, 'remove_point': 0
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        print("test_one_edit_required passed")
+
+    def test_remove_point_out_of_range(self):
+        response = self.client.post(self.url, {
+            'file_hash': self.file_hash, 'word': 'cat', 'model': 0, 'remove_point': 2
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        print("test_remove_point_out_of_range passed")
+
+
+# Clicks through /sam2/refine/ to a real predictor over the stub model, to see
+# what the decoder is prompted with
+class RefinementDecoderTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.predictor = use_stub_predictor(self)
+        buffer = BytesIO()
+        PILImage.new('RGB', (40, 30)).save(buffer, format='PNG')
+        self.image = Image.objects.create(
+            name='Test Image',
+            file=SimpleUploadedFile("refine_image.png", buffer.getvalue(), content_type="image/png"),
+            file_hash=hashlib.md5(b"refine-decoder").hexdigest(),
+            width=40,
+            height=30
+        )
+
+    def tearDown(self):
+        refinement_sessions.clear()
+        self.image.file.delete(save=False)
+
+    def click(self, **edit):
+        response = self.client.post(reverse('SAM2mask-refine'), {
+            'file_hash': self.image.file_hash, 'word': 'cat', 'model': 0, **edit
+        }, format='json')
+        self.assertIn(response.status_code, (status.HTTP_200_OK, status.HTTP_201_CREATED))
+        return self.predictor.model.decoder_calls[-1]
+
+    def session_logits(self):
+        return torch.as_tensor(refinement_sessions.get((self.image.file_hash, 'cat', 0))["logits"])
+
+    def test_logits_fed_back(self):
+        first = self.click(add_inclusion_point={'x': 0.25, 'y': 0.25})
+        self.assertIsNone(first["mask_input"])
+        logits = self.session_logits()
+        self.assertEqual(tuple(logits.shape), (1, 256, 256))
+
+        second = self.click(add_exclusion_point={'x': 0.75, 'y': 0.75})
+        self.assertEqual(tuple(second["mask_input"].shape), (1, 1, 256, 256))
+        self.assertTrue(torch.equal(second["mask_input"][0], logits))
+        self.assertEqual(second["points"].shape[1], 2)
+
+        # removing a point starts from the remaining points alone
+        third = self.click(remove_point=1)
+        self.assertIsNone(third["mask_input"])
+        self.assertEqual(third["points"].shape[1], 1)
+        print("test_logits_fed_back passed")
+
+    def test_lost_session_starts_again(self):
+        self.click(add_inclusion_point={'x': 0.25, 'y': 0.25})
+        # as when the session is evicted, or the worker restarted
+        refinement_sessions.clear()
+        call = self.click(add_inclusion_point={'x': 0.75, 'y': 0.75})
+        self.assertIsNone(call["mask_input"])
+        self.assertEqual(call["points"].shape[1], 1)
+
+        # as when the word's mask is replaced through /sam2/
+        Mask.objects.create(image=self.image, word=Word.objects.get(image=self.image, word='cat'),
+                            maskRle=encode_mask(np.zeros((30, 40))))
+        call = self.click(add_inclusion_point={'x': 0.5, 'y': 0.5})
+        self.assertIsNone(call["mask_input"])
+        self.assertEqual(call["points"].shape[1], 1)
+        print("test_lost_session_starts_again passed")
+
+
+# ------------------- Cache Tests --------------------
+
+class LRUCacheTest(TestCase):
+    def setUp(self):
+        self.cache = LRUCache(max_bytes=10, sizeof=len)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.put('a', b'1234')
+        self.cache.put('b', b'1234')
+        self.cache.get('a')
+        self.cache.put('c', b'1234')
+
+        self.assertIn('a', self.cache)
+        self.assertNotIn('b', self.cache)
+        self.assertIn('c', self.cache)
+        self.assertEqual(self.cache.current_bytes, 8)
+        print("test_evicts_least_recently_used passed")
+
+    def test_rejects_oversized_value(self):
+        self.assertFalse(self.cache.put('big', b'12345678901'))
+        self.assertEqual(len(self.cache), 0)
+        print("test_rejects_oversized_value passed")
+
+    def test_discard_where(self):
+        self.cache.put(('hash1', 0), b'12')
+        self.cache.put(('hash1', 3), b'12')
+        self.cache.put(('hash2', 0), b'12')
+        self.cache.discard_where(lambda key: key[0] == 'hash1')
+
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.current_bytes, 2)
+        print("test_discard_where passed")
+
+
+class TTLCacheTest(TestCase):
+    def test_entries_expire(self):
+        cache = LRUCache(max_bytes=10, sizeof=len, ttl=60)
+        cache.put('a', b'12')
+        self.assertEqual(cache.get('a'), b'12')
+        cache.ttl = 0
+        cache.put('b', b'12')
+        self.assertIsNone(cache.get('b'))
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.current_bytes, 2)
+        print("test_entries_expire passed")
+
+
+class FakeModelRegistry(ModelRegistry):
+    # builds a small linear layer in place of a SAM2 checkpoint
+    def build(self, index):
+        return SimpleNamespace(model=torch.nn.Linear(10, 10))
+
+
+class StubPromptEncoder:
+    # passes the points and mask input straight through to the decoder
+    def __call__(self, points, boxes, masks):
+        return points, masks
+
+    def get_dense_pe(self):
+        return None
+
+
+# Stands in for a SAM2 model behind a real SAM2ImagePredictor, so prompt
+# scaling, batching and mask upscaling run as they do with SAM2. The decoder
+# returns logits that are positive in a block around each prompt's first point
+# (a box's top left corner), so a mask shows which prompt it came from, and
+# records the prompts and mask inputs it was given
+class StubSAM2Model(torch.nn.Module):
+    image_size = 1024
+
+    def __init__(self):
+        super().__init__()
+        self.anchor = torch.nn.Parameter(torch.zeros(1))
+        self.sam_prompt_encoder = StubPromptEncoder()
+        self.decoder_calls = []
+
+    @property
+    def device(self):
+        return self.anchor.device
+
+    def sam_mask_decoder(self, sparse_prompt_embeddings, dense_prompt_embeddings, multimask_output, **kwargs):
+        coords, _ = sparse_prompt_embeddings
+        self.decoder_calls.append({"points": coords.clone(), "mask_input": dense_prompt_embeddings})
+        channels = 3 if multimask_output else 1
+        logits = torch.full((coords.shape[0], channels, 256, 256), -10.0)
+        for idx, (x, y) in enumerate(coords[:, 0].tolist()):
+            col, row = int(x / 4), int(y / 4)
+            for channel in range(channels):
+                # larger blocks for the alternative masks
+                half = 8 * (channel + 1)
+                logits[idx, channel, max(row - half, 0):row + half, max(col - half, 0):col + half] = 10.0
+        scores = torch.linspace(0.5, 0.9, channels).repeat(coords.shape[0], 1)
+        return logits, scores, None, None
+
+
+# The image encoder records the size of every image it encodes
+class StubPredictor(SAM2ImagePredictor):
+    def __init__(self):
+        super().__init__(StubSAM2Model())
+        self.encoder_calls = []
+
+    def set_image(self, image):
+        self.reset_predictor()
+        self.encoder_calls.append(tuple(image.shape[:2]))
+        self._orig_hw = [tuple(image.shape[:2])]
+        self._features = {
+            "image_embed": torch.zeros(1, 4, 4, 4),
+            "high_res_feats": [torch.zeros(1, 4, 16, 16), torch.zeros(1, 4, 8, 8)]
+        }
+        self._is_image_set = True
+
+
+def use_stub_predictor(test):
+    """Serve every model index with one StubPredictor for the rest of `test`,
+    with empty embedding caches and the on-disk store in a temporary directory."""
+    predictor = StubPredictor()
+    store = SAM2Implimentation.embedding_store
+    root = tempfile.mkdtemp()
+
+    def restore():
+        del model_registry.build
+        for index in range(len(model_registry.specs)):
+            model_registry.evict(index)
+        embedding_cache.clear()
+        SAM2Implimentation.embedding_store = store
+        shutil.rmtree(root, ignore_errors=True)
+
+    for index in range(len(model_registry.specs)):
+        model_registry.evict(index)
+    embedding_cache.clear()
+    model_registry.build = lambda index: predictor
+    SAM2Implimentation.embedding_store = DiskCache(root, 1024 * 1024 * 1024)
+    test.addCleanup(restore)
+    return predictor
+
+
+class EmbeddingReuseTest(TestCase):
+    def setUp(self):
+        self.predictor = use_stub_predictor(self)
+        self.image = np.zeros((300, 400, 3), dtype=np.uint8)
+        self.tool = AutoSegmentTool()
+
+    def test_second_prompt_skips_encoder(self):
+        self.tool.generateMask(self.image, inclusionPoints=[[100, 100]], model=0, imageHash='reuse')
+        self.tool.generateMask(self.image, boundingBoxes=[[[10, 10], [200, 200]]], model=0, imageHash='reuse')
+        self.assertEqual(self.predictor.encoder_calls, [(300, 400)])
+        # but another image, or the same one for another model, is encoded
+        self.tool.generateMask(self.image, inclusionPoints=[[100, 100]], model=0, imageHash='other')
+        self.tool.generateMask(self.image, inclusionPoints=[[100, 100]], model=1, imageHash='reuse')
+        self.assertEqual(len(self.predictor.encoder_calls), 3)
+        print("test_second_prompt_skips_encoder passed")
+
+    def test_restored_from_disk(self):
+        self.tool.generateMask(self.image, inclusionPoints=[[100, 100]], model=0, imageHash='reuse')
+        self.assertIsNotNone(SAM2Implimentation.embedding_store.get('reuse', 'tiny.npy'))
+        # as after a restart, or in another worker
+        embedding_cache.clear()
+        mask = self.tool.generateMask(self.image, inclusionPoints=[[100, 100]], model=0, imageHash='reuse')
+        self.assertEqual(len(self.predictor.encoder_calls), 1)
+        self.assertIn(('reuse', 0), embedding_cache)
+        self.assertTrue(mask[0, 100, 100])
+        print("test_restored_from_disk passed")
+
+
+class PromptShapeTest(TestCase):
+    # The stub decoder marks the area around each prompt's first point (a
+    # box's top left corner), so each mask shows which prompt it came from
+    def setUp(self):
+        self.predictor = use_stub_predictor(self)
+        self.image = np.zeros((300, 400, 3), dtype=np.uint8)
+        self.tool = AutoSegmentTool()
+
+    def test_mask_shapes(self):
+        one_box = self.tool.generateMask(self.image, boundingBoxes=[[[50, 50], [150, 150]]], model=0)
+        two_boxes = self.tool.generateMask(self.image, boundingBoxes=[[[50, 50], [150, 150]], [[300, 200], [390, 290]]], model=0)
+        points = self.tool.generateMask(self.image, inclusionPoints=[[100, 100]], exclusionPoints=[[10, 10]], model=0)
+
+        self.assertEqual(one_box.shape, (1, 300, 400))
+        self.assertEqual(two_boxes.shape, (2, 300, 400))
+        self.assertEqual(points.shape, (1, 300, 400))
+        self.assertTrue(two_boxes[0, 50, 50] and not two_boxes[0, 200, 300])
+        self.assertTrue(two_boxes[1, 200, 300] and not two_boxes[1, 50, 50])
+        print("test_mask_shapes passed")
+
+    def test_batched_shapes(self):
+        # prompts batched into one decoder call come back as they would alone
+        boxes = self.tool.runBatch(0, (id(self.image), None, "boxes"), [
+            (self.image, None, {"inclusionPoints": [], "boundingBoxes": [[[50, 50], [150, 150]]], "exclusionPoints": []}, None),
+            (self.image, None, {"inclusionPoints": [], "boundingBoxes": [[[300, 200], [390, 290]], [[200, 50], [250, 100]]], "exclusionPoints": []}, None),
+        ])
+        points = self.tool.runBatch(0, (id(self.image), None, "points", 1), [
+            (self.image, None, {"inclusionPoints": [[100, 100]], "boundingBoxes": [], "exclusionPoints": []}, None),
+            (self.image, None, {"inclusionPoints": [[300, 200]], "boundingBoxes": [], "exclusionPoints": []}, None),
+        ])
+
+        self.assertEqual([masks.shape for masks in boxes], [(1, 300, 400), (2, 300, 400)])
+        self.assertEqual([masks.shape for masks in points], [(1, 300, 400), (1, 300, 400)])
+        self.assertTrue(boxes[1][1, 50, 200])
+        self.assertTrue(points[1][0, 200, 300] and not points[0][0, 200, 300])
+        self.assertEqual(len(self.predictor.model.decoder_calls), 2)
+        print("test_batched_shapes passed")
+
+    def test_mixed_prompts_in_order(self):
+        prompts = [
+            {"boundingBoxes": [[[50, 50], [150, 150]]]},
+            {"inclusionPoints": [[300, 200]]},
+            {"boundingBoxes": [[[200, 50], [250, 100]]]},
+            {"inclusionPoints": [[100, 250]], "exclusionPoints": [[10, 10]]},
+        ]
+        masks = self.tool.generateMasks(self.image, prompts, model=0)
+
+        self.assertEqual(len(masks), 4)
+        self.assertTrue(all(mask.shape == (300, 400) for mask in masks))
+        corners = [(50, 50), (200, 300), (50, 200), (250, 100)]
+        for idx, mask in enumerate(masks):
+            for other, (row, col) in enumerate(corners):
+                self.assertEqual(bool(mask[row, col]), idx == other)
+        # the boxes go through one decoder call, and each length of point set through one
+        self.assertEqual(len(self.predictor.model.decoder_calls), 3)
+        print("test_mixed_prompts_in_order passed")
+
+
+class OutputSizeTest(TestCase):
+    # Inference runs on a downsized copy of the image, with prompts given and
+    # masks returned at the image's full size
+    def setUp(self):
+        self.predictor = use_stub_predictor(self)
+        self.tool = AutoSegmentTool()
+
+    def test_masks_at_output_size(self):
+        proxy = np.zeros((768, 1024, 3), dtype=np.uint8)
+        masks = self.tool.generateMask(proxy, inclusionPoints=[[3000, 600]], model=0, outputSize=(3000, 4000))
+
+        self.assertEqual(self.predictor.encoder_calls, [(768, 1024)])
+        self.assertEqual(masks.shape, (1, 3000, 4000))
+        self.assertTrue(masks[0, 600, 3000])
+        self.assertFalse(masks[0, 600 // 4, 3000 // 4])
+        print("test_masks_at_output_size passed")
+
+    def test_cached_embedding_at_another_size(self):
+        image = np.zeros((300, 400, 3), dtype=np.uint8)
+        self.tool.generateMask(image, inclusionPoints=[[100, 100]], model=0, imageHash='resized')
+        self.assertEqual(embedding_cache.get(('resized', 0))["orig_hw"], (300, 400))
+
+        masks = self.tool.generateMasks(image, [{"inclusionPoints": [[200, 150]]}, {"boundingBoxes": [[[600, 450], [700, 550]]]}],
+                                        model=0, imageHash='resized', outputSize=(600, 800))
+        self.assertEqual(len(self.predictor.encoder_calls), 1)
+        self.assertEqual([mask.shape for mask in masks], [(600, 800), (600, 800)])
+        self.assertTrue(masks[0][150, 200] and not masks[0][450, 600])
+        self.assertTrue(masks[1][450, 600] and not masks[1][150, 200])
+        # the stored size is unchanged, for requests without an output size
+        mask = self.tool.generateMask(image, inclusionPoints=[[100, 100]], model=0, imageHash='resized')
+        self.assertEqual(mask.shape, (1, 300, 400))
+        print("test_cached_embedding_at_another_size passed")
+
+
+class ModelRegistryTest(TestCase):
+    def setUp(self):
+        specs = [{'name': name, 'config': None, 'checkpoint': None} for name in ('tiny', 'small', 'large')]
+        # 440 bytes per model, so only two fit under the ceiling
+        self.registry = FakeModelRegistry(specs, torch.device('cpu'), max_bytes=1000)
+
+    def test_loads_on_first_use(self):
+        self.assertEqual(self.registry.resident(), [])
+        predictor = self.registry.get(1)
+        self.assertIs(self.registry.get(1), predictor)
+        self.assertEqual(self.registry.resident(), [(1, 'small', 440)])
+        print("test_loads_on_first_use passed")
+
+    def test_evicts_least_recently_used_model(self):
+        self.registry.get(0)
+        self.registry.get(1)
+        self.registry.get(0)
+        self.registry.get(2)
+
+        self.assertTrue(self.registry.is_resident(0))
+        self.assertFalse(self.registry.is_resident(1))
+        self.assertTrue(self.registry.is_resident(2))
+        self.assertLessEqual(self.registry.resident_bytes, 1000)
+        print("test_evicts_least_recently_used_model passed")
+
+    def test_unknown_model(self):
+        with self.assertRaises(ValueError):
+            self.registry.get(3)
+        with self.assertRaises(ValueError):
+            self.registry.get(True)
+        print("test_unknown_model passed")
+
+
+class QuantizationTest(TestCase):
+    def setUp(self):
+        self.model = torch.nn.Module()
+        self.model.image_encoder = torch.nn.Sequential(torch.nn.Linear(64, 64), torch.nn.Conv2d(3, 3, 1))
+        self.model.sam_mask_decoder = torch.nn.Sequential(torch.nn.Linear(64, 64))
+
+    def test_quantizes_linear_layers(self):
+        inputs = torch.randn(4, 64)
+        expected = self.model.sam_mask_decoder(inputs)
+        float_bytes = model_nbytes(self.model)
+        quantize_model(self.model)
+
+        self.assertIsInstance(self.model.image_encoder[0], torch.ao.nn.quantized.dynamic.Linear)
+        self.assertIsInstance(self.model.image_encoder[1], torch.nn.Conv2d)
+        self.assertTrue(torch.allclose(self.model.sam_mask_decoder(inputs), expected, atol=0.05))
+        # int8 weights are counted, at a quarter of their float size
+        self.assertLess(model_nbytes(self.model), float_bytes / 2)
+        self.assertGreater(model_nbytes(self.model), float_bytes / 5)
+        print("test_quantizes_linear_layers passed")
+
+    def test_variants_follow_float_models(self):
+        from .SAM2Implimentation import MODEL_SPECS, QUANTIZED_BASE
+        for index, base in QUANTIZED_BASE.items():
+            self.assertEqual(MODEL_SPECS[index]['name'], f"{MODEL_SPECS[base]['name']}_int8")
+            self.assertEqual(MODEL_SPECS[index]['checkpoint'], MODEL_SPECS[base]['checkpoint'])
+        self.assertEqual(len(QUANTIZED_BASE), 4)
+        print("test_variants_follow_float_models passed")
+
+    def test_concurrent_saves(self):
+        # workers quantising the same checkpoint at once each write their own
+        # temporary file, and whichever renames last leaves a whole checkpoint
+        quantize_model(self.model)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'sam2.1_hiera_tiny.int8.pt')
+        state = self.model.state_dict()
+        threads = [threading.Thread(target=save_state_dict, args=(state, path)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(os.listdir(directory), ['sam2.1_hiera_tiny.int8.pt'])
+        loaded = torch.load(path, weights_only=True)
+        self.assertEqual(set(loaded), set(state))
+        print("test_concurrent_saves passed")
+
+    def test_failed_save_leaves_nothing(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with self.assertRaises(Exception):
+            # a lambda cannot be pickled
+            save_state_dict({'weight': lambda: None}, os.path.join(directory, 'model.int8.pt'))
+        self.assertEqual(os.listdir(directory), [])
+        print("test_failed_save_leaves_nothing passed")
+
+
+class DiskCacheTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = DiskCache(self.root, max_bytes=10)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def write_bytes(self, data):
+        def write(path):
+            with open(path, 'wb') as f:
+                f.write(data)
+        return write
+
+    def test_put_and_get(self):
+        self.assertIsNone(self.cache.get('hash1', 'tiny.npy'))
+        path = self.cache.put('hash1', 'tiny.npy', self.write_bytes(b'1234'))
+        self.assertEqual(self.cache.get('hash1', 'tiny.npy'), path)
+        print("test_put_and_get passed")
+
+    def test_evicts_oldest_over_limit(self):
+        self.cache.put('hash1', 'tiny.npy', self.write_bytes(b'123456'))
+        os.utime(self.cache.path('hash1', 'tiny.npy'), (0, 0))
+        self.cache.put('hash2', 'tiny.npy', self.write_bytes(b'123456'))
+
+        self.assertIsNone(self.cache.get('hash1', 'tiny.npy'))
+        self.assertIsNotNone(self.cache.get('hash2', 'tiny.npy'))
+        self.assertLessEqual(self.cache.size(), 10)
+        print("test_evicts_oldest_over_limit passed")
+
+    def test_purge(self):
+        self.cache.put('hash1', 'tiny.npy', self.write_bytes(b'12'))
+        self.cache.put('hash1', 'large.npy', self.write_bytes(b'12'))
+        self.cache.purge('hash1')
+        self.assertEqual(self.cache.size(), 0)
+        print("test_purge passed")
+
+    def test_walks_only_over_limit(self):
+        walks = []
+        files = self.cache._files
+        self.cache._files = lambda root=None: walks.append(root) or files(root)
+
+        self.cache.put('hash1', 'tiny.npy', self.write_bytes(b'1234'))
+        self.assertEqual(len(walks), 1)
+        # overwriting and writing under the limit use the running total
+        self.cache.put('hash1', 'tiny.npy', self.write_bytes(b'12'))
+        self.cache.put('hash2', 'tiny.npy', self.write_bytes(b'1234'))
+        self.assertEqual(len(walks), 1)
+        self.assertEqual(self.cache._total, 6)
+
+        self.cache.purge('hash2')
+        self.assertEqual(self.cache._total, 2)
+        # going over the limit walks the cache and evicts
+        self.cache.put('hash3', 'tiny.npy', self.write_bytes(b'123456789'))
+        self.assertLessEqual(self.cache.size(), 10)
+        self.assertEqual(self.cache._total, self.cache.size())
+        print("test_walks_only_over_limit passed")
+
+    def test_embedding_round_trip(self):
+        entry = {
+            "features": {
+                "image_embed": torch.rand(1, 8, 4, 4),
+                "high_res_feats": [torch.rand(1, 2, 16, 16), torch.rand(1, 4, 8, 8)]
+            },
+            "orig_hw": (30, 40)
+        }
+        path = os.path.join(self.root, 'embedding.npy')
+        write_embedding(path, entry)
+        loaded = read_embedding(path, torch.device('cpu'))
+
+        self.assertEqual(loaded["orig_hw"], (30, 40))
+        self.assertTrue(torch.equal(loaded["features"]["image_embed"], entry["features"]["image_embed"]))
+        for loaded_feat, feat in zip(loaded["features"]["high_res_feats"], entry["features"]["high_res_feats"]):
+            self.assertTrue(torch.equal(loaded_feat, feat))
+        print("test_embedding_round_trip passed")
+
+
+class BlockedPrecomputer(EmbeddingPrecomputer):
+    # holds every job until released, standing in for a slow image encoder
+    def __init__(self, max_pending):
+        super().__init__(max_pending)
+        self.release = threading.Event()
+
+    def _run(self, image_id, model):
+        self.release.wait(timeout=5)
+
+
+class EmbeddingPrecomputerTest(TestCase):
+    def setUp(self):
+        self.precomputer = BlockedPrecomputer(max_pending=1)
+        self.image = Image.objects.create(
+            name='Test Image',
+            file=SimpleUploadedFile("test_image.jpg", b"file_content", content_type="image/jpeg"),
+            file_hash=hashlib.md5(b"test").hexdigest()
+        )
+
+    def tearDown(self):
+        self.precomputer.release.set()
+        self.precomputer._executor.shutdown(wait=True)
+
+    def test_submit_marks_image_pending(self):
+        self.assertTrue(self.precomputer.submit(self.image, 0))
+        self.image.refresh_from_db()
+        self.assertEqual(self.image.embedding_status, Image.EMBEDDING_PENDING)
+        self.assertEqual(self.image.embedding_model, 0)
+        print("test_submit_marks_image_pending passed")
+
+    def test_queue_is_bounded(self):
+        other = Image.objects.create(name='Other Image', file_hash=hashlib.md5(b"other").hexdigest())
+        self.assertTrue(self.precomputer.submit(self.image, 0))
+        self.assertFalse(self.precomputer.submit(other, 0))
+        other.refresh_from_db()
+        self.assertEqual(other.embedding_status, Image.EMBEDDING_NONE)
+        print("test_queue_is_bounded passed")
+
+
+class InferenceProfileTest(TestCase):
+    @override_settings(SAM2_CPU_THREADS=None, SAM2_CPU_WORKERS=3)
+    def test_threads_shared_between_workers(self):
+        self.assertEqual(cpu_threads(), max(1, available_cpus() // 3))
+        with override_settings(SAM2_CPU_WORKERS=available_cpus() * 2):
+            self.assertEqual(cpu_threads(), 1)
+        with override_settings(SAM2_CPU_THREADS=5):
+            self.assertEqual(cpu_threads(), 5)
+        print("test_threads_shared_between_workers passed")
+
+    def test_channels_last(self):
+        inputs = []
+
+        class Encoder(torch.nn.Conv2d):
+            def forward(self, sample):
+                inputs.append(sample)
+                return super().forward(sample)
+        model = SimpleNamespace(image_encoder=Encoder(3, 4, 3))
+        optimise_model(model, channels_last=True, compile=False)
+        self.assertTrue(model.image_encoder.weight.is_contiguous(memory_format=torch.channels_last))
+        # the image batch is converted too, so no layer converts it back and forth
+        output = model.image_encoder(torch.rand(1, 3, 8, 8))
+        self.assertTrue(inputs[0].is_contiguous(memory_format=torch.channels_last))
+        self.assertTrue(output.is_contiguous(memory_format=torch.channels_last))
+        print("test_channels_last passed")
+
+    @override_settings(SAM2_WARMUP_MODELS=[])
+    def test_warmup_disabled(self):
+        # wsgi.py and asgi.py call it on import, so it must do nothing unless configured
+        threads = threading.active_count()
+        self.assertIsNone(start_warmup())
+        self.assertEqual(threading.active_count(), threads)
+        self.assertEqual(model_registry.resident(), [])
+        print("test_warmup_disabled passed")
+
+
+class InferenceSchedulerTest(TestCase):
+    def setUp(self):
+        self.batches = []
+        self.scheduler = InferenceScheduler(self.run_batch, window=0.2, max_batch_size=8)
+
+    def run_batch(self, model, key, payloads):
+        if key == 'broken':
+            raise RuntimeError('decoder failed')
+        self.batches.append((model, key, payloads))
+        return [payload * 2 for payload in payloads]
+
+    def test_batches_requests_with_same_key(self):
+        futures = [
+            self.scheduler.submit(0, 'image1', 1),
+            self.scheduler.submit(0, 'image2', 2),
+            self.scheduler.submit(0, 'image1', 3),
+        ]
+        self.assertEqual([future.result(timeout=5) for future in futures], [2, 4, 6])
+        self.assertEqual(self.batches, [(0, 'image1', [1, 3]), (0, 'image2', [2])])
+        print("test_batches_requests_with_same_key passed")
+
+    def test_errors_reach_every_request_in_batch(self):
+        futures = [self.scheduler.submit(0, 'broken', n) for n in range(2)]
+        for future in futures:
+            with self.assertRaises(RuntimeError):
+                future.result(timeout=5)
+        print("test_errors_reach_every_request_in_batch passed")
+
+
+class SAM2maskAsyncViewTest(TestCase):
+    async def test_missing_prompt(self):
+        response = await self.async_client.post(reverse('SAM2mask-async'), {
+            'file_hash': hashlib.md5(b"test").hexdigest(),
+            'word': 'cat',
+            'model': '0'
+        })
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        print("test_missing_prompt passed")
+
+    async def test_image_not_found(self):
+        response = await self.async_client.post(
+            reverse('SAM2mask-async'),
+            json.dumps({
+                'file_hash': hashlib.md5(b"nonexistent").hexdigest(),
+                'word': 'cat',
+                'bounding_box': [[0.1, 0.1, 0.5, 0.5]],
+                'model': 0
+            }),
+            content_type='application/json'
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        print("test_image_not_found passed")
+
+    @override_settings(SAM2_ASYNC_QUEUE_TIMEOUT=0.05)
+    async def test_busy(self):
+        # every slot in the process is taken, so the request gives up waiting for one
+        taken = 0
+        while sam2_async_slots.acquire(blocking=False):
+            taken += 1
+        try:
+            response = await self.async_client.post(reverse('SAM2mask-async'), {
+                'file_hash': hashlib.md5(b"test").hexdigest(),
+                'word': 'cat',
+                'bounding_box': json.dumps([[0.1, 0.1, 0.5, 0.5]]),
+                'model': '0'
+            })
+        finally:
+            for _ in range(taken):
+                sam2_async_slots.release()
+
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        print("test_busy passed")
+
+
+# The view reads the image on executor threads, which only see committed rows
+class SAM2maskAsyncCancelTest(TransactionTestCase):
+    def setUp(self):
+        buffer = BytesIO()
+        PILImage.new('RGB', (8, 6), (10, 20, 30)).save(buffer, format='PNG')
+        self.image = Image.objects.create(
+            name='Test Image',
+            file=SimpleUploadedFile("async_image.png", buffer.getvalue(), content_type="image/png"),
+            file_hash=hashlib.md5(b"async").hexdigest(),
+            width=8,
+            height=6
+        )
+        # inference that never finishes, standing in for a job still queued
+        self.submitted = []
+
+        def submit(model, key, job):
+            future = Future()
+            self.submitted.append(future)
+            return future
+        SAM2Implimentation.inference_scheduler.submit = submit
+        self.addCleanup(delattr, SAM2Implimentation.inference_scheduler, 'submit')
+
+    async def test_disconnect_cancels_inference(self):
+        request = asyncio.ensure_future(self.async_client.post(reverse('SAM2mask-async'), {
+            'file_hash': self.image.file_hash,
+            'word': 'cat',
+            'bounding_box': json.dumps([[0.1, 0.1, 0.5, 0.5]]),
+            'model': '0'
+        }))
+        while not self.submitted and not request.done():
+            await asyncio.sleep(0.01)
+        self.assertFalse(request.done())
+        # as when the client disconnects
+        request.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await request
+
+        self.assertTrue(self.submitted[0].cancelled())
+        self.assertFalse(await Mask.objects.filter(image=self.image).aexists())
+        # the request's slot is given back
+        self.assertTrue(sam2_async_slots.acquire(blocking=False))
+        sam2_async_slots.release()
+        print("test_disconnect_cancels_inference passed")
+
+
+class SAM2BulkViewTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        buffer = BytesIO()
+        PILImage.new('RGB', (8, 6), (10, 20, 30)).save(buffer, format='PNG')
+        self.image = Image.objects.create(
+            name='Test Image',
+            file=SimpleUploadedFile("bulk_image.png", buffer.getvalue(), content_type="image/png"),
+            file_hash=hashlib.md5(b"bulk").hexdigest(),
+            width=8,
+            height=6
+        )
+        self.url = reverse('SAM2mask-bulk')
+
+    def tearDown(self):
+        self.image.file.delete(save=False)
+
+    def test_invalid_items_reported(self):
+        response = self.client.post(self.url, {
+            'file_hash': self.image.file_hash,
+            'items': [
+                {'bounding_box': [[0.1, 0.1, 0.5, 0.5]]},
+                {'word': 'dog'},
+                {'word': 'sun', 'bounding_box': [[0.1, 0.1, 0.5, 0.5]], 'inclusion_points': [{'x': 0.5, 'y': 0.5}]},
+            ]
+        }, format='json')
+
+        # nothing left to segment
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            [result['status'] for result in response.data['results']],
+            [status.HTTP_400_BAD_REQUEST] * 3
+        )
+        self.assertFalse(Mask.objects.filter(image=self.image).exists())
+        print("test_invalid_items_reported passed")
+
+    def test_existing_mask_replaced(self):
+        use_stub_predictor(self)
+        mask = Mask.objects.create(
+            image=self.image,
+            word=Word.objects.create(word='cat', image=self.image),
+            maskRle=encode_mask(np.ones((6, 8)))
+        )
+        response = self.client.post(self.url, {
+            'file_hash': self.image.file_hash,
+            'model': 0,
+            'items': [
+                {'word': 'cat', 'bounding_box': [[0.1, 0.1, 0.5, 0.5]]},
+                {'word': 'dog', 'inclusion_points': [{'x': 0.75, 'y': 0.75}]},
+                {'word': 'cat', 'bounding_box': [[0.5, 0.5, 0.9, 0.9]]},
+            ]
+        }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(
+            [result['status'] for result in response.data['results']],
+            [status.HTTP_201_CREATED, status.HTTP_201_CREATED, status.HTTP_409_CONFLICT]
+        )
+        self.assertFalse(Mask.objects.filter(pk=mask.pk).exists())
+        self.assertEqual(sorted(Mask.objects.filter(image=self.image).values_list('word__word', flat=True)), ['cat', 'dog'])
+        self.assertEqual(Word.objects.filter(image=self.image, word='cat').count(), 1)
+        print("test_existing_mask_replaced passed")
+
+    def test_too_many_items(self):
+        with override_settings(SAM2_BULK_MAX_ITEMS=1):
+            response = self.client.post(self.url, {
+                'file_hash': self.image.file_hash,
+                'items': [{'word': 'cat'}, {'word': 'dog'}]
+            }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        print("test_too_many_items passed")
+
+    def test_saved_in_bulk(self):
+        Word.objects.create(word='cat', image=self.image)
+        masks_by_word = []
+        for word, row in (('cat', 1), ('dog', 2), ('sun', 3)):
+            mask_array = np.zeros((6, 8), dtype=np.uint8)
+            mask_array[row, 2:6] = 1
+            masks_by_word.append((word, mask_array))
+        version = Image.objects.get(pk=self.image.pk).version
+
+        # the masks being replaced, the existing words, the words' and masks'
+        # inserts and the image's version, in a savepoint in tests
+        with self.assertNumQueries(7):
+            masks = save_bulk_masks(self.image, masks_by_word)
+
+        self.assertEqual([mask.word.word for mask in masks], ['cat', 'dog', 'sun'])
+        self.assertTrue(all(mask.pk for mask in masks))
+        self.assertEqual(Word.objects.filter(image=self.image).count(), 3)
+        self.assertTrue(np.array_equal(decode_mask(bytes(masks[1].maskRle)), masks_by_word[1][1]))
+        self.assertEqual(Image.objects.get(pk=self.image.pk).version, version + 1)
+        print("test_saved_in_bulk passed")
+
+
+# auto_annotate with its workers as threads of the test process, and inference
+# replaced by a mask of the whole image, failing for the images in `failing`
+class FakeAnnotateCommand(auto_annotate.Command):
+    def __init__(self, failing=()):
+        super().__init__(stdout=StringIO(), stderr=StringIO())
+        self.failing = failing
+        self.calls = []
+
+    def make_executor(self, workers, threads):
+        return ThreadPoolExecutor(max_workers=workers)
+
+    def worker(self, image, parsed, model):
+        self.calls.append((image.file_hash, [word for _, word, _ in parsed]))
+        if image.file_hash in self.failing:
+            raise RuntimeError("inference failed")
+        content = {"maskRle": encode_mask(np.ones((6, 8)))}
+        return image.pk, [(idx, word, content) for idx, word, _ in parsed], 0.0
+
+
+class AutoAnnotateCommandTest(TestCase):
+    def setUp(self):
+        self.images = []
+        for name in ('first', 'second', 'third'):
+            buffer = BytesIO()
+            PILImage.new('RGB', (8, 6)).save(buffer, format='PNG')
+            self.images.append(Image.objects.create(
+                name=name,
+                file=SimpleUploadedFile(f"{name}.png", buffer.getvalue(), content_type="image/png"),
+                file_hash=hashlib.md5(name.encode()).hexdigest(),
+                width=8,
+                height=6
+            ))
+        self.dir = tempfile.mkdtemp()
+        self.prompts = os.path.join(self.dir, 'prompts.json')
+        with open(self.prompts, 'w') as f:
+            json.dump({'*': [
+                {'word': 'cat', 'bounding_box': [[0.1, 0.1, 0.5, 0.5]]},
+                {'word': 'dog', 'inclusion_points': [{'x': 0.5, 'y': 0.5}]}
+            ]}, f)
+        self.checkpoint = f"{self.prompts}.progress"
+
+    def tearDown(self):
+        for image in self.images:
+            image.file.delete(save=False)
+        shutil.rmtree(self.dir)
+
+    def run_command(self, command, *args):
+        call_command(command, '--all', '--prompts', self.prompts, '--model', '0', *args)
+        with open(self.checkpoint) as f:
+            return f.read().split()
+
+    def test_annotates_and_records_progress(self):
+        command = FakeAnnotateCommand()
+        done = self.run_command(command)
+
+        self.assertEqual(sorted(done), sorted(image.file_hash for image in self.images))
+        self.assertEqual(Mask.objects.count(), 6)
+        self.assertIn("Annotated 3 images with 6 masks", command.stdout.getvalue())
+        print("test_annotates_and_records_progress passed")
+
+    def test_resumes_from_checkpoint(self):
+        with open(self.checkpoint, 'w') as f:
+            f.write(f"{self.images[0].file_hash}\n")
+        command = FakeAnnotateCommand()
+        done = self.run_command(command)
+
+        self.assertEqual([file_hash for file_hash, _ in command.calls], [image.file_hash for image in self.images[1:]])
+        self.assertFalse(Mask.objects.filter(image=self.images[0]).exists())
+        self.assertEqual(sorted(done), sorted(image.file_hash for image in self.images))
+        self.assertIn("1 already done", command.stdout.getvalue())
+
+        # unless told to start again, which still skips the words now masked
+        command = FakeAnnotateCommand()
+        self.run_command(command, '--restart')
+        self.assertEqual(command.calls, [(self.images[0].file_hash, ['cat', 'dog'])])
+        print("test_resumes_from_checkpoint passed")
+
+    def test_existing_masks_skipped(self):
+        first, second, _ = self.images
+        mask = Mask.objects.create(image=first, word=Word.objects.create(word='cat', image=first), maskRle=encode_mask(np.zeros((6, 8))))
+        for word in ('cat', 'dog'):
+            Mask.objects.create(image=second, word=Word.objects.create(word=word, image=second), maskRle=encode_mask(np.zeros((6, 8))))
+        command = FakeAnnotateCommand()
+        done = self.run_command(command)
+
+        # only the missing words are segmented, and images with none are finished without a worker
+        self.assertEqual(dict(command.calls), {first.file_hash: ['dog'], self.images[2].file_hash: ['cat', 'dog']})
+        self.assertTrue(Mask.objects.filter(pk=mask.pk).exists())
+        self.assertIn(second.file_hash, done)
+        print("test_existing_masks_skipped passed")
+
+    def test_failed_image_retried(self):
+        failing = self.images[1]
+        command = FakeAnnotateCommand(failing={failing.file_hash})
+        done = self.run_command(command)
+
+        self.assertNotIn(failing.file_hash, done)
+        self.assertFalse(Mask.objects.filter(image=failing).exists())
+        self.assertIn("second: inference failed", command.stderr.getvalue())
+        self.assertIn("1 failed", command.stdout.getvalue())
+
+        # the next run only tries the failed image
+        command = FakeAnnotateCommand()
+        done = self.run_command(command)
+        self.assertEqual(command.calls, [(failing.file_hash, ['cat', 'dog'])])
+        self.assertIn(failing.file_hash, done)
+        print("test_failed_image_retried passed")
+
+    def test_default_workers(self):
+        parser = auto_annotate.Command().create_parser('manage.py', 'auto_annotate')
+        options = parser.parse_args(['--all', '--prompts', self.prompts])
+        self.assertEqual(options.workers, min(2, os.cpu_count() or 1))
+        print("test_default_workers passed")
+
+
+class AutoMaskTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        buffer = BytesIO()
+        PILImage.new('RGB', (16, 12), (10, 20, 30)).save(buffer, format='PNG')
+        self.image = Image.objects.create(
+            name='Test Image',
+            file=SimpleUploadedFile("auto_image.png", buffer.getvalue(), content_type="image/png"),
+            file_hash=hashlib.md5(b"auto").hexdigest(),
+            width=16,
+            height=12
+        )
+        # generated at half the image's size
+        self.candidate_mask = np.zeros((6, 8), dtype=np.uint8)
+        self.candidate_mask[1:4, 2:6] = 1
+        self.candidate = CandidateMask.objects.create(
+            image=self.image,
+            maskRle=encode_mask(self.candidate_mask),
+            bbox=[4, 2, 8, 6],
+            area=48,
+            predicted_iou=0.9,
+            stability_score=0.97,
+            point=[8, 4],
+            model=0
+        )
+
+    def tearDown(self):
+        self.image.file.delete(save=False)
+
+    def test_mask_nms(self):
+        masks = np.zeros((4, 20, 20), dtype=bool)
+        masks[0, 2:10, 2:10] = True
+        masks[1, 2:10, 2:11] = True  # near duplicate of 0
+        masks[2, 12:18, 12:18] = True
+        masks[3] = masks[0]
+        masks[3, 19, 19] = True  # duplicate with a stray pixel, so a much larger box
+        keep = mask_nms(masks, [0.8, 0.9, 0.7, 0.6], 0.7, max_side=20)
+        self.assertEqual(keep.tolist(), [1, 2])
+        self.assertEqual(mask_nms(np.zeros((0, 4, 4)), [], 0.7).tolist(), [])
+        print("test_mask_nms passed")
+
+    def test_batch_fits_memory(self):
+        self.assertEqual(adaptive_points_per_batch(64, 10, 10), 64)
+        with override_settings(SAM2_AUTO_MEMORY_FRACTION=0):
+            self.assertEqual(adaptive_points_per_batch(64, 1024, 1024), 1)
+        print("test_batch_fits_memory passed")
+
+    def test_scale_mask(self):
+        scaled = scale_mask(self.candidate_mask, 12, 16)
+        self.assertEqual(scaled.shape, (12, 16))
+        self.assertEqual(scaled.sum(), 48)
+        print("test_scale_mask passed")
+
+    def test_list(self):
+        response = self.client.get(reverse('SAM2mask-auto-image', args=[self.image.file_hash]))
+        candidate = response.data['candidates'][0]
+        self.assertEqual(candidate['mask'], coco_rle(encode_mask(self.candidate_mask)))
+        # the mask is at half size, while its box is in image pixels
+        self.assertEqual((candidate['mask_width'], candidate['mask_height']), (8, 6))
+        self.assertEqual(candidate['bbox'], [4, 2, 8, 6])
+        print("test_list passed")
+
+    def test_accept(self):
+        response = self.client.post(reverse('candidate-mask', args=[self.candidate.uuid]), {'word': 'box'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        mask = Mask.objects.get(uuid=response.data['mask']['uuid'])
+        self.assertEqual(mask.word.word, 'box')
+        expected = np.zeros((12, 16), dtype=np.uint8)
+        expected[2:8, 4:12] = 1
+        self.assertTrue(np.array_equal(decode_mask(bytes(mask.maskRle)), expected))
+        self.assertFalse(CandidateMask.objects.filter(pk=self.candidate.pk).exists())
+        print("test_accept passed")
+
+    def test_discard(self):
+        response = self.client.delete(reverse('candidate-mask', args=[self.candidate.uuid]))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(CandidateMask.objects.exists())
+        print("test_discard passed")
+
+    def test_invalid_options(self):
+        response = self.client.post(reverse('SAM2mask-auto'), {
+            'file_hash': self.image.file_hash,
+            'pred_iou_thresh': 2
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        print("test_invalid_options passed")
+
+
+class ContourSimplificationTest(TestCase):
+    def setUp(self):
+        # a wiggly circle, long enough to need simplifying
+        angles = np.linspace(0, 2 * np.pi, 2000)
+        radius = 200 + 15 * np.sin(angles * 40)
+        self.contour = np.stack([300 + radius * np.sin(angles), 300 + radius * np.cos(angles)], axis=1)
+
+    def test_matches_tolerance_retry_loop(self):
+        (simplified,), (tolerance,) = simplify_contours([self.contour], 100, 0.5)
+
+        # the smallest tolerance on the 0.5 grid that fits the budget
+        expected_tolerance = 0.5
+        expected = measure.approximate_polygon(self.contour, tolerance=expected_tolerance)
+        while len(expected) > 100 and expected_tolerance < 10:
+            expected_tolerance += 0.5
+            expected = measure.approximate_polygon(self.contour, tolerance=expected_tolerance)
+
+        self.assertEqual(tolerance, expected_tolerance)
+        self.assertTrue(np.array_equal(simplified, expected))
+        self.assertLessEqual(len(simplified), 100)
+        print("test_matches_tolerance_retry_loop passed")
+
+    def test_small_contours_unchanged(self):
+        small = self.contour[:50]
+        simplified, tolerances = simplify_contours([small, self.contour], 100, 0.5)
+
+        self.assertIs(simplified[0], small)
+        self.assertIsNone(tolerances[0])
+        self.assertIsNotNone(tolerances[1])
+        print("test_small_contours_unchanged passed")
+
+
+class CompactContoursTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.file_hash = hashlib.md5(b"contours").hexdigest()
+        self.image = Image.objects.create(name='Test Image', file_hash=self.file_hash)
+        # half pixel coordinates, as produced by find_contours
+        self.points = [
+            np.array([[0.5, 1.0], [10.5, 1.0], [10.5, 20.0], [0.5, 1.0]]),
+            np.array([[300.0, 400.5], [299.5, 401.0]])
+        ]
+        self.json_word = Word.objects.create(word='json', image=self.image)
+        Mask.objects.create(
+            image=self.image,
+            word=self.json_word,
+            maskImage=SimpleUploadedFile("json_mask.png", b"mask_content", content_type="image/png"),
+            contours={
+                "label": "json",
+                "contours": [{"contour_index": idx, "points": p.tolist()} for idx, p in enumerate(self.points)]
+            }
+        )
+        self.compact_word = Word.objects.create(word='compact', image=self.image)
+        Mask.objects.create(
+            image=self.image,
+            word=self.compact_word,
+            maskImage=SimpleUploadedFile("compact_mask.png", b"mask_content", content_type="image/png"),
+            contours_compact=encode_contours(self.points)
+        )
+
+    def test_round_trip(self):
+        decoded = decode_contours(encode_contours(self.points))
+        self.assertEqual(len(decoded), len(self.points))
+        for original, result in zip(self.points, decoded):
+            self.assertTrue(np.array_equal(original, result))
+        self.assertEqual(decode_contours(encode_contours([])), [])
+        print("test_round_trip passed")
+
+    def test_json_served_from_compact(self):
+        response = self.client.get(reverse('mask-get-contours', args=[self.file_hash, 'compact']))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()["label"], "compact")
+        self.assertEqual(response.json()["contours"][1]["points"], self.points[1].tolist())
+        print("test_json_served_from_compact passed")
+
+    def test_compact_stream(self):
+        response = self.client.get(
+            reverse('mask-get-all-contours', args=[self.file_hash]),
+            HTTP_ACCEPT='application/x-sam2-contours'
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/x-sam2-contours')
+        frames = dict(decode_frames(b''.join(response.streaming_content)))
+        self.assertEqual(set(frames), {'json', 'compact'})
+        for contours in frames.values():
+            self.assertTrue(all(np.array_equal(a, b) for a, b in zip(contours, self.points)))
+        print("test_compact_stream passed")
+
+    def test_compact_stream_not_found(self):
+        response = self.client.get(reverse('mask-get-contours', args=[self.file_hash, 'missing']) + '?format=contours')
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        print("test_compact_stream_not_found passed")
+
+
+class MaskRenderTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        buffer = BytesIO()
+        PILImage.new('RGB', (6, 4), (10, 20, 30)).save(buffer, format='PNG')
+        self.image = Image.objects.create(
+            name='Test Image',
+            file=SimpleUploadedFile("render_image.png", buffer.getvalue(), content_type="image/png"),
+            file_hash=hashlib.md5(b"render").hexdigest()
+        )
+        self.mask_array = np.zeros((4, 6), dtype=np.uint8)
+        self.mask_array[1:3, 2:5] = 1
+        self.mask = Mask.objects.create(
+            image=self.image,
+            word=Word.objects.create(word='box', image=self.image),
+            maskRle=encode_mask(self.mask_array)
+        )
+
+    def tearDown(self):
+        mask_render_cache.purge(str(self.mask.uuid))
+        self.image.file.delete(save=False)
+
+    def test_rle_round_trip(self):
+        self.assertTrue(np.array_equal(decode_mask(encode_mask(self.mask_array)), self.mask_array))
+        full = np.ones((3, 3), dtype=np.uint8)
+        self.assertTrue(np.array_equal(decode_mask(encode_mask(full)), full))
+        # column-major runs starting with 0s, as in COCO
+        self.assertEqual(coco_rle(encode_mask(self.mask_array)), {"size": [4, 6], "counts": [9, 2, 2, 2, 2, 2, 5]})
+        print("test_rle_round_trip passed")
+
+    def test_render_cutout(self):
+        url = reverse('render_mask', args=[self.mask.uuid])
+        for _ in range(2):  # rendered, then cached
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response['Content-Type'], 'image/png')
+            cutout = np.array(PILImage.open(BytesIO(b''.join(response.streaming_content))))
+            self.assertEqual(cutout.shape, (4, 6, 4))
+            self.assertTrue(np.array_equal(cutout[..., 3], self.mask_array * 255))
+            self.assertTrue(np.all(cutout[..., :3] == (10, 20, 30)))
+        self.assertIsNotNone(mask_render_cache.get(str(self.mask.uuid), cutout_name('png')))
+        print("test_render_cutout passed")
+
+    def test_cutout_removed_with_mask(self):
+        self.client.get(reverse('render_mask', args=[self.mask.uuid]))
+        self.mask.delete()
+        self.assertIsNone(mask_render_cache.get(str(self.mask.uuid), cutout_name('png')))
+        print("test_cutout_removed_with_mask passed")
+
+    @override_settings(SAM2_MASK_FORMAT='webp')
+    def test_render_webp(self):
+        response = self.client.get(reverse('render_mask', args=[self.mask.uuid]))
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        cutout = np.array(PILImage.open(BytesIO(b''.join(response.streaming_content))))
+        self.assertTrue(np.array_equal(cutout[..., 3], self.mask_array * 255))
+        print("test_render_webp passed")
+
+    @override_settings(SAM2_MASK_FORMAT='png1')
+    def test_render_1_bit(self):
+        response = self.client.get(reverse('render_mask', args=[self.mask.uuid]))
+        rendered = PILImage.open(BytesIO(b''.join(response.streaming_content)))
+        self.assertEqual(rendered.mode, '1')
+        self.assertTrue(np.array_equal(np.array(rendered), self.mask_array.astype(bool)))
+        print("test_render_1_bit passed")
+
+    @override_settings(SAM2_MASK_STORAGE='png')
+    def test_deferred_encoding(self):
+        Mask.objects.filter(pk=self.mask.pk).update(encoding_status=Mask.ENCODING_PENDING)
+        img_arr = np.array(PILImage.open(self.image.file.path).convert('RGB'))
+
+        mask_encoder.encode(self.mask.pk, img_arr, self.mask_array)
+
+        self.mask.refresh_from_db()
+        self.assertEqual(self.mask.encoding_status, Mask.ENCODING_READY)
+        self.assertIsNone(self.mask.maskRle)
+        self.assertTrue(os.path.isfile(self.mask.maskImage.path))
+        self.assertTrue(np.array_equal(np.array(PILImage.open(self.mask.maskImage.path))[..., 3], self.mask_array * 255))
+        self.mask.delete()
+        print("test_deferred_encoding passed")
+
+    def test_serialized_url(self):
+        response = self.client.get(reverse('mask-by-image', args=[self.image.file_hash]))
+        self.assertTrue(response.json()[0]["maskImage"].endswith(reverse('render_mask', args=[self.mask.uuid])))
+        print("test_serialized_url passed")
+
+
+class DecodedImageCacheTest(TestCase):
+    def setUp(self):
+        buffer = BytesIO()
+        PILImage.new('RGB', (6, 4), (1, 2, 3)).save(buffer, format='PNG')
+        self.image = Image.objects.create(
+            name='Test Image',
+            file=SimpleUploadedFile("cached_image.png", buffer.getvalue(), content_type="image/png"),
+            file_hash=hashlib.md5(b"cached").hexdigest()
+        )
+
+    def tearDown(self):
+        decoded_image_cache.pop(self.image.file_hash)
+
+    def test_decoded_once(self):
+        first = load_image_rgb(self.image)
+        self.assertEqual(first.shape, (4, 6, 3))
+        # later loads come from the cache, without the file
+        self.image.file.delete(save=False)
+        self.assertIs(load_image_rgb(self.image), first)
+        print("test_decoded_once passed")
+
+    def test_size_filled_in_for_old_images(self):
+        self.assertIsNone(self.image.width)
+        self.assertEqual(self.image.get_size(), (6, 4))
+        self.assertEqual(Image.objects.get(pk=self.image.pk).mode, 'RGB')
+        self.image.file.delete(save=False)
+        print("test_size_filled_in_for_old_images passed")
+
+
+class InferenceImageTest(TestCase):
+    def setUp(self):
+        buffer = BytesIO()
+        PILImage.new('RGB', (300, 120), (1, 2, 3)).save(buffer, format='JPEG')
+        self.image = Image.objects.create(
+            name='Test Image',
+            file=SimpleUploadedFile("inference_image.jpg", buffer.getvalue(), content_type="image/jpeg"),
+            file_hash=hashlib.md5(b"inference").hexdigest()
+        )
+
+    def tearDown(self):
+        inference_image_store.purge(self.image.file_hash)
+        self.image.file.delete(save=False)
+
+    @override_settings(SAM2_INFERENCE_SIZE=100)
+    def test_downsized_once(self):
+        arr = load_inference_image(self.image)
+        self.assertEqual(arr.shape, (40, 100, 3))
+        self.assertIsNotNone(inference_image_store.get(self.image.file_hash, '100.npy'))
+        # later loads come from the caches, without the file
+        self.image.file.delete(save=False)
+        self.assertIs(load_inference_image(self.image), arr)
+        print("test_downsized_once passed")
+
+    def test_small_images_not_enlarged(self):
+        self.assertEqual(load_inference_image(self.image).shape, (120, 300, 3))
+        print("test_small_images_not_enlarged passed")
+
+    def test_deleted_with_image(self):
+        load_inference_image(self.image)
+        APIClient().delete(reverse('delete_image', args=[self.image.file_hash]))
+        self.assertIsNone(inference_image_store.get(self.image.file_hash, '1024.npy'))
+        print("test_deleted_with_image passed")
+
+
+class ListImagesViewTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.url = reverse('list_images')
+        for idx in range(5):
+            image = Image.objects.create(name=f'Image {idx}', file_hash=hashlib.md5(str(idx).encode()).hexdigest())
+            for word_text in ('cat', 'dog'):
+                word = Word.objects.create(word=word_text, image=image)
+                Mask.objects.create(
+                    image=image,
+                    word=word,
+                    maskRle=encode_mask(np.ones((2, 2))),
+                    contours_compact=encode_contours([np.array([[0.5, 0.5], [1.5, 0.5]])])
+                )
+
+    def test_queries_do_not_grow_with_images(self):
+        # the list's ETag, images, their masks, their words and the words' masks
+        with self.assertNumQueries(5):
+            response = self.client.get(self.url)
+
+        self.assertEqual(len(response.data), 5)
+        self.assertEqual(len(response.data[0]['word_masks'][0]['associated_masks']), 1)
+        self.assertEqual(response.data[0]['masks'][0]['contours']['label'], 'cat')
+        print("test_queries_do_not_grow_with_images passed")
+
+    def test_slim_listing(self):
+        # the list's ETag and the images with their counts
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url, {'view': 'slim'})
+
+        self.assertEqual(len(response.data), 5)
+        self.assertEqual(
+            set(response.data[0]),
+            {'id', 'name', 'file', 'file_hash', 'thumbnail', 'word_count', 'mask_count'}
+        )
+        self.assertEqual((response.data[0]['word_count'], response.data[0]['mask_count']), (2, 2))
+        print("test_slim_listing passed")
+
+    def test_cursor_pagination(self):
+        names = []
+        response = self.client.get(self.url, {'view': 'slim', 'page_size': 2})
+        while True:
+            self.assertLessEqual(len(response.data['results']), 2)
+            names += [image['name'] for image in response.data['results']]
+            if not response.data['next']:
+                break
+            response = self.client.get(response.data['next'])
+
+        self.assertEqual(names, [f'Image {idx}' for idx in range(5)])
+        print("test_cursor_pagination passed")
+
+    def test_field_selection(self):
+        # nested masks are not fetched unless asked for
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url, {'fields': 'id,name'})
+        self.assertEqual(set(response.data[0]), {'id', 'name'})
+
+        response = self.client.get(self.url, {'fields': 'id,nonsense'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        print("test_field_selection passed")
+
+    def test_masks_paginated(self):
+        response = self.client.get(reverse('mask-list'), {'page_size': 3, 'fields': 'uuid,word'})
+
+        self.assertEqual(len(response.data['results']), 3)
+        self.assertEqual(set(response.data['results'][0]), {'uuid', 'word'})
+        self.assertIsNotNone(response.data['next'])
+        print("test_masks_paginated passed")
+
+
+class ConditionalGetTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.image = Image.objects.create(name='Test Image', file_hash=hashlib.md5(b"etag").hexdigest())
+        self.word = Word.objects.create(word='cat', image=self.image)
+        self.mask = Mask.objects.create(
+            image=self.image,
+            word=self.word,
+            maskRle=encode_mask(np.ones((2, 2))),
+            contours_compact=encode_contours([np.array([[0.5, 0.5], [1.5, 0.5]])])
+        )
+        self.contours_url = reverse('mask-get-all-contours', args=[self.image.file_hash])
+
+    def revalidate(self, url, response, **extra):
+        return self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'], **extra)
+
+    def test_unchanged_contours_not_modified(self):
+        response = self.client.get(self.contours_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('Last-Modified', response)
+
+        response = self.revalidate(self.contours_url, response)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.content, b'')
+        print("test_unchanged_contours_not_modified passed")
+
+    def test_mask_and_word_changes_invalidate(self):
+        first = self.client.get(self.contours_url)
+
+        self.word.word = 'dog'
+        self.word.save()
+        second = self.revalidate(self.contours_url, first)
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+
+        self.mask.delete()
+        third = self.revalidate(self.contours_url, second)
+        self.assertEqual(third.status_code, status.HTTP_200_OK)
+        self.assertEqual(third.json(), {'contours': {}})
+        print("test_mask_and_word_changes_invalidate passed")
+
+    def test_format_changes_etag(self):
+        response = self.client.get(self.contours_url)
+        compact = self.revalidate(self.contours_url, response, HTTP_ACCEPT='application/x-sam2-contours')
+        self.assertEqual(compact.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(compact['ETag'], response['ETag'])
+        print("test_format_changes_etag passed")
+
+    def test_image_edit_changes_etag(self):
+        url = reverse('mask-by-image', args=[self.image.file_hash])
+        response = self.client.get(url)
+        # the word and mask created in setUp bumped it in the database
+        self.image.refresh_from_db()
+        version = self.image.version
+
+        self.image.name = 'Renamed Image'
+        self.image.save()
+        self.assertEqual(self.image.version, version + 1)
+        changed = self.revalidate(url, response)
+        self.assertEqual(changed.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(changed['ETag'], response['ETag'])
+
+        # as it does when only some fields are saved
+        self.image.name = 'Test Image'
+        self.image.save(update_fields=['name'])
+        self.assertEqual(self.revalidate(url, changed).status_code, status.HTTP_200_OK)
+        print("test_image_edit_changes_etag passed")
+
+    def test_image_list(self):
+        url = reverse('list_images')
+        response = self.client.get(url)
+        self.assertEqual(self.revalidate(url, response).status_code, status.HTTP_304_NOT_MODIFIED)
+
+        Image.bump_version(self.image.pk, embedding_status=Image.EMBEDDING_READY)
+        changed = self.revalidate(url, response)
+        self.assertEqual(changed.status_code, status.HTTP_200_OK)
+
+        Image.objects.create(name='Another Image', file_hash=hashlib.md5(b"etag2").hexdigest())
+        self.assertEqual(self.revalidate(url, changed).status_code, status.HTTP_200_OK)
+        print("test_image_list passed")
+
+
+class TileTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        # a gradient, so tiles from different places differ
+        self.pixels = np.zeros((300, 520, 3), dtype=np.uint8)
+        self.pixels[..., 0] = np.arange(520) % 256
+        self.pixels[..., 1] = (np.arange(300) % 256)[:, None]
+        buffer = BytesIO()
+        PILImage.fromarray(self.pixels).save(buffer, format='PNG')
+        self.image = Image.objects.create(
+            name='Large Image',
+            file=SimpleUploadedFile("tiled_image.png", buffer.getvalue(), content_type="image/png"),
+            file_hash=hashlib.md5(b"tiles").hexdigest()
+        )
+        self.mask_array = np.zeros((300, 520), dtype=np.uint8)
+        self.mask_array[11:290, 260:400] = 1
+        self.mask = Mask.objects.create(
+            image=self.image,
+            word=Word.objects.create(word='box', image=self.image),
+            maskRle=encode_mask(self.mask_array)
+        )
+        # lossless tiles, to compare pixels
+        tile_pyramid.tile_format = 'png'
+
+    def tearDown(self):
+        tile_pyramid.tile_format = 'jpeg'
+        tile_pyramid.purge(self.image.file_hash)
+        mask_render_cache.purge(str(self.mask.uuid))
+        self.image.file.delete(save=False)
+
+    def get_tile(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('max-age', response['Cache-Control'])
+        return np.array(PILImage.open(BytesIO(response.content)))
+
+    def test_info(self):
+        response = self.client.get(reverse('image_tiles', args=[self.image.file_hash]))
+        levels = response.json()['levels']
+        self.assertEqual([(level['width'], level['height']) for level in levels], [(520, 300), (260, 150), (130, 75)])
+        self.assertEqual((levels[0]['columns'], levels[0]['rows']), (3, 2))
+        self.assertIn('{level}/{col}/{row}', response.json()['tile_url'])
+        print("test_info passed")
+
+    def test_tiles(self):
+        # full size tile, the partial tile on the corner and the downsized level
+        tile = self.get_tile(reverse('image_tile', args=[self.image.file_hash, 0, 1, 0]))
+        self.assertTrue(np.array_equal(tile, self.pixels[:256, 256:512]))
+        corner = self.get_tile(reverse('image_tile', args=[self.image.file_hash, 0, 2, 1]))
+        self.assertTrue(np.array_equal(corner, self.pixels[256:, 512:]))
+        top = self.get_tile(reverse('image_tile', args=[self.image.file_hash, 1, 0, 0]))
+        self.assertEqual(top.shape, (150, 256, 3))
+
+        response = self.client.get(reverse('image_tile', args=[self.image.file_hash, 0, 3, 0]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get(reverse('image_tile', args=[self.image.file_hash, 3, 0, 0]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        print("test_tiles passed")
+
+    def test_mask_tiles(self):
+        tile = self.get_tile(reverse('mask_tile', args=[self.image.file_hash, self.mask.uuid, 0, 1, 0]))
+        self.assertEqual(tile.shape, (256, 256, 4))
+        self.assertTrue(np.array_equal(tile[..., 3], self.mask_array[:256, 256:512] * 255))
+        self.assertTrue(np.array_equal(tile[..., :3], self.pixels[:256, 256:512]))
+
+        # 2x2 blocks averaged at the next level, so the half covered top edge is half opaque
+        top = self.get_tile(reverse('mask_tile', args=[self.image.file_hash, self.mask.uuid, 1, 0, 0]))
+        self.assertEqual(top.shape, (150, 256, 4))
+        self.assertEqual(top[5, 130, 3], 128)
+        self.assertEqual(top[6, 130, 3], 255)
+        self.assertEqual(top[5, 129, 3], 0)
+        self.assertEqual(top[144, 150, 3], 255)
+        self.assertEqual(top[145, 150, 3], 0)
+        print("test_mask_tiles passed")
+
+    def test_thumbnail(self):
+        # stores the size, as read_image_metadata does on upload
+        self.image.get_size()
+        response = self.client.get(reverse('list_images'), {'view': 'slim'})
+        url = response.data[0]['thumbnail']
+        self.assertTrue(url.endswith(reverse('image_thumbnail', args=[self.image.file_hash])))
+        thumbnail = self.get_tile(url)
+        self.assertEqual(thumbnail.shape, (148, 256, 3))
+        print("test_thumbnail passed")
+
+    def test_undecodable_thumbnail(self):
+        svg = b'<svg xmlns="http://www.w3.org/2000/svg" width="4" height="4"/>'
+        image = Image.objects.create(
+            name='Vector Image',
+            file=SimpleUploadedFile("vector_image.svg", svg, content_type="image/svg+xml"),
+            file_hash=hashlib.md5(svg).hexdigest()
+        )
+        self.addCleanup(image.file.delete, save=False)
+
+        # no size could be read, so clients fall back to the original file
+        response = self.client.get(reverse('list_images'), {'view': 'slim'})
+        self.assertIsNone(next(item for item in response.data if item['file_hash'] == image.file_hash)['thumbnail'])
+        response = self.client.get(reverse('image_thumbnail', args=[image.file_hash]))
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertEqual(response['Location'], image.file.url)
+        print("test_undecodable_thumbnail passed")
+
+    def test_exif_orientation(self):
+        # stored on its side, with the EXIF tag saying to turn it 90 degrees clockwise
+        exif = PILImage.Exif()
+        exif[0x0112] = 6
+        buffer = BytesIO()
+        PILImage.fromarray(self.pixels).save(buffer, format='PNG', exif=exif)
+        image = Image.objects.create(
+            name='Rotated Image',
+            file=SimpleUploadedFile("rotated_image.png", buffer.getvalue(), content_type="image/png"),
+            file_hash=hashlib.md5(b"rotated tiles").hexdigest()
+        )
+        mask = Mask.objects.create(
+            image=image,
+            word=Word.objects.create(word='box', image=image),
+            maskRle=encode_mask(self.mask_array)
+        )
+        self.addCleanup(image.file.delete, save=False)
+        self.addCleanup(tile_pyramid.purge, image.file_hash)
+        self.addCleanup(mask_render_cache.purge, str(mask.uuid))
+        rotated = np.rot90(self.pixels, -1)
+        rotated_mask = np.rot90(self.mask_array, -1)
+
+        levels = self.client.get(reverse('image_tiles', args=[image.file_hash])).json()['levels']
+        self.assertEqual((levels[0]['width'], levels[0]['height']), (300, 520))
+        tile = self.get_tile(reverse('image_tile', args=[image.file_hash, 0, 1, 1]))
+        self.assertTrue(np.array_equal(tile, rotated[256:512, 256:]))
+        mask_tile = self.get_tile(reverse('mask_tile', args=[image.file_hash, mask.uuid, 0, 1, 1]))
+        self.assertTrue(np.array_equal(mask_tile[..., 3], rotated_mask[256:512, 256:] * 255))
+        thumbnail = self.get_tile(reverse('image_thumbnail', args=[image.file_hash]))
+        self.assertEqual(thumbnail.shape, (256, 148, 3))
+        print("test_exif_orientation passed")
+
+    def test_built_as_encoded_tiles(self):
+        self.get_tile(reverse('image_tile', args=[self.image.file_hash, 1, 0, 0]))
+        # every tile of every level, and no decoded pixels
+        names = sorted(os.listdir(os.path.join(tile_pyramid.store.root, self.image.file_hash)))
+        self.assertEqual(names, sorted(
+            ['pyramid.png.done', 'tile-1-0-0.png', 'tile-1-1-0.png', 'tile-2-0-0.png']
+            + [f'tile-0-{col}-{row}.png' for col in range(3) for row in range(2)]
+        ))
+
+        # an evicted tile is built again
+        os.remove(tile_pyramid.store.path(self.image.file_hash, 'tile-0-1-0.png'))
+        tile = self.get_tile(reverse('image_tile', args=[self.image.file_hash, 0, 1, 0]))
+        self.assertTrue(np.array_equal(tile, self.pixels[:256, 256:512]))
+        print("test_built_as_encoded_tiles passed")
+
+    def test_without_store(self):
+        # tiles are rendered from the image file when they cannot be stored
+        store = tile_pyramid.store
+        tile_pyramid.store = DiskCache(tempfile.mkdtemp(), max_bytes=0)
+        try:
+            tile = self.get_tile(reverse('image_tile', args=[self.image.file_hash, 0, 2, 1]))
+            top = self.get_tile(reverse('mask_tile', args=[self.image.file_hash, self.mask.uuid, 1, 0, 0]))
+        finally:
+            shutil.rmtree(tile_pyramid.store.root)
+            tile_pyramid.store = store
+        self.assertTrue(np.array_equal(tile, self.pixels[256:, 512:]))
+        self.assertEqual(top[6, 130, 3], 255)
+        print("test_without_store passed")
+
+    def test_deleted_with_image(self):
+        self.get_tile(reverse('image_tile', args=[self.image.file_hash, 0, 0, 0]))
+        self.assertIsNotNone(tile_pyramid.store.get(self.image.file_hash, 'tile-0-0-0.png'))
+        self.client.delete(reverse('delete_image', args=[self.image.file_hash]))
+        self.assertIsNone(tile_pyramid.store.get(self.image.file_hash, 'tile-0-0-0.png'))
+        print("test_deleted_with_image passed")
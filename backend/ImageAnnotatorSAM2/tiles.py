@@ -0,0 +1,274 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+from django.conf import settings
+from django.db import close_old_connections
+from PIL import Image as PILImage, ImageOps
+
+from .disk_cache import DiskCache
+from .mask_codec import decode_mask, decode_mask_columns
+from .mask_render import mask_render_cache
+
+
+# Tile formats, chosen with SAM2_TILE_FORMAT: (file extension, content type)
+TILE_FORMATS = {
+    'jpeg': ('jpg', 'image/jpeg'),
+    'webp': ('webp', 'image/webp'),
+    'png': ('png', 'image/png'),
+}
+
+
+# EXIF orientations applied to an array the way ImageOps.exif_transpose applies
+# them to an image, for masks, which are stored unrotated like the file's pixels
+ORIENTATIONS = {
+    2: lambda a: a[:, ::-1],
+    3: lambda a: a[::-1, ::-1],
+    4: lambda a: a[::-1],
+    5: lambda a: a.swapaxes(0, 1),
+    6: lambda a: np.rot90(a, -1),
+    7: lambda a: a[::-1, ::-1].swapaxes(0, 1),
+    8: lambda a: np.rot90(a, 1),
+}
+
+
+def oriented_size(image):
+    # (width, height) of the image as displayed, with its EXIF orientation applied
+    width, height = image.get_size()
+    if image.orientation in (5, 6, 7, 8):
+        return height, width
+    return width, height
+
+
+def level_sizes(width, height, tile_size):
+    # (width, height) of each pyramid level: level 0 is the full image and each
+    # level after it is half the size (rounded up) until one tile covers it
+    sizes = [(width, height)]
+    while max(sizes[-1]) > tile_size:
+        w, h = sizes[-1]
+        sizes.append(((w + 1) // 2, (h + 1) // 2))
+    return sizes
+
+
+# Multi-resolution pyramid of an image, for viewing images too large to load
+# whole. Every tile of every level is encoded once and stored under
+# <root>/<file_hash>/, so serving a tile is reading a file; the image is only
+# decoded to build the pyramid, the first time a tile is requested or in the
+# background after upload with SAM2_TILES_ON_UPLOAD.
+# Mask tiles use the same grid: the image's tile with the mask as alpha, cut
+# from the run-length encoded mask and cached with the mask's rendered cutouts.
+class TilePyramid:
+    # builds of different images run in parallel unless their hashes share a lock
+    LOCK_STRIPES = 64
+
+    def __init__(self, store, tile_size, tile_format, thumbnail_size):
+        self.store = store
+        self.tile_size = tile_size
+        self.tile_format = tile_format
+        self.thumbnail_size = thumbnail_size
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='tile-pyramid')
+        self._locks = [threading.Lock() for _ in range(self.LOCK_STRIPES)]
+
+    @property
+    def content_type(self):
+        return TILE_FORMATS[self.tile_format][1]
+
+    def levels(self, image):
+        return level_sizes(*oriented_size(image), self.tile_size)
+
+    def grid(self, image, level):
+        # (columns, rows) of tiles at a level
+        width, height = self.levels(image)[level]
+        return -(-width // self.tile_size), -(-height // self.tile_size)
+
+    def has_tile(self, image, level, col, row):
+        if not 0 <= level < len(self.levels(image)):
+            return False
+        columns, rows = self.grid(image, level)
+        return 0 <= col < columns and 0 <= row < rows
+
+    def info(self, image):
+        levels = []
+        for level, (width, height) in enumerate(self.levels(image)):
+            columns, rows = self.grid(image, level)
+            levels.append({"level": level, "width": width, "height": height, "columns": columns, "rows": rows})
+        return {
+            "width": levels[0]["width"],
+            "height": levels[0]["height"],
+            "tile_size": self.tile_size,
+            "content_type": self.content_type,
+            "levels": levels
+        }
+
+    def tile(self, image, level, col, row):
+        # encoded tile of the image
+        name = self._tile_name(level, col, row)
+        data = self._read(self.store, image.file_hash, name)
+        if data is None and self.store.enabled:
+            self.build(image, missing=name)
+            data = self._read(self.store, image.file_hash, name)
+        if data is None:
+            # the store is disabled, or evicted the tile as soon as it was built
+            data = self._encode(self._render_tile(image, level, col, row), self.tile_format)
+        return data
+
+    def mask_tile(self, mask, level, col, row):
+        # PNG tile of the mask's cutout, with the mask as alpha over the pixels
+        # of the image's tile, as shown beneath it
+        def render():
+            with PILImage.open(BytesIO(self.tile(mask.image, level, col, row))) as img:
+                pixels = np.asarray(img.convert('RGB'))
+            alpha = self._mask_alpha(mask, level, col, row)
+            return self._encode(np.dstack((pixels, alpha)), 'png')
+        return self._cached(mask_render_cache, str(mask.uuid), f"tile-{level}-{col}-{row}.png", render)
+
+    def thumbnail(self, image):
+        def render():
+            with image.file.open('rb') as f:
+                img = PILImage.open(f)
+                # lets JPEGs decode straight at a fraction of their size
+                img.draft('RGB', (self.thumbnail_size, self.thumbnail_size))
+                img = ImageOps.exif_transpose(img).convert('RGB')
+            img.thumbnail((self.thumbnail_size, self.thumbnail_size))
+            return self._encode(np.asarray(img), self.tile_format)
+        return self._cached(self.store, image.file_hash, f"thumbnail.{TILE_FORMATS[self.tile_format][0]}", render)
+
+    def submit(self, image):
+        # builds the pyramid and thumbnail in the background
+        self._executor.submit(self._prebuild, image)
+
+    def purge(self, file_hash):
+        self.store.purge(file_hash)
+
+    def build(self, image, missing=None):
+        """Encode every tile of the image's pyramid into the store, unless a
+        previous build finished (or, given the name of a `missing` tile, unless
+        that tile is there now)."""
+        if not self.store.enabled:
+            return
+        marker = f"pyramid.{TILE_FORMATS[self.tile_format][0]}.done"
+        with self._lock_for(image.file_hash):
+            if self.store.get(image.file_hash, missing or marker):
+                return
+            levels = self.levels(image)
+            img = self._open(image)
+            for level in range(len(levels)):
+                pixels = np.asarray(img)
+                columns, rows = self.grid(image, level)
+                for row in range(rows):
+                    for col in range(columns):
+                        top, bottom, left, right = self._tile_bounds(level, col, row)
+                        data = self._encode(pixels[top:bottom, left:right], self.tile_format)
+                        self._write(self.store, image.file_hash, self._tile_name(level, col, row), data, enforce_limit=False)
+                if level + 1 < len(levels):
+                    # 2x2 box filter, so each level averages the one above it
+                    img = img.reduce(2)
+            self._write(self.store, image.file_hash, marker, b'', enforce_limit=False)
+        # once per pyramid rather than once per tile
+        self.store.enforce_limit()
+
+    def _prebuild(self, image):
+        try:
+            self.build(image)
+            self.thumbnail(image)
+        except Exception as e:
+            print(f"Error building tiles for image {image.file_hash}: {e}")
+        finally:
+            close_old_connections()
+
+    def _tile_name(self, level, col, row):
+        return f"tile-{level}-{col}-{row}.{TILE_FORMATS[self.tile_format][0]}"
+
+    def _tile_bounds(self, level, col, row):
+        # (top, bottom, left, right) of a tile in level pixels
+        size = self.tile_size
+        return row * size, (row + 1) * size, col * size, (col + 1) * size
+
+    def _open(self, image):
+        # the image's pixels as displayed, with its EXIF orientation applied
+        with image.file.open('rb') as f:
+            return ImageOps.exif_transpose(PILImage.open(f)).convert('RGB')
+
+    def _render_tile(self, image, level, col, row):
+        # one tile straight from the image file, reduced as build() reduces it
+        img = self._open(image)
+        for _ in range(level):
+            img = img.reduce(2)
+        top, bottom, left, right = self._tile_bounds(level, col, row)
+        return np.asarray(img)[top:bottom, left:right]
+
+    def _mask_alpha(self, mask, level, col, row):
+        # averages each 2^level x 2^level block of the full size mask, matching
+        # the repeated 2x2 reductions of the image
+        width, height = oriented_size(mask.image)
+        scale = 2 ** level
+        top, bottom, left, right = (bound * scale for bound in self._tile_bounds(level, col, row))
+        bottom, right = min(bottom, height), min(right, width)
+        orient = ORIENTATIONS.get(mask.image.orientation)
+        if orient is None:
+            region = decode_mask_columns(bytes(mask.maskRle), left, right)[top:bottom]
+        else:
+            # the tile's columns are not the stored mask's, so orient all of it
+            region = orient(decode_mask(bytes(mask.maskRle)))[top:bottom, left:right]
+
+        rows, cols = -(-region.shape[0] // scale), -(-region.shape[1] // scale)
+        padded = np.zeros((rows * scale, cols * scale), dtype=np.float32)
+        padded[:region.shape[0], :region.shape[1]] = region
+        sums = padded.reshape(rows, scale, cols, scale).sum(axis=(1, 3))
+        # blocks on the bottom and right edges can be partial
+        row_counts = np.minimum(scale, region.shape[0] - np.arange(rows) * scale)
+        col_counts = np.minimum(scale, region.shape[1] - np.arange(cols) * scale)
+        return np.rint(sums / np.outer(row_counts, col_counts) * 255).astype(np.uint8)
+
+    def _encode(self, pixels, fmt):
+        buffer = BytesIO()
+        img = PILImage.fromarray(pixels)
+        if fmt == 'jpeg':
+            img.save(buffer, format='JPEG', quality=85)
+        elif fmt == 'webp':
+            img.save(buffer, format='WEBP', quality=85)
+        else:
+            img.save(buffer, format='PNG', compress_level=1)
+        return buffer.getvalue()
+
+    def _cached(self, cache, key, name, render):
+        data = self._read(cache, key, name)
+        if data is None:
+            data = render()
+            if cache.enabled:
+                self._write(cache, key, name, data)
+        return data
+
+    def _read(self, cache, key, name):
+        path = cache.get(key, name)
+        if path:
+            try:
+                with open(path, 'rb') as f:
+                    return f.read()
+            except OSError:
+                # evicted in the meantime
+                pass
+        return None
+
+    def _write(self, cache, key, name, data, enforce_limit=True):
+        def write(tmp_path):
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+        cache.put(key, name, write, enforce_limit=enforce_limit)
+
+    def _lock_for(self, file_hash):
+        # a fixed set of locks, so one is not kept for every image ever tiled
+        return self._locks[hash(file_hash) % len(self._locks)]
+
+
+tile_pyramid = TilePyramid(
+    store=DiskCache(
+        os.path.join(settings.MEDIA_ROOT, 'tiles'),
+        getattr(settings, 'SAM2_TILE_STORE_BYTES', 20 * 1024 * 1024 * 1024)
+    ),
+    tile_size=getattr(settings, 'SAM2_TILE_SIZE', 256),
+    tile_format=getattr(settings, 'SAM2_TILE_FORMAT', 'jpeg'),
+    thumbnail_size=getattr(settings, 'SAM2_THUMBNAIL_SIZE', 256)
+)
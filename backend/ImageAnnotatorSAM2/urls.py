@@ -1,7 +1,8 @@
 # urls.py
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import (UploadImageView, ListImagesView,CsrfTokenView,DeleteImageView, SelectImageView, WordView,SAM2maskView, MaskViewSet,DeleteMaskView)
+from .views import (UploadImageView, ListImagesView,CsrfTokenView,DeleteImageView, SelectImageView, WordView,SAM2maskView, SAM2maskAsyncView, SAM2BulkView, SAM2RefineView, MultimaskChoiceView, AutoMaskView, CandidateMaskView, SAM2ModelsView, MaskViewSet,DeleteMaskView, RenderMaskView,
+                    TileInfoView, ImageTileView, MaskTileView, ThumbnailView)
 
 router = DefaultRouter()
 router.register(r'masks', MaskViewSet, basename='mask')
@@ -15,6 +16,11 @@ urlpatterns = [
     path('images/', ListImagesView.as_view(), name='list_images'),
     path('delete/<str:file_hash>/', DeleteImageView.as_view(), name='delete_image'),
     path('select-image/', SelectImageView.as_view(), name='select_image'),
+    path('thumbnail/<str:file_hash>/', ThumbnailView.as_view(), name='image_thumbnail'),
+    path('tiles/<str:file_hash>/', TileInfoView.as_view(), name='image_tiles'),
+    path('tiles/<str:file_hash>/<int:level>/<int:col>/<int:row>/', ImageTileView.as_view(), name='image_tile'),
+    path('tiles/<str:file_hash>/masks/<uuid:mask_uuid>/<int:level>/<int:col>/<int:row>/',
+         MaskTileView.as_view(), name='mask_tile'),
 
     #Words
     path('word/', WordView.as_view(), name='upload word'),
@@ -22,7 +28,17 @@ urlpatterns = [
 
     #Masks
     path('sam2/', SAM2maskView.as_view(), name='SAM2mask'),
+    path('sam2/async/', SAM2maskAsyncView.as_view(), name='SAM2mask-async'),
+    path('sam2/bulk/', SAM2BulkView.as_view(), name='SAM2mask-bulk'),
+    path('sam2/multimask/<uuid:candidates_id>/', MultimaskChoiceView.as_view(), name='SAM2mask-multimask'),
+    path('sam2/refine/', SAM2RefineView.as_view(), name='SAM2mask-refine'),
+    path('sam2/refine/<str:file_hash>/<str:word>/', SAM2RefineView.as_view(), name='SAM2mask-refine-session'),
+    path('sam2/auto/', AutoMaskView.as_view(), name='SAM2mask-auto'),
+    path('sam2/auto/<str:file_hash>/', AutoMaskView.as_view(), name='SAM2mask-auto-image'),
+    path('sam2/candidates/<uuid:candidate_uuid>/', CandidateMaskView.as_view(), name='candidate-mask'),
+    path('sam2/models/', SAM2ModelsView.as_view(), name='SAM2models'),
     path('api/', include(router.urls)),
     path('delete-mask/', DeleteMaskView.as_view(), name='delete-mask'),
+    path('masks/<uuid:mask_uuid>/render/', RenderMaskView.as_view(), name='render_mask'),
 
 ]
\ No newline at end of file
@@ -1,7 +1,5 @@
 # views.py
 import datetime
-from io import BytesIO
-import uuid
 from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework.response import Response
 from rest_framework.views import APIView
@@ -9,26 +7,50 @@ from rest_framework.generics import ListAPIView, DestroyAPIView
 from rest_framework import status, generics, viewsets
 from rest_framework.decorators import action
 from rest_framework.exceptions import ValidationError
-from django.core.files.base import ContentFile
-from .models import Image, Word, Mask
-from .serializers import ImageSerializer, WordSerializer, ImageFileSerialiser, MaskSerializer
+from rest_framework.settings import api_settings
+from django.core.files.base import File
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Max, Prefetch, Sum
+from .models import Image, Word, Mask, CandidateMask
+from .serializers import ImageSerializer, ImageSummarySerializer, WordSerializer, ImageFileSerialiser, MaskSerializer, CandidateMaskSerializer
 import os
 import hashlib
-from django.http import JsonResponse
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
 from django.shortcuts import get_object_or_404
+from django.urls import reverse
 from django.http import Http404, HttpResponseNotFound
 from django.views import View
-from django.http import FileResponse
+from django.http import FileResponse, StreamingHttpResponse
 from django.contrib.sessions.models import Session
 from django.contrib import admin
 from rest_framework.permissions import AllowAny
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
 import re
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import json
-from PIL import Image as PILImage
-from .SAM2Implimentation import AutoSegmentTool
-from skimage import measure  # Added for contour generation
+from django.db import close_old_connections
+from django.utils.decorators import method_decorator
+from .SAM2Implimentation import AutoSegmentTool, interactive_gate, model_registry, purge_embeddings
+from .precompute import embedding_precomputer
+from django.conf import settings
+from .contours import find_contours, simplify_contours
+from .contour_codec import CONTENT_TYPE as CONTOURS_CONTENT_TYPE, encode_contours, encode_frame
+from .renderers import ContourRenderer
+from .pagination import IdCursorPagination, OptionalCursorPagination
+from .mask_codec import coco_rle, decode_mask, encode_mask
+from .mask_render import content_type, cutout_file, mask_format, mask_image_file
+from .mask_encoder import mask_encoder
+from .image_cache import load_image_rgb, load_inference_image, purge_inference_images, read_image_metadata
+from .tiles import tile_pyramid
+from .auto_masks import scale_mask
+from .multimask import get_candidates, multimask_cache, store_candidates
+from .refinement import discard_session, edit_points, get_session, purge_sessions, store_session
+from django.utils.cache import patch_cache_control
 import matplotlib.pyplot as plt  # Added for visualization testing
 
 ### upload point for images 
@@ -38,23 +60,38 @@ class UploadImageView(APIView):
     def post(self, request, *args, **kwargs):
         image = request.FILES.get('image')
         name = request.data.get('name')
-  
-        image_hash = self.get_file_hash(image)
 
         # Check if the uploaded file is an image
         if image and self.is_image(image) and name:
 
-            # duplicate protection
-            for existing_image in Image.objects.all():
-                if existing_image.file_hash == image_hash:
-                    print("match found")
-                    print(image_hash, " is equal to\n", existing_image.file_hash)
-                    return Response({
-                    "message": "This image has already been uploaded."
-                    }, status=status.HTTP_400_BAD_REQUEST)
+            # Hash the file in the same pass that writes it to storage
+            file_field = Image._meta.get_field('file')
+            hashing_file = HashingFile(image)
+            stored_name = file_field.storage.save(file_field.generate_filename(None, image.name), hashing_file)
+            image_hash = hashing_file.hexdigest()
+            # size, mode and orientation from the header, without decoding the image
+            metadata = read_image_metadata(image)
 
-            upload = Image.objects.create(name=name, file=image, file_hash=image_hash)
-            upload.save()
+            duplicate = Response({
+                "message": "This image has already been uploaded."
+            }, status=status.HTTP_400_BAD_REQUEST)
+            if Image.objects.filter(file_hash=image_hash).exists():
+                file_field.storage.delete(stored_name)
+                return duplicate
+            # the unique index on file_hash catches a duplicate uploaded at the same time
+            try:
+                with transaction.atomic():
+                    upload = Image.objects.create(name=name, file=stored_name, file_hash=image_hash, **metadata)
+            except IntegrityError:
+                file_field.storage.delete(stored_name)
+                return duplicate
+
+            # Warm the embedding for the model the client segments with
+            if getattr(settings, 'SAM2_PRECOMPUTE_ON_UPLOAD', False):
+                embedding_precomputer.submit(upload, self.get_precompute_model(request))
+            # and the tile pyramid for viewing it
+            if getattr(settings, 'SAM2_TILES_ON_UPLOAD', False):
+                tile_pyramid.submit(upload)
 
             full_image_url = request.build_absolute_uri(upload.file.url)
 
@@ -63,7 +100,8 @@ class UploadImageView(APIView):
                 "message": "Uploaded successfully!",
                 "imageName": upload.name,
                 "imageLocation": full_image_url,
-                "file_hash": upload.file_hash
+                "file_hash": upload.file_hash,
+                "embedding_status": upload.embedding_status
             }, status=status.HTTP_201_CREATED)
         else:
             return Response({
@@ -78,12 +116,37 @@ class UploadImageView(APIView):
             return True
         return False
 
-    def get_file_hash(self, file):
-        # Calculate the MD5 hash of the file content
-        hasher = hashlib.md5()
-        for chunk in file.chunks():
-            hasher.update(chunk)
-        return hasher.hexdigest()
+    def get_precompute_model(self, request):
+        # model chosen by the client, falling back to the configured default
+        default_model = getattr(settings, 'SAM2_PRECOMPUTE_MODEL', 3)
+        try:
+            return parse_model(request.data.get('model', default_model))
+        except SAM2RequestError:
+            return default_model
+
+
+# Wraps an uploaded file so its MD5 hash is calculated from the chunks storage
+# reads while writing it out, rather than in a separate pass
+class HashingFile(File):
+    def __init__(self, file):
+        super().__init__(file, name=file.name)
+        self.hasher = hashlib.md5()
+        self.bytes_hashed = 0
+
+    def chunks(self, chunk_size=None):
+        for chunk in self.file.chunks(chunk_size):
+            self.hasher.update(chunk)
+            self.bytes_hashed += len(chunk)
+            yield chunk
+
+    def hexdigest(self):
+        # storage backends that read the file some other way never call chunks()
+        if self.bytes_hashed != self.file.size:
+            self.hasher = hashlib.md5()
+            self.bytes_hashed = 0
+            for _ in self.chunks():
+                pass
+        return self.hasher.hexdigest()
 
 ### delete image, pass image hash of target
 class DeleteImageView(DestroyAPIView):
@@ -100,6 +163,12 @@ class DeleteImageView(DestroyAPIView):
         # If deleting selected image, remove from session.
         if request.session.get('last_selected_image_hash') == image.file_hash:
             del request.session['last_selected_image_hash']
+        # Cached embeddings and tiles for this image are no longer needed
+        if image.file_hash:
+            purge_embeddings(image.file_hash)
+            purge_sessions(image.file_hash)
+            purge_inference_images(image.file_hash)
+            tile_pyramid.purge(image.file_hash)
 
         # Deleting the database record
         image.delete()
@@ -123,7 +192,9 @@ class SelectImageView(APIView):
             if image:
                 return Response({
                     "imageName": image.name,
-                    "imageLocation": image.file.url
+                    "imageLocation": image.file.url,
+                    "thumbnail": reverse('image_thumbnail', args=[image.file_hash]),
+                    "tiles": reverse('image_tiles', args=[image.file_hash])
                 }, status=200)
             else:
                 return Response({"message": "Image not found"}, status=404)
@@ -249,54 +320,29 @@ def visualize_contours(mask_array, max_points_per_contour=None, tolerance=0.5, v
         plt.figure(figsize=(10, 10))  # Optional: Specify figure size
         plt.imshow(np.squeeze(mask_array), cmap='gray')
 
-    contours = measure.find_contours(np.squeeze(mask_array), level=0.5)
+    contours = find_contours(mask_array)
+    simplified_contours, tolerances = simplify_contours(contours, max_points_per_contour, tolerance)
     
-    print(f"Number of contours detected: {len(contours)}")
-    
-    simplified_contours = []
-    
-    for idx, contour in enumerate(contours, start=1):
-        original_num_points = len(contour)
-        current_tolerance = tolerance
-        
-       
-        if max_points_per_contour and original_num_points > max_points_per_contour:
-            simplified = measure.approximate_polygon(contour, tolerance=current_tolerance)
-            num_simplified_points = len(simplified)
-            
+    if (visualise):
+        print(f"Number of contours detected: {len(contours)}")
 
-            while num_simplified_points > max_points_per_contour and current_tolerance < 10:
-                current_tolerance += 0.5
-                simplified = measure.approximate_polygon(contour, tolerance=current_tolerance)
-                num_simplified_points = len(simplified)
-            
-            contour = simplified 
-            print(f"Contour {idx} simplified from {original_num_points} to {num_simplified_points} points with tolerance {current_tolerance}.")
-        else:
-            num_simplified_points = original_num_points
-            print(f"Contour {idx} has {num_simplified_points} points (no simplification applied).")
-      
-        simplified_contours.append(contour)
-        
-        if (visualise):
+        for contour, current_tolerance in zip(simplified_contours, tolerances):
             plt.plot(contour[:, 1], contour[:, 0], linewidth=2)
             
 
             label_x, label_y = contour[0, 1], contour[0, 0]
-            label_text = f"Tol: {current_tolerance}, Points: {num_simplified_points}"
+            label_text = f"Tol: {current_tolerance or tolerance}, Points: {len(contour)}"
             
 
             plt.text(label_x, label_y, label_text, fontsize=8, color='yellow',
                     bbox=dict(facecolor='black', alpha=0.5, boxstyle='round,pad=0.2'))
     
-    if (visualise):
         plt.title('Contour Visualization')
         plt.axis('image')
     
-    media_path = '/home/hammatime123/it-project-group-65/backend/media'
-    contours_dir = os.path.join(media_path, 'contours')
+        media_path = '/home/hammatime123/it-project-group-65/backend/media'
+        contours_dir = os.path.join(media_path, 'contours')
     
-    if(visualise):
         os.makedirs(contours_dir, exist_ok=True)
     
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -324,229 +370,1044 @@ def format_contours_to_json(label, contours):
         })
     return data  # Return as a Python dictionary
 
-    contours = measure.find_contours(np.squeeze(mask_array), level=0.5)
-    simplified_contours = []
-    for contour in contours:
-        original_num_points = len(contour)
-        current_tolerance = tolerance
-        if max_points and original_num_points > max_points:
-            simplified = measure.approximate_polygon(contour, tolerance=current_tolerance)
-            num_simplified_points = len(simplified)
-            while num_simplified_points > max_points and current_tolerance < 10:
-                current_tolerance += 0.5
-                simplified = measure.approximate_polygon(contour, tolerance=current_tolerance)
-                num_simplified_points = len(simplified)
-            contour = simplified
-        simplified_contours.append(contour)
-    return simplified_contours
+def contour_fields(label, contours):
+    # JSON and/or compact contours for a new Mask, depending on SAM2_CONTOUR_STORAGE
+    storage = getattr(settings, 'SAM2_CONTOUR_STORAGE', 'json')
+    fields = {}
+    if storage in ('json', 'both'):
+        fields["contours"] = format_contours_to_json(label, contours)
+    if storage in ('compact', 'both'):
+        fields["contours_compact"] = encode_contours(contours)
+    return fields
     
+def mask_fields(image, total_mask):
+    # Mask image or run-length encoded mask for a new Mask, depending on
+    # SAM2_MASK_STORAGE; deferred masks keep the run-length encoded mask until
+    # their image is written. Only mask images need the full size image
+    deferred = getattr(settings, 'SAM2_MASK_ENCODE_DEFERRED', False)
+    if getattr(settings, 'SAM2_MASK_STORAGE', 'rle') == 'png' and not deferred:
+        fmt = mask_format()
+        img_arr = load_image_rgb(image) if fmt != 'png1' else None
+        return {"maskImage": mask_image_file(img_arr, total_mask, fmt)}
+    fields = {"maskRle": encode_mask(total_mask)}
+    if deferred:
+        fields["encoding_status"] = Mask.ENCODING_PENDING
+    return fields
+
+
+def encode_after_response(mask, total_mask):
+    # hand a pending mask to the background encoder once it is committed,
+    # encoding it straight away if the encoder is full
+    def submit():
+        if not mask_encoder.submit(mask, None, total_mask):
+            mask_encoder.encode(mask.pk, None, total_mask)
+    transaction.on_commit(submit)
+
+
+# Raised by the /sam2/ helpers below with the error message and status code to
+# send back, so the sync and async views can share them
+class SAM2RequestError(Exception):
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+def json_field(data, name, default=None):
+    # Form requests send JSON-encoded strings, JSON requests send the values
+    value = data.get(name)
+    if value in (None, ''):
+        return default
+    if isinstance(value, str):
+        return json.loads(value)
+    return value
+
+
+def parse_model(value):
+    # a request's model index, checked against the registry's models so an
+    # unknown one is the client's error rather than a failure loading it
+    try:
+        # JSON true/false would otherwise pass as 1 and 0
+        if isinstance(value, bool):
+            raise ValueError(value)
+        model = int(value)
+        if model != value and str(model) != value:
+            raise ValueError(value)
+        model_registry.check_index(model)
+    except (TypeError, ValueError):
+        raise SAM2RequestError(
+            f"'model' must be a model index from 0 to {len(model_registry.specs) - 1}.",
+            status.HTTP_400_BAD_REQUEST
+        )
+    return model
+
+
+def parse_sam2_request(data):
+    """Read and validate the fields of a /sam2/ request."""
+    try:
+        parsed = {
+            "image_hash": data.get('file_hash'),
+            "word": data.get('word'),
+            "inclusion_points": json_field(data, 'inclusion_points', []),
+            "exclusion_points": json_field(data, 'exclusion_points', []),
+            "bounding_boxes": json_field(data, 'bounding_box', []),
+            "model": json_field(data, 'model', 3),
+            # Optional: segment several words at once, one prompt per word, taken
+            # either from 'bounding_box' (one box per word) or from 'point_sets'
+            # (one {inclusion_points, exclusion_points} object per word)
+            "words": json_field(data, 'words'),
+            "point_sets": json_field(data, 'point_sets', []),
+            # Optional: return SAM2's alternative masks for an ambiguous prompt,
+            # to choose one of with /sam2/multimask/<candidates_id>/, rather
+            # than saving the best one
+            "multimask": bool(json_field(data, 'multimask', False)),
+        }
+    except json.JSONDecodeError:
+        raise SAM2RequestError("Request fields must be valid JSON.", status.HTTP_400_BAD_REQUEST)
+
+    if not parsed["image_hash"] or not (parsed["word"] or parsed["words"]):
+        raise SAM2RequestError("Missing required fields: 'file_hash' and/or 'word'.", status.HTTP_400_BAD_REQUEST)
+    parsed["model"] = parse_model(parsed["model"])
+
+    if parsed["words"]:
+        if not isinstance(parsed["words"], list) or len(parsed["words"]) != len(parsed["bounding_boxes"] or parsed["point_sets"]):
+            raise SAM2RequestError(
+                "'words' must be a list with one entry per bounding box or point set.",
+                status.HTTP_400_BAD_REQUEST
+            )
+        # each point set prompts one word, so it needs at least one point
+        if not parsed["bounding_boxes"] and not all(
+            isinstance(point_set, dict)
+            and isinstance(point_set.get('inclusion_points', []), list)
+            and isinstance(point_set.get('exclusion_points', []), list)
+            and (point_set.get('inclusion_points') or point_set.get('exclusion_points'))
+            for point_set in parsed["point_sets"]
+        ):
+            raise SAM2RequestError(
+                "Each of 'point_sets' must have at least one of 'inclusion_points' and 'exclusion_points'.",
+                status.HTTP_400_BAD_REQUEST
+            )
+    # Check for presence of either bounding_boxes or both inclusion_points and exclusion_points
+    elif not parsed["bounding_boxes"] and not (parsed["inclusion_points"] or parsed["exclusion_points"]):
+        raise SAM2RequestError(
+            "Provide either 'bounding_box' or both 'inclusion_points' and 'exclusion_points'.",
+            status.HTTP_400_BAD_REQUEST
+        )
+
+    if parsed["bounding_boxes"] and not isinstance(parsed["bounding_boxes"], list):
+        raise SAM2RequestError(
+            "'bounding_box' must be a list of four numbers: [x1, y1, x2, y2].",
+            status.HTTP_400_BAD_REQUEST
+        )
+    # Ensure inclusion_points and exclusion_points are properly structured
+    if not (isinstance(parsed["inclusion_points"], list) and isinstance(parsed["exclusion_points"], list)):
+        raise SAM2RequestError(
+            "'inclusion_points' and 'exclusion_points' must be lists of points.",
+            status.HTTP_400_BAD_REQUEST
+        )
+    if parsed["multimask"] and (parsed["words"] or len(parsed["bounding_boxes"]) > 1
+                                or (parsed["bounding_boxes"] and (parsed["inclusion_points"] or parsed["exclusion_points"]))):
+        raise SAM2RequestError(
+            "'multimask' needs a single word prompted with one bounding box or a set of points.",
+            status.HTTP_400_BAD_REQUEST
+        )
+
+    return parsed
+
+
+def open_inference_image(image):
+    """Return an Image's (height, width) and its pixels downsized for inference.
+
+    SAM2 encodes every image at 1024x1024, so inference runs on a cached copy
+    of that size and only the masks are produced at the image's full size.
+    """
+    if not image.file:
+        raise SAM2RequestError("Image file not found.", status.HTTP_404_NOT_FOUND)
+    try:
+        width, height = image.get_size()
+        return (height, width), load_inference_image(image)
+    except Exception as e:
+        print(f"Error opening image file: {e}")
+        raise SAM2RequestError("Failed to open image file.", status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+def scale_points(points, width_scale, height_scale):
+    # Frontend points are relative to the image size, of the form {'x': .., 'y': ..}
+    return [[point['x'] * width_scale, point['y'] * height_scale] for point in points]
+
+
+def scale_boxes(bounding_boxes, width_scale, height_scale):
+    # Relative [x1, y1, x2, y2] boxes to pixel [[x1, y1], [x2, y2]] corners
+    return [
+        [[sublist[0] * width_scale, sublist[1] * height_scale], [sublist[2] * width_scale, sublist[3] * height_scale]]
+        for sublist in bounding_boxes
+    ]
+
+
+def submit_segmentation(my_sam, parsed, size, inference_img):
+    """Queue inference for a parsed /sam2/ request on the image's inference copy.
+
+    Prompts are scaled to, and masks returned at, the image's full (height,
+    width) `size`. Returns a Future of generateMask's NxHxW masks (one per
+    box), or of one HxW mask per word when the request has 'words'.
+    """
+    height_scale, width_scale = size  # Get width and height
+    try:
+        if parsed["words"] and parsed["bounding_boxes"]:
+            prompts = [
+                {"boundingBoxes": [box]}
+                for box in scale_boxes(parsed["bounding_boxes"], width_scale, height_scale)
+            ]
+        elif parsed["words"]:
+            prompts = [
+                {
+                    "inclusionPoints": scale_points(point_set.get('inclusion_points', []), width_scale, height_scale),
+                    "exclusionPoints": scale_points(point_set.get('exclusion_points', []), width_scale, height_scale)
+                }
+                for point_set in parsed["point_sets"]
+            ]
+        elif parsed["bounding_boxes"]:
+            # Transform and scale the points
+            prompt = {"boundingBoxes": scale_boxes(parsed["bounding_boxes"], width_scale, height_scale)}
+        else:
+            # Scale the points
+            prompt = {
+                "inclusionPoints": scale_points(parsed["inclusion_points"], width_scale, height_scale),
+                "exclusionPoints": scale_points(parsed["exclusion_points"], width_scale, height_scale)
+            }
+    except (AttributeError, IndexError, KeyError, TypeError):
+        raise SAM2RequestError(
+            "Each prompt must be a bounding box [x1, y1, x2, y2] or a set of points.",
+            status.HTTP_400_BAD_REQUEST
+        )
+
+    try:
+        if parsed["words"]:
+            return my_sam.submitMasks(
+                inference_img, prompts, model=parsed["model"], imageHash=parsed["image_hash"], outputSize=size
+            )
+        return my_sam.submitMask(
+            inference_img, model=parsed["model"], imageHash=parsed["image_hash"], outputSize=size,
+            multimask=parsed["multimask"], **prompt
+        )
+    except Exception as e:
+        print(f"Error generating mask: {e}")
+        raise SAM2RequestError("Failed to generate mask.", status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+def merge_masks(mask_array, width_scale, height_scale):
+    # Combine the NxHxW masks returned for one prompt (one per box) into one
+    masks = np.reshape(mask_array, (-1, height_scale, width_scale))
+    return np.logical_or.reduce(masks).astype(np.uint8)
+
+
+def save_segmentation(parsed, image, size, result):
+    """Store the masks produced for a parsed /sam2/ request, returning the new Masks."""
+    if parsed["words"]:
+        masks_by_word = [(word, mask.astype(np.uint8)) for word, mask in zip(parsed["words"], result)]
+    else:
+        height, width = size
+        masks_by_word = [(parsed["word"], merge_masks(result, width, height))]
+    return [save_mask(image, word, total_mask) for word, total_mask in masks_by_word]
+
+
+def mask_content(image, word, total_mask):
+    """Fields of a new Mask for a generated mask: its image or encoded mask, and its contours."""
+    # contours = generate_contour_from_mask(total_mask, total_mask.shape[::-1], max_points=10)
+    # contours_json = format_contours_to_json(word, contours)
+    temp = visualize_contours(total_mask,1000,0.5, visualise=False)
+
+    try:
+        content = mask_fields(image, total_mask)
+    except Exception as e:
+        print(f"Error saving mask image to buffer: {e}")
+        raise SAM2RequestError("Failed to save mask image.", status.HTTP_500_INTERNAL_SERVER_ERROR)
+    return {**content, **contour_fields(word, temp)}  # Store contours in the Mask object
+
+
+def save_mask(image, word, total_mask):
+    """Store a generated mask and its contours against the image and word."""
+    content = mask_content(image, word, total_mask)
+
+    # Handle Word association
+    try:
+        word_obj, created = Word.objects.get_or_create(
+            image=image,
+            word=word
+        )
+    except Exception as e:
+        print(f"Error retrieving or creating Word object: {e}")
+        raise SAM2RequestError("Failed to retrieve or create Word object.", status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    # Create and save the Mask instance
+    try:
+        mask = Mask.objects.create(
+            image=image,
+            word=word_obj,
+            **content
+        )
+    except Exception as e:
+        print(f"Error saving Mask instance: {e}")
+        raise SAM2RequestError("Failed to save mask to the database.", status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    if mask.encoding_status == Mask.ENCODING_PENDING:
+        encode_after_response(mask, total_mask)
+    return mask
+
+
+def mask_details(request, mask):
+    return {
+        "uuid": str(mask.uuid),
+        "maskImage": request.build_absolute_uri(mask.get_image_url()),
+        "encoding_status": mask.encoding_status,
+        "image_id": mask.image.file_hash,
+        "word": mask.word.word,
+    }
+
+
+def segmentation_response_data(request, parsed, new_masks):
+    # Return mask details (one mask, or one per word)
+    if parsed["words"]:
+        return {
+            "message": "Masks generated and saved successfully!",
+            "masks": [mask_details(request, new_mask) for new_mask in new_masks]
+        }
+    return {
+        "message": "Mask generated and saved successfully!",
+        "mask": mask_details(request, new_masks[0])
+    }
+
+
+def multimask_response_data(parsed, image, result):
+    # Caches the alternative masks of a multimask request, returning them best
+    # first for the annotator to choose from
+    masks, scores = result
+    candidates_id, entry = store_candidates(image, parsed["word"], parsed["model"], masks, scores)
+    return {
+        "message": "Choose one of the candidate masks.",
+        "candidates_id": candidates_id,
+        "expires_in": multimask_cache.ttl,
+        "candidates": [
+            {"index": idx, "score": score, "mask": coco_rle(mask)}
+            for idx, (mask, score) in enumerate(zip(entry["masks"], entry["scores"]))
+        ]
+    }
+
+
 class SAM2maskView(APIView):
 
     def post(self, request, *args, **kwargs):
         my_sam = AutoSegmentTool()
 
-        # Extract data from the request
-        image_hash = request.data.get('file_hash')
-        word = request.data.get('word')
-        inclusion_points = json.loads(request.data.get('inclusion_points'))
-        exclusion_points = json.loads(request.data.get('exclusion_points'))
-        bounding_boxes = json.loads(request.data.get('bounding_box'))
-        model = json.loads(request.data.get('model'))
-        
-        # contour fidelity setting: 0 = low, 1 = medium, 2 = high
-        contour_fidelity = json.loads(request.data.get('contour_fidelity'))
+        try:
+            parsed = parse_sam2_request(request.data)
+            # Get and open image
+            image = get_object_or_404(Image, file_hash=parsed["image_hash"])
+            size, inference_img = open_inference_image(image)
+
+            future = submit_segmentation(my_sam, parsed, size, inference_img)
+            try:
+                with interactive_gate.busy():
+                    result = future.result()
+            except Exception as e:
+                print(f"Error generating mask: {e}")
+                raise SAM2RequestError("Failed to generate mask.", status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+            if parsed["multimask"]:
+                return Response(multimask_response_data(parsed, image, result), status=status.HTTP_200_OK)
+            new_masks = save_segmentation(parsed, image, size, result)
+        except SAM2RequestError as e:
+            return Response({"error": e.message}, status=e.status_code)
+
+        # Return a success response with mask details and contours
+        return Response(segmentation_response_data(request, parsed, new_masks), status=status.HTTP_201_CREATED)
 
-        # Get max_points from request data (optional)
-        max_points = request.data.get('max_points')
-        max_points = int(max_points) if max_points else None
 
-        if not image_hash or not word:
-            return Response(
-                {"error": "Missing required fields: 'file_hash' and/or 'word'."},
-                status=status.HTTP_400_BAD_REQUEST
-            )
+# POST {"index"} saves candidate `index` of a multimask /sam2/ request as the
+# word's mask, without running the model again. Candidates stay cached until
+# they expire, so a different one can still be chosen afterwards
+class MultimaskChoiceView(APIView):
 
-        # Check for presence of either bounding_boxes or both inclusion_points and exclusion_points
-        if not bounding_boxes and not (inclusion_points or exclusion_points):
+    def post(self, request, candidates_id):
+        entry = get_candidates(candidates_id)
+        if entry is None:
+            return Response({"error": "Candidate masks not found or expired."}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            index = int(json_field(request.data, 'index'))
+        except (json.JSONDecodeError, TypeError, ValueError):
+            index = None
+        if index is None or not 0 <= index < len(entry["masks"]):
             return Response(
-                {
-                    "error": "Provide either 'bounding_box' or both 'inclusion_points' and 'exclusion_points'."
-                },
+                {"error": f"'index' must be from 0 to {len(entry['masks']) - 1}."},
                 status=status.HTTP_400_BAD_REQUEST
             )
+        image = get_object_or_404(Image, pk=entry["image_id"])
 
-        # Get and open image
-        image = get_object_or_404(Image, file_hash=image_hash)
-        image_file = image.file
-
-        if not image_file:
-            return Response(
-                {"error": "Image file not found."},
-                status=status.HTTP_404_NOT_FOUND
-            )
-        
         try:
-            with image_file.open('rb') as img:
-                imgObject = PILImage.open(img).convert('RGB')  # Ensure image is in RGB
-                width_scale, height_scale = imgObject.size  # Get width and height
-        except Exception as e:
-            print(f"Error opening image file: {e}")
-            return Response(
-                {"error": "Failed to open image file."},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
-            )
+            new_mask = save_mask(image, entry["word"], decode_mask(entry["masks"][index]))
+        except SAM2RequestError as e:
+            return Response({"error": e.message}, status=e.status_code)
+        return Response({
+            "message": "Mask saved successfully!",
+            "score": entry["scores"][index],
+            "mask": mask_details(request, new_mask)
+        }, status=status.HTTP_201_CREATED)
 
-        if bounding_boxes:
-            # Validate bounding_boxes structure
-            if not isinstance(bounding_boxes, list):
-                return Response(
-                    {"error": "'bounding_box' must be a list of four numbers: [x1, y1, x2, y2]."},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-            # Transform and scale the points
-            bounding_boxes = [
-                [[sublist[0] * width_scale, sublist[1] * height_scale], [sublist[2] * width_scale, sublist[3] * height_scale]]
-                for sublist in bounding_boxes
-            ]
-        else:
-            # Ensure inclusion_points and exclusion_points are properly structured
-            if not (isinstance(inclusion_points, list) or isinstance(exclusion_points, list)):
-                return Response(
-                    {"error": "'inclusion_points' and 'exclusion_points' must be lists of points."},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-            inclusion_points = [[point['x'], point['y']] for point in inclusion_points]
-            exclusion_points = [[point['x'], point['y']] for point in exclusion_points]
-            # Scale the points
-            scaled_inclusion_points = [[point[0] * width_scale, point[1] * height_scale] for point in inclusion_points]
-            scaled_exclusion_points = [[point[0] * width_scale, point[1] * height_scale] for point in exclusion_points]
 
+def parse_refine_request(data):
+    """Read and validate the fields of a /sam2/refine/ request: the session's
+    file_hash, word and model, and exactly one of 'add_inclusion_point',
+    'add_exclusion_point' ({x, y} relative to the image size) or 'remove_point'
+    (index into the session's points)."""
+    try:
+        parsed = {
+            "image_hash": data.get('file_hash'),
+            "word": data.get('word'),
+            "model": json_field(data, 'model', 3),
+            "add_point": None,
+            "remove_point": None,
+        }
+        edits = [name for name in ('add_inclusion_point', 'add_exclusion_point', 'remove_point') if json_field(data, name) is not None]
+        if len(edits) == 1 and edits[0] == 'remove_point':
+            parsed["remove_point"] = int(json_field(data, 'remove_point'))
+        elif len(edits) == 1:
+            point = json_field(data, edits[0])
+            parsed["add_point"] = {
+                "x": float(point['x']),
+                "y": float(point['y']),
+                "include": edits[0] == 'add_inclusion_point'
+            }
+    except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+        raise SAM2RequestError(
+            "'model' and 'remove_point' must be integers, and added points {x, y} objects.",
+            status.HTTP_400_BAD_REQUEST
+        )
+
+    if not parsed["image_hash"] or not parsed["word"]:
+        raise SAM2RequestError("Missing required fields: 'file_hash' and/or 'word'.", status.HTTP_400_BAD_REQUEST)
+    parsed["model"] = parse_model(parsed["model"])
+    if len(edits) != 1:
+        raise SAM2RequestError(
+            "Provide one of 'add_inclusion_point', 'add_exclusion_point' or 'remove_point'.",
+            status.HTTP_400_BAD_REQUEST
+        )
+    return parsed
+
+
+### click refinement of one word's mask, a point at a time
+# Every call adds or removes one point and re-runs the decoder on all the
+# session's points (see refinement.py). Adding a point also feeds back the last
+# prediction's low resolution logits as a mask prompt, so the mask converges in
+# fewer clicks; removing one predicts from the remaining points alone. Each
+# result is saved as the word's mask, as with /sam2/. GET and DELETE on
+# sam2/refine/<file_hash>/<word>/?model= show and end a session
+class SAM2RefineView(APIView):
+
+    def post(self, request, *args, **kwargs):
         try:
-            if bounding_boxes:
-                mask_array = my_sam.generateMask(
-                    imgObject, 
-                    boundingBoxes=bounding_boxes,
-                    model=model
+            parsed = parse_refine_request(request.data)
+            image_hash, word, model = parsed["image_hash"], parsed["word"], parsed["model"]
+            image = get_object_or_404(Image, file_hash=image_hash)
+            mask_uuid = Mask.objects.filter(image=image, word__word=word).values_list('uuid', flat=True).first()
+            session = get_session(image_hash, word, model, str(mask_uuid) if mask_uuid else None)
+            if parsed["remove_point"] is not None and not 0 <= parsed["remove_point"] < len(session["points"]):
+                raise SAM2RequestError(
+                    f"'remove_point' must be the index of one of the {len(session['points'])} points in the session.",
+                    status.HTTP_400_BAD_REQUEST
                 )
-            else:
-                mask_array = my_sam.generateMask(
-                    imgObject, 
-                    inclusionPoints=scaled_inclusion_points, 
-                    exclusionPoints=scaled_exclusion_points,
-                    model=model
+            points, mask_input = edit_points(session, parsed["add_point"], parsed["remove_point"])
+
+            if not points:
+                # nothing left to prompt with, so the word has no mask
+                discard_session(image_hash, word, model)
+                Mask.objects.filter(image=image, word__word=word).delete()
+                return Response({"message": "All points removed, mask deleted.", "mask": None, "points": []},
+                                status=status.HTTP_200_OK)
+
+            size, inference_img = open_inference_image(image)
+            height, width = size
+            try:
+                masks, logits = AutoSegmentTool().generateRefinedMask(
+                    inference_img,
+                    inclusionPoints=scale_points([point for point in points if point["include"]], width, height),
+                    exclusionPoints=scale_points([point for point in points if not point["include"]], width, height),
+                    maskInput=mask_input,
+                    model=model,
+                    imageHash=image_hash,
+                    outputSize=size
                 )
-        except Exception as e:
-            print(f"Error generating mask: {e}")
-            return Response(
-                {"error": "Failed to generate mask."},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
-            )
+            except Exception as e:
+                print(f"Error generating mask: {e}")
+                raise SAM2RequestError("Failed to generate mask.", status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        img_arr = np.array(imgObject)
-        total_mask = np.zeros((height_scale, width_scale), dtype=np.uint8)
+            new_mask = save_mask(image, word, masks[0].astype(np.uint8))
+        except SAM2RequestError as e:
+            return Response({"error": e.message}, status=e.status_code)
 
-        if len(np.shape(mask_array)) == 3:
-            # print("Shape of mask passed with 3 dims is: ", np.shape(mask_array))
-            mask_image = np.squeeze(mask_array)
-            # print(np.shape(mask_image))
-            total_mask = total_mask + mask_image
+        store_session(image_hash, word, model, points, logits, str(new_mask.uuid))
+        return Response({
+            "message": "Mask refined and saved successfully!",
+            "mask": mask_details(request, new_mask),
+            "points": points
+        }, status=status.HTTP_201_CREATED)
+
+    def get(self, request, file_hash, word):
+        image = get_object_or_404(Image, file_hash=file_hash)
+        model = self.model_param(request)
+        if model is None:
+            return Response({"error": "'model' must be a model index."}, status=status.HTTP_400_BAD_REQUEST)
+        mask_uuid = Mask.objects.filter(image=image, word__word=word).values_list('uuid', flat=True).first()
+        session = get_session(file_hash, word, model, str(mask_uuid) if mask_uuid else None)
+        return Response({"points": session["points"]}, status=status.HTTP_200_OK)
+
+    def delete(self, request, file_hash, word):
+        model = self.model_param(request)
+        if model is None:
+            return Response({"error": "'model' must be a model index."}, status=status.HTTP_400_BAD_REQUEST)
+        discard_session(file_hash, word, model)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    def model_param(self, request):
+        try:
+            return parse_model(request.query_params.get('model', 3))
+        except SAM2RequestError:
+            return None
+
+
+def parse_bulk_item(item, width_scale, height_scale):
+    """Read one item of a /sam2/bulk/ request into its word and its prompts.
+
+    An item has a 'word' and either 'bounding_box' (a list of boxes, one prompt
+    each, whose masks are merged) or 'inclusion_points'/'exclusion_points'.
+    """
+    if not isinstance(item, dict) or not item.get('word'):
+        raise SAM2RequestError("Each item needs a 'word'.", status.HTTP_400_BAD_REQUEST)
+    try:
+        boxes = json_field(item, 'bounding_box', [])
+        inclusion_points = json_field(item, 'inclusion_points', [])
+        exclusion_points = json_field(item, 'exclusion_points', [])
+        if boxes and (inclusion_points or exclusion_points):
+            raise SAM2RequestError(
+                "Provide either 'bounding_box' or points for an item, not both.",
+                status.HTTP_400_BAD_REQUEST
+            )
+        if boxes:
+            prompts = [{"boundingBoxes": [box]} for box in scale_boxes(boxes, width_scale, height_scale)]
+        elif inclusion_points or exclusion_points:
+            prompts = [{
+                "inclusionPoints": scale_points(inclusion_points, width_scale, height_scale),
+                "exclusionPoints": scale_points(exclusion_points, width_scale, height_scale)
+            }]
         else:
-            for mask in mask_array:
-                mask_image = np.squeeze(mask)
-                # print("First squeeze", np.shape(mask_image))
-                total_mask = total_mask + mask_image
+            raise SAM2RequestError(
+                "Provide either 'bounding_box' or both 'inclusion_points' and 'exclusion_points'.",
+                status.HTTP_400_BAD_REQUEST
+            )
+    except (json.JSONDecodeError, AttributeError, IndexError, KeyError, TypeError):
+        raise SAM2RequestError(
+            "Each prompt must be a bounding box [x1, y1, x2, y2] or a set of points.",
+            status.HTTP_400_BAD_REQUEST
+        )
+    return item['word'], prompts
+
+
+def parse_bulk_items(items, size, existing_words=()):
+    """Validate the items of a bulk request for an image of (height, width) `size`.
+
+    Returns [(index, word, prompts)] for the items that can be segmented, and
+    {index: SAM2RequestError} for those that cannot, including items whose word
+    is repeated or in `existing_words` (words to leave as they are, as
+    auto_annotate does with words that already have a mask).
+    """
+    height_scale, width_scale = size
+    parsed = []
+    errors = {}
+    seen = set(existing_words)
+    for idx, item in enumerate(items):
+        try:
+            word, prompts = parse_bulk_item(item, width_scale, height_scale)
+            if word in seen:
+                raise SAM2RequestError(f"A mask for '{word}' already exists.", status.HTTP_409_CONFLICT)
+        except SAM2RequestError as e:
+            errors[idx] = e
+            continue
+        seen.add(word)
+        parsed.append((idx, word, prompts))
+    return parsed, errors
+
+
+def submit_bulk_items(image_hash, size, inference_img, parsed, model):
+    # every item's prompts in one submitMasks call, returning a Future of their masks
+    prompts = [prompt for _, _, item_prompts in parsed for prompt in item_prompts]
+    return AutoSegmentTool().submitMasks(inference_img, prompts, model=model, imageHash=image_hash, outputSize=size)
+
+
+def merge_item_masks(parsed, masks):
+    # (word, mask) per item, the masks of an item's boxes merged into one
+    masks = iter(masks)
+    return [
+        (word, np.logical_or.reduce([next(masks) for _ in item_prompts]).astype(np.uint8))
+        for _, word, item_prompts in parsed
+    ]
+
+
+def save_bulk_masks(image, masks_by_word):
+    """Store (word, mask) pairs against the image in one transaction, returning the new Masks."""
+    contents = [(word, mask_content(image, word, total_mask)) for word, total_mask in masks_by_word]
+    return insert_masks(image, contents, [total_mask for _, total_mask in masks_by_word])
+
+
+def insert_masks(image, contents, total_masks=None):
+    """Create Masks from (word, mask_content) pairs in one transaction, returning them.
+
+    Words and masks are written with one bulk insert each, and the image's
+    version is bumped once rather than once per row. A word's existing mask is
+    replaced, as Mask.save() does. Pending masks are encoded after commit from
+    `total_masks`, or from their run-length encoded mask.
+    """
+    words = [word for word, _ in contents]
+    try:
+        with transaction.atomic():
+            # their files and cutouts are removed by Mask's post_delete signal
+            Mask.objects.filter(image=image, word__word__in=words).delete()
+            word_objs = {}
+            for word_obj in Word.objects.filter(image=image, word__in=words).order_by('id'):
+                word_objs.setdefault(word_obj.word, word_obj)
+            new_words = Word.objects.bulk_create([
+                Word(image=image, word=word) for word in dict.fromkeys(words) if word not in word_objs
+            ])
+            if new_words and new_words[0].pk is None:
+                # databases that do not return primary keys from bulk inserts
+                pks = dict(Word.objects.filter(image=image, word__in=words).values_list('word', 'pk'))
+                for word_obj in new_words:
+                    word_obj.pk = pks[word_obj.word]
+            word_objs.update((word_obj.word, word_obj) for word_obj in new_words)
+
+            masks = Mask.objects.bulk_create([
+                Mask(image=image, word=word_objs[word], **content) for word, content in contents
+            ])
+            if masks and masks[0].pk is None:
+                pks = dict(Mask.objects.filter(image=image).values_list('uuid', 'pk'))
+                for mask in masks:
+                    mask.pk = pks[mask.uuid]
+            Image.bump_version(image.pk)
+            for idx, mask in enumerate(masks):
+                if mask.encoding_status == Mask.ENCODING_PENDING:
+                    total_mask = total_masks[idx] if total_masks is not None else decode_mask(bytes(mask.maskRle))
+                    encode_after_response(mask, total_mask)
+    except IntegrityError as e:
+        print(f"Error saving Mask instances: {e}")
+        raise SAM2RequestError("A mask for one of these words was saved in the meantime.", status.HTTP_409_CONFLICT)
+    return masks
+
+
+### segment many words on one image in a single request
+# Takes {"file_hash", "model", "items": [{"word", "bounding_box" or
+# "inclusion_points"/"exclusion_points"}, ...]}. The image is encoded once, all
+# prompts are decoded together and every mask is saved in one transaction.
+# Returns one result per item, in order; items that cannot be segmented (bad
+# prompts or repeated words) get an error and do not stop the rest. A word that
+# already has a mask has it replaced, as with /sam2/.
+class SAM2BulkView(APIView):
+
+    def post(self, request, *args, **kwargs):
+        image_hash = request.data.get('file_hash')
+        try:
+            items = json_field(request.data, 'items')
+            model = json_field(request.data, 'model', 3)
+        except json.JSONDecodeError:
+            return Response({"error": "Request fields must be valid JSON."}, status=status.HTTP_400_BAD_REQUEST)
+        if not image_hash or not isinstance(items, list) or not items:
+            return Response({"error": "Missing required fields: 'file_hash' and/or 'items'."}, status=status.HTTP_400_BAD_REQUEST)
+        max_items = getattr(settings, 'SAM2_BULK_MAX_ITEMS', 100)
+        if len(items) > max_items:
+            return Response({"error": f"At most {max_items} items can be segmented at once."}, status=status.HTTP_400_BAD_REQUEST)
 
-        alpha_channel = (total_mask * 255).astype(np.uint8)
-        img_arr_with_alpha = np.dstack((img_arr[..., :3], alpha_channel))
-        mask_png = PILImage.fromarray(img_arr_with_alpha, 'RGBA')
+        try:
+            model = parse_model(model)
+            image = get_object_or_404(Image, file_hash=image_hash)
+            size, inference_img = open_inference_image(image)
+        except SAM2RequestError as e:
+            return Response({"error": e.message}, status=e.status_code)
+
+        # validate every item before running any inference
+        parsed, errors = parse_bulk_items(items, size)
+        results = [None] * len(items)
+        for idx, e in errors.items():
+            results[idx] = {"status": e.status_code, "error": e.message}
+
+        if parsed:
+            try:
+                future = submit_bulk_items(image_hash, size, inference_img, parsed, model)
+                with interactive_gate.busy():
+                    masks = future.result()
+            except Exception as e:
+                print(f"Error generating masks: {e}")
+                return Response({"error": "Failed to generate masks."}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+            try:
+                new_masks = save_bulk_masks(image, merge_item_masks(parsed, masks))
+            except SAM2RequestError as e:
+                return Response({"error": e.message}, status=e.status_code)
+            for (idx, _, _), new_mask in zip(parsed, new_masks):
+                results[idx] = {"status": status.HTTP_201_CREATED, "mask": mask_details(request, new_mask)}
 
-        # contours = generate_contour_from_mask(total_mask, imgObject.size, max_points=10)
-        # contours_json = format_contours_to_json(word, contours)
+        return Response(
+            {"message": f"{len(parsed)} of {len(items)} masks generated and saved.", "results": results},
+            status=status.HTTP_201_CREATED if parsed else status.HTTP_400_BAD_REQUEST
+        )
 
-        temp = visualize_contours(total_mask,1000,0.5, visualise=False)
-        contours_json = format_contours_to_json(word,temp)
 
+def parse_auto_mask_options(data):
+    """Read the generate_candidates options of a /sam2/auto/ request, leaving
+    out any that were not given so they fall back to settings."""
+    max_points_per_side = getattr(settings, 'SAM2_AUTO_MAX_POINTS_PER_SIDE', 64)
+    options = {}
+    try:
+        for name in ('points_per_side', 'points_per_batch'):
+            value = json_field(data, name)
+            if value is not None:
+                value = int(value)
+                if value < 1 or (name == 'points_per_side' and value > max_points_per_side):
+                    raise ValueError(name)
+                options[name] = value
+        for name in ('pred_iou_thresh', 'stability_score_thresh', 'nms_thresh'):
+            value = json_field(data, name)
+            if value is not None:
+                value = float(value)
+                if not 0 <= value <= 1:
+                    raise ValueError(name)
+                options[name] = value
+    except (json.JSONDecodeError, TypeError, ValueError):
+        raise SAM2RequestError(
+            f"'points_per_side' must be from 1 to {max_points_per_side}, 'points_per_batch' at least 1 "
+            "and thresholds from 0 to 1.",
+            status.HTTP_400_BAD_REQUEST
+        )
+    return options
+
+
+def save_candidates(image, size, inference_size, records, model):
+    # Replaces the image's candidate masks with generated mask records, whose
+    # boxes, areas and points are scaled from inference resolution to the image
+    (height, width), (inference_height, inference_width) = size, inference_size
+    scale_x, scale_y = width / inference_width, height / inference_height
+    candidates = [
+        CandidateMask(
+            image=image,
+            maskRle=encode_mask(record["segmentation"]),
+            bbox=[round(record["bbox"][0] * scale_x, 1), round(record["bbox"][1] * scale_y, 1),
+                  round(record["bbox"][2] * scale_x, 1), round(record["bbox"][3] * scale_y, 1)],
+            area=round(record["area"] * scale_x * scale_y),
+            predicted_iou=record["predicted_iou"],
+            stability_score=record["stability_score"],
+            point=[record["point_coords"][0][0] * scale_x, record["point_coords"][0][1] * scale_y],
+            model=model
+        )
+        for record in records
+    ]
+    with transaction.atomic():
+        CandidateMask.objects.filter(image=image).delete()
+        CandidateMask.objects.bulk_create(candidates)
+    return candidates
+
+
+### "segment everything": find every object in an image as candidate masks
+# POST {"file_hash", "model", and optionally "points_per_side", "points_per_batch",
+# "pred_iou_thresh", "stability_score_thresh", "nms_thresh"} generates them,
+# replacing the image's earlier candidates; GET lists them. Annotators then
+# accept candidates as the mask of a word, or discard them
+class AutoMaskView(APIView):
+
+    def get(self, request, file_hash):
+        image = get_object_or_404(Image, file_hash=file_hash)
+        candidates = CandidateMask.objects.filter(image=image)
+        return Response({"candidates": CandidateMaskSerializer(candidates, many=True).data}, status=status.HTTP_200_OK)
 
-        # Save the PIL Image to an in-memory file
-        buffer = BytesIO()
+    def post(self, request, file_hash=None):
+        image_hash = file_hash or request.data.get('file_hash')
         try:
-            mask_png.save(buffer, format='PNG')
-        except Exception as e:
-            print(f"Error saving mask image to buffer: {e}")
-            return Response(
-                {"error": "Failed to save mask image."},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
-            )
-        
-        mask_filename = f"mask_{uuid.uuid4()}.png"
-        mask_content = ContentFile(buffer.getvalue(), name=mask_filename)
+            if not image_hash:
+                raise SAM2RequestError("Missing required field: 'file_hash'.", status.HTTP_400_BAD_REQUEST)
+            try:
+                model = parse_model(json_field(request.data, 'model', 3))
+            except json.JSONDecodeError:
+                raise SAM2RequestError("'model' must be a model index.", status.HTTP_400_BAD_REQUEST)
+            options = parse_auto_mask_options(request.data)
+            image = get_object_or_404(Image, file_hash=image_hash)
+            size, inference_img = open_inference_image(image)
+
+            try:
+                records = AutoSegmentTool().generateAllMasks(
+                    inference_img, model=model, imageHash=image_hash, options=options
+                )
+            except Exception as e:
+                print(f"Error generating masks: {e}")
+                raise SAM2RequestError("Failed to generate masks.", status.HTTP_500_INTERNAL_SERVER_ERROR)
+        except SAM2RequestError as e:
+            return Response({"error": e.message}, status=e.status_code)
 
-        # Handle Word association
+        candidates = save_candidates(image, size, inference_img.shape[:2], records, model)
+        return Response({
+            "message": f"Found {len(candidates)} candidate masks.",
+            "candidates": CandidateMaskSerializer(candidates, many=True).data
+        }, status=status.HTTP_201_CREATED)
+
+
+# POST {"word"} stores a candidate mask as the word's mask, scaled to the
+# image's size (replacing any mask the word had, as /sam2/ does); DELETE
+# discards it
+class CandidateMaskView(APIView):
+
+    def post(self, request, candidate_uuid):
+        candidate = get_object_or_404(CandidateMask.objects.select_related('image'), uuid=candidate_uuid)
+        word = request.data.get('word')
+        if not word:
+            return Response({"error": "Missing required field: 'word'."}, status=status.HTTP_400_BAD_REQUEST)
+
+        image = candidate.image
         try:
-            word_obj, created = Word.objects.get_or_create(
-                image=image,
-                word=word
-            )
-        except Exception as e:
-            print(f"Error retrieving or creating Word object: {e}")
-            return Response(
-                {"error": "Failed to retrieve or create Word object."},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
-            )
+            width, height = image.get_size()
+            total_mask = scale_mask(decode_mask(bytes(candidate.maskRle)), height, width)
+            with transaction.atomic():
+                mask = save_mask(image, word, total_mask)
+                candidate.delete()
+        except SAM2RequestError as e:
+            return Response({"error": e.message}, status=e.status_code)
+        return Response({
+            "message": "Candidate mask accepted.",
+            "mask": mask_details(request, mask)
+        }, status=status.HTTP_201_CREATED)
 
-        # Create and save the Mask instance
+    def delete(self, request, candidate_uuid):
+        candidate = get_object_or_404(CandidateMask, uuid=candidate_uuid)
+        candidate.delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+# Dedicated threads for the blocking parts of async /sam2/ requests (image
+# decode, mask encode and database writes); inference itself runs on the
+# scheduler's per-model worker threads
+sam2_async_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'SAM2_ASYNC_MAX_CONCURRENCY', 4),
+    thread_name_prefix='sam2-async'
+)
+# Limits async /sam2/ requests in flight across the process, whichever event
+# loop serves them (under WSGI each request runs on a loop of its own)
+sam2_async_slots = threading.BoundedSemaphore(getattr(settings, 'SAM2_ASYNC_MAX_CONCURRENCY', 4))
+
+
+async def acquire_sam2_async_slot(timeout):
+    # polls rather than blocking a thread on the semaphore, so a cancelled
+    # request can never take a slot after it has stopped waiting
+    deadline = time.monotonic() + timeout
+    while not sam2_async_slots.acquire(blocking=False):
+        if time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(0.01)
+    return True
+
+
+async def run_in_sam2_executor(func, *args):
+    def call():
         try:
-            new_mask = Mask.objects.create(
-                maskImage=mask_content,
-                image=image,
-                word=word_obj,
-                contours=contours_json  # Store contours in the Mask object
-            )
-        except Exception as e:
-            print(f"Error saving Mask instance: {e}")
-            return Response(
-                {"error": "Failed to save mask to the database."},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            return func(*args)
+        finally:
+            # connections opened on executor threads are not cleaned up by the request cycle
+            close_old_connections()
+    return await asyncio.get_running_loop().run_in_executor(sam2_async_executor, call)
+
+
+### async version of /sam2/ for ASGI deployments
+# Inference is awaited rather than run on the request thread, so other requests
+# keep being served, and a request whose client disconnects is cancelled while
+# it is still queued for inference
+@method_decorator(csrf_exempt, name='dispatch')
+class SAM2maskAsyncView(View):
+
+    async def post(self, request, *args, **kwargs):
+        if request.content_type == 'application/json':
+            try:
+                data = json.loads(request.body or b'{}')
+            except json.JSONDecodeError:
+                return JsonResponse({"error": "Request body must be valid JSON."}, status=status.HTTP_400_BAD_REQUEST)
+        else:
+            data = request.POST
+
+        if not await acquire_sam2_async_slot(getattr(settings, 'SAM2_ASYNC_QUEUE_TIMEOUT', 30)):
+            return JsonResponse(
+                {"error": "Too many segmentation requests, try again shortly."},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE
             )
 
-        # Return a success response with mask details and contours
-        return Response(
+        try:
+            parsed = parse_sam2_request(data)
+            image = await run_in_sam2_executor(Image.objects.filter(file_hash=parsed["image_hash"]).first)
+            if image is None:
+                raise SAM2RequestError("Image not found.", status.HTTP_404_NOT_FOUND)
+            size, inference_img = await run_in_sam2_executor(open_inference_image, image)
+
+            future = submit_segmentation(AutoSegmentTool(), parsed, size, inference_img)
+            try:
+                with interactive_gate.busy():
+                    # cancelling this await (client disconnect) also cancels the
+                    # queued inference job
+                    result = await asyncio.wrap_future(future)
+            except asyncio.CancelledError:
+                print(f"Client disconnected, cancelled segmentation of {parsed['image_hash']}")
+                raise
+            except Exception as e:
+                print(f"Error generating mask: {e}")
+                raise SAM2RequestError("Failed to generate mask.", status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+            if parsed["multimask"]:
+                data = await run_in_sam2_executor(multimask_response_data, parsed, image, result)
+                return JsonResponse(data, status=status.HTTP_200_OK)
+            new_masks = await run_in_sam2_executor(save_segmentation, parsed, image, size, result)
+            data = await run_in_sam2_executor(segmentation_response_data, request, parsed, new_masks)
+        except SAM2RequestError as e:
+            return JsonResponse({"error": e.message}, status=e.status_code)
+        finally:
+            sam2_async_slots.release()
+
+        return JsonResponse(data, status=status.HTTP_201_CREATED)
+
+
+### report which SAM2 models are loaded in this worker
+class SAM2ModelsView(APIView):
+    def get(self, request, *args, **kwargs):
+        resident = {index: nbytes for index, _, nbytes in model_registry.resident()}
+        models = [
             {
-                "message": "Mask generated and saved successfully!",
-                "mask": {
-                    "uuid": str(new_mask.uuid),
-                    "maskImage": request.build_absolute_uri(new_mask.maskImage.url),
-                    "image_id": image.file_hash,
-                    "word": word_obj.word,
-                    #"contours": contours
-                }
-            },
-            status=status.HTTP_201_CREATED
-        )
+                "model": index,
+                "name": spec["name"],
+                "resident": index in resident,
+                "bytes": resident.get(index)
+            }
+            for index, spec in enumerate(model_registry.specs)
+        ]
+        return Response({
+            "models": models,
+            "resident_bytes": model_registry.resident_bytes,
+            "max_bytes": model_registry.max_bytes
+        }, status=status.HTTP_200_OK)
 
 
-### get exhaustive list of images
-class ListImagesView(ListAPIView):
-    queryset = Image.objects.all() 
-    serializer_class = ImageSerializer
+# ?fields=a,b limits each item in the response to those fields, so clients
+# only get (and the database only loads) what they render
+class FieldSelectionMixin:
+    def selected_fields(self):
+        fields = self.request.query_params.get('fields')
+        if not fields:
+            return None
+        return [field.strip() for field in fields.split(',') if field.strip()]
+
+    def wants_field(self, name):
+        fields = self.selected_fields()
+        return fields is None or name in fields
+
+    def get_serializer(self, *args, **kwargs):
+        fields = self.selected_fields()
+        if fields is not None:
+            kwargs.setdefault('fields', fields)
+        return super().get_serializer(*args, **kwargs)
+
+
+# Conditional GET support: ETags come from Image.version, which is bumped on every
+# change to an image or its words and masks, combined with whatever else in the
+# request changes the response (the query string and the negotiated format)
+def representation_tag(request):
+    renderer = getattr(request, 'accepted_renderer', None)
+    key = f"{getattr(renderer, 'format', '')}?{request.GET.urlencode()}"
+    return hashlib.md5(key.encode()).hexdigest()[:12]
+
+
+def image_version(file_hash):
+    return Image.objects.filter(file_hash=file_hash).values_list('pk', 'version', 'updated_at').first()
+
+
+def image_etag(request, file_hash=None, **kwargs):
+    version = image_version(file_hash)
+    if version is None:
+        return None
+    return f"image-{version[0]}-{version[1]}-{representation_tag(request)}"
+
 
-class MaskViewSet(viewsets.ReadOnlyModelViewSet):
-    queryset = Mask.objects.all()
+def image_last_modified(request, file_hash=None, **kwargs):
+    version = image_version(file_hash)
+    return version[2] if version else None
+
+
+def image_list_etag(request, *args, **kwargs):
+    # covers additions (count, last id), deletions (count) and changes to any
+    # image (versions, last update). There is no Last-Modified for the list,
+    # as deleting an image would not move it forward.
+    stats = Image.objects.aggregate(
+        count=Count('id'),
+        last_id=Max('id'),
+        versions=Sum('version'),
+        updated=Max('updated_at')
+    )
+    key = "{count}-{last_id}-{versions}-{updated}".format(**stats)
+    return f"images-{hashlib.md5(key.encode()).hexdigest()[:16]}-{representation_tag(request)}"
+
+
+### get exhaustive list of images
+# ?view=slim lists only each image's id, name, file, hash and word/mask counts,
+# which is all an image picker needs. Paginated with ?page_size= and ?cursor=
+@method_decorator(condition(etag_func=image_list_etag), name='get')
+class ListImagesView(FieldSelectionMixin, ListAPIView):
+    pagination_class = OptionalCursorPagination
+
+    def get_queryset(self):
+        if self.is_slim():
+            return Image.objects.only('id', 'name', 'file', 'file_hash', 'width').annotate(
+                word_count=Count('word_masks', distinct=True),
+                mask_count=Count('masks', distinct=True)
+            ).order_by('id')
+
+        # masks are nested twice (under the image and under each word), so
+        # fetch each level in one query rather than per image
+        masks = Mask.objects.select_related('word').defer('maskRle')
+        queryset = Image.objects.order_by('id')
+        if self.wants_field('masks'):
+            queryset = queryset.prefetch_related(Prefetch('masks', queryset=masks))
+        if self.wants_field('word_masks'):
+            queryset = queryset.prefetch_related(Prefetch('word_masks__associated_masks', queryset=masks))
+        return queryset
+
+    def get_serializer_class(self):
+        return ImageSummarySerializer if self.is_slim() else ImageSerializer
+
+    def is_slim(self):
+        return self.request.query_params.get('view') == 'slim'
+
+class MaskViewSet(FieldSelectionMixin, viewsets.ReadOnlyModelViewSet):
     serializer_class = MaskSerializer
+    # the full list of masks is always paginated
+    pagination_class = IdCursorPagination
+
+    def get_queryset(self):
+        queryset = Mask.objects.select_related('word').defer('maskRle').order_by('id')
+        if not self.wants_field('contours'):
+            queryset = queryset.defer('contours', 'contours_compact')
+        return queryset
 
     @action(detail=False, methods=['get'], url_path='by-image/(?P<file_hash>[^/.]+)')
+    @method_decorator(condition(etag_func=image_etag, last_modified_func=image_last_modified))
     def by_image(self, request, file_hash=None):
 
         image = get_object_or_404(Image, file_hash=file_hash)
-        masks = Mask.objects.filter(image=image)
+        masks = self.get_queryset().filter(image=image)
         serializer = self.get_serializer(masks, many=True)
         return Response(serializer.data)
     
     @action(detail=False, methods=['get'], url_path='by-image/(?P<file_hash>[^/.]+)/by-word/(?P<word>[^/.]+)')
+    @method_decorator(condition(etag_func=image_etag, last_modified_func=image_last_modified))
     def by_image_and_word(self, request, file_hash=None, word=None):
         image = get_object_or_404(Image, file_hash=file_hash)
         word_obj = get_object_or_404(Word, image=image, word=word)
-        mask = Mask.objects.filter(image=image, word=word_obj)
+        mask = self.get_queryset().filter(image=image, word=word_obj)
         
         if not mask:
             return Response({"detail": "Mask not found for the given image and word."}, status=status.HTTP_404_NOT_FOUND)
@@ -554,19 +1415,34 @@ class MaskViewSet(viewsets.ReadOnlyModelViewSet):
         serializer = self.get_serializer(mask, many=True)
         return Response(serializer.data)
     
-    @action(detail=False, methods=['get'], url_path='contours/(?P<file_hash>[^/.]+)/(?P<word>[^/.]+)')
+    # Contours are JSON by default; clients sending Accept: application/x-sam2-contours
+    # (or ?format=contours) get a stream of compact binary frames instead
+    contour_renderers = [*api_settings.DEFAULT_RENDERER_CLASSES, ContourRenderer]
+
+    @action(detail=False, methods=['get'], url_path='contours/(?P<file_hash>[^/.]+)/(?P<word>[^/.]+)',
+            renderer_classes=contour_renderers)
+    @method_decorator(condition(etag_func=image_etag, last_modified_func=image_last_modified))
     def get_contours(self, request, file_hash=None, word=None):
         image = get_object_or_404(Image, file_hash=file_hash)
         word_obj = get_object_or_404(Word, image=image, word=word)
-        mask = get_object_or_404(Mask, image=image, word=word_obj)
-        
-        return Response(mask.contours, status=status.HTTP_200_OK)
+        mask = get_object_or_404(Mask.objects.select_related('word'), image=image, word=word_obj)
+
+        if request.accepted_renderer.format == ContourRenderer.format:
+            return compact_contours_response([mask])
+        return Response(mask.get_contours(), status=status.HTTP_200_OK)
     
-    @action(detail=False, methods=['get'], url_path='contours/(?P<file_hash>[^/.]+)')
+    @action(detail=False, methods=['get'], url_path='contours/(?P<file_hash>[^/.]+)',
+            renderer_classes=contour_renderers)
+    @method_decorator(condition(etag_func=image_etag, last_modified_func=image_last_modified))
     def get_all_contours(self, request, file_hash=None):
         image = get_object_or_404(Image, file_hash=file_hash)
         
-        masks = Mask.objects.filter(image=image)
+        masks = Mask.objects.filter(image=image).select_related('word').only(
+            'contours', 'contours_compact', 'word__word'
+        )
+
+        if request.accepted_renderer.format == ContourRenderer.format:
+            return compact_contours_response(masks.iterator())
         
         contours_dict = {}
         
@@ -574,12 +1450,99 @@ class MaskViewSet(viewsets.ReadOnlyModelViewSet):
             word = mask.word.word if mask.word else 'unassociated'
 
             if word in contours_dict:
-                contours_dict[word].append(mask.contours)
+                contours_dict[word].append(mask.get_contours())
             else:
-                contours_dict[word] = [mask.contours]
+                contours_dict[word] = [mask.get_contours()]
 
         return Response({'contours': contours_dict}, status=status.HTTP_200_OK)
-    
+
+
+def compact_contours_response(masks):
+    # streams one frame per mask, so large images are never held in memory whole
+    def frames():
+        for mask in masks:
+            data = mask.get_contours_compact()
+            if data is not None:
+                yield encode_frame(mask.word.word, data)
+    return StreamingHttpResponse(frames(), content_type=CONTOURS_CONTENT_TYPE)
+
+
+# Serves a mask's cutout: the stored mask image, or one rendered from the run-length
+# encoded mask and cached on disk
+class RenderMaskView(APIView):
+    def get(self, request, mask_uuid):
+        mask = get_object_or_404(Mask.objects.select_related('image'), uuid=mask_uuid)
+        if mask.maskImage:
+            response = FileResponse(mask.maskImage.open('rb'))
+        elif mask.maskRle is not None and mask.image.file:
+            fmt = mask_format()
+            response = FileResponse(cutout_file(mask, fmt), content_type=content_type(fmt))
+        else:
+            return Response({"error": "Mask has no image data."}, status=status.HTTP_404_NOT_FOUND)
+        # a mask's uuid changes whenever it is regenerated
+        patch_cache_control(response, max_age=24 * 60 * 60)
+        return response
+
+
+# Tiles are immutable for a file_hash (and mask uuid), so browsers can keep them
+TILE_MAX_AGE = 7 * 24 * 60 * 60
+
+
+def tile_response(data):
+    response = HttpResponse(data, content_type=tile_pyramid.content_type)
+    patch_cache_control(response, max_age=TILE_MAX_AGE)
+    return response
+
+
+def get_tiled_image(file_hash):
+    image = get_object_or_404(Image, file_hash=file_hash)
+    if not image.file:
+        raise Http404("Image file not found.")
+    return image
+
+
+# Size of an image's pyramid levels and how many tiles each has
+class TileInfoView(APIView):
+    def get(self, request, file_hash):
+        image = get_tiled_image(file_hash)
+        info = tile_pyramid.info(image)
+        info["tile_url"] = request.build_absolute_uri(
+            reverse('image_tile', args=[file_hash, 0, 0, 0])
+        ).replace('/0/0/0/', '/{level}/{col}/{row}/')
+        return Response(info, status=status.HTTP_200_OK)
+
+
+class ImageTileView(APIView):
+    def get(self, request, file_hash, level, col, row):
+        image = get_tiled_image(file_hash)
+        if not tile_pyramid.has_tile(image, level, col, row):
+            return Response({"error": "Tile not found."}, status=status.HTTP_404_NOT_FOUND)
+        return tile_response(tile_pyramid.tile(image, level, col, row))
+
+
+# The mask's cutout on the same tile grid as its image, for overlays
+class MaskTileView(APIView):
+    def get(self, request, file_hash, mask_uuid, level, col, row):
+        image = get_tiled_image(file_hash)
+        mask = get_object_or_404(Mask, uuid=mask_uuid, image=image)
+        if mask.maskRle is None or not tile_pyramid.has_tile(image, level, col, row):
+            return Response({"error": "Tile not found."}, status=status.HTTP_404_NOT_FOUND)
+        response = tile_response(tile_pyramid.mask_tile(mask, level, col, row))
+        response['Content-Type'] = 'image/png'
+        return response
+
+
+class ThumbnailView(APIView):
+    def get(self, request, file_hash):
+        image = get_tiled_image(file_hash)
+        try:
+            return tile_response(tile_pyramid.thumbnail(image))
+        except Exception as e:
+            # not an image PIL can decode, such as an SVG, which browsers show as it is
+            print(f"Error rendering thumbnail of image {file_hash}: {e}")
+            return HttpResponseRedirect(image.file.url)
+
+
 class DeleteMaskView(APIView):
     def delete(self, request, *args, **kwargs):
         image_hash = request.query_params.get('image_hash')
@@ -14,3 +14,7 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
 application = get_asgi_application()
+
+# Load the SAM2 models listed in SAM2_WARMUP_MODELS in the background
+from ImageAnnotatorSAM2.inference_profile import start_warmup  # noqa: E402
+start_warmup()
@@ -149,4 +149,102 @@ CORS_ALLOWED_ORIGINS = [
 
 CSRF_COOKIE_NAME = 'csrftoken'
 CSRF_COOKIE_SAMESITE = None  # Set to 'None' for cross-origin (if you're running React and Django on different ports)
-CSRF_COOKIE_SECURE = False  # Set to True if using HTTPS in production
\ No newline at end of file
+CSRF_COOKIE_SECURE = False  # Set to True if using HTTPS in production
+
+# SAM2 inference
+# RAM ceiling (in bytes) for loaded SAM2 models; least recently used models are
+# unloaded when a request needs one that does not fit
+SAM2_MODEL_MEMORY_BYTES = 2 * 1024 * 1024 * 1024
+# Memory budget (in bytes) for cached image embeddings, shared by all models
+SAM2_EMBEDDING_CACHE_BYTES = 512 * 1024 * 1024
+# Size cap (in bytes) for embeddings stored under MEDIA_ROOT/embeddings, set to
+# 0 to disable the on-disk store
+SAM2_EMBEDDING_STORE_BYTES = 10 * 1024 * 1024 * 1024
+# /sam2/ requests arriving within this many milliseconds of each other are
+# batched into one decoder call when they share an image
+SAM2_BATCH_WINDOW_MS = 5
+SAM2_MAX_BATCH_SIZE = 8
+# Async /sam2/async/ requests processed at once per worker, and how long (in
+# seconds) a request waits for a free slot before getting a 503
+SAM2_ASYNC_MAX_CONCURRENCY = 4
+SAM2_ASYNC_QUEUE_TIMEOUT = 30
+# Precompute embeddings in the background when an image is uploaded, for the
+# model sent with the upload (or SAM2_PRECOMPUTE_MODEL if none is sent)
+SAM2_PRECOMPUTE_ON_UPLOAD = False
+SAM2_PRECOMPUTE_MODEL = 3
+# Uploads queued for precomputation at once; later uploads are skipped
+SAM2_PRECOMPUTE_MAX_PENDING = 4
+# How mask contours are stored: 'json' (lists of points), 'compact' (quantised,
+# delta encoded binary, much smaller) or 'both'. The API serves either form.
+SAM2_CONTOUR_STORAGE = 'json'
+# How masks are stored: 'rle' (run-length encoded, with the cutout rendered
+# when requested) or 'png' (an RGBA cutout of the image, as large as the image)
+SAM2_MASK_STORAGE = 'rle'
+# Size cap (in bytes) for rendered cutouts cached under MEDIA_ROOT/mask_renders,
+# set to 0 to disable the cache
+SAM2_MASK_RENDER_CACHE_BYTES = 1024 * 1024 * 1024
+# Format of mask images: 'png' or 'webp' (lossless) RGBA cutouts of the image,
+# or 'png1' for the mask alone as a 1-bit PNG. Lower compression is faster to
+# encode but gives larger files (PNG level 0-9, WebP method 0-6).
+SAM2_MASK_FORMAT = 'png'
+SAM2_MASK_PNG_COMPRESS_LEVEL = 1
+SAM2_MASK_WEBP_METHOD = 0
+# Encode mask images after the /sam2/ response is sent; masks are marked
+# pending until then, and only this many are queued at once
+SAM2_MASK_ENCODE_DEFERRED = False
+SAM2_MASK_ENCODE_MAX_PENDING = 4
+# Memory budget (in bytes) for decoded images kept between /sam2/ requests
+SAM2_DECODED_IMAGE_CACHE_BYTES = 256 * 1024 * 1024
+# Page size for cursor paginated API lists (?page_size= can ask for up to the max)
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+# Largest image (in pixels) that will be decoded
+SAM2_MAX_IMAGE_PIXELS = 250_000_000
+# Image pyramids and tiles for viewing large images, stored under MEDIA_ROOT/tiles
+# ('jpeg', 'webp' or 'png' tiles); built on first use, or after upload if enabled
+SAM2_TILE_SIZE = 256
+SAM2_TILE_FORMAT = 'jpeg'
+SAM2_TILE_STORE_BYTES = 20 * 1024 * 1024 * 1024
+SAM2_THUMBNAIL_SIZE = 256
+SAM2_TILES_ON_UPLOAD = False
+# Inference runs on a copy of each image downsized to SAM2's encoder resolution,
+# kept in memory and under MEDIA_ROOT/inference_images; masks are still
+# produced at the image's full size
+SAM2_INFERENCE_SIZE = 1024
+SAM2_INFERENCE_IMAGE_CACHE_BYTES = 128 * 1024 * 1024
+SAM2_INFERENCE_IMAGE_STORE_BYTES = 2 * 1024 * 1024 * 1024
+# Most items a /sam2/bulk/ request can segment at once
+SAM2_BULK_MAX_ITEMS = 100
+# "Segment everything" (/sam2/auto/): point grid density and batch size, which
+# is lowered so a batch's masks fit in this fraction of available memory, and
+# the thresholds for keeping a mask (see SAM2AutomaticMaskGenerator); masks
+# overlapping a better one by more than SAM2_AUTO_NMS_THRESH IoU are dropped
+SAM2_AUTO_POINTS_PER_SIDE = 32
+SAM2_AUTO_MAX_POINTS_PER_SIDE = 64
+SAM2_AUTO_POINTS_PER_BATCH = 64
+SAM2_AUTO_MEMORY_FRACTION = 0.25
+SAM2_AUTO_PRED_IOU_THRESH = 0.8
+SAM2_AUTO_STABILITY_SCORE_THRESH = 0.95
+SAM2_AUTO_NMS_THRESH = 0.7
+# Memory budget (in bytes) for /sam2/refine/ click sessions, each holding its
+# points and the last prediction's 256x256 logits (about 256 KB)
+SAM2_REFINEMENT_CACHE_BYTES = 64 * 1024 * 1024
+# Alternative masks of multimask /sam2/ requests are kept this many seconds to
+# be chosen from, within a memory budget (in bytes)
+SAM2_MULTIMASK_TTL = 300
+SAM2_MULTIMASK_CACHE_BYTES = 64 * 1024 * 1024
+# CPU inference: intra-op threads per worker process, by default the available
+# cores divided between SAM2_CPU_WORKERS processes (or $WEB_CONCURRENCY), so
+# several workers do not oversubscribe the cores
+SAM2_CPU_THREADS = None
+SAM2_CPU_WORKERS = None
+SAM2_CPU_INTEROP_THREADS = 1
+# Models (by index) loaded and run once when the server starts, so the first
+# request does not pay for it
+SAM2_WARMUP_MODELS = []
+# Optional image encoder speedups; compare them per model with
+# `python manage.py bench_inference`. Compiling takes minutes per model at
+# startup, best paired with SAM2_WARMUP_MODELS
+SAM2_CHANNELS_LAST = False
+SAM2_COMPILE = False
+SAM2_COMPILE_MODE = 'max-autotune'
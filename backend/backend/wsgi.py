@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
 application = get_wsgi_application()
+
+# Load the SAM2 models listed in SAM2_WARMUP_MODELS in the background
+from ImageAnnotatorSAM2.inference_profile import start_warmup  # noqa: E402
+start_warmup()
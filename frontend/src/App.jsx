@@ -85,6 +85,8 @@ const App = () => {
         const formData = new FormData();
         formData.append('image', file);
         formData.append('name', file.name);
+        // model to warm the embedding for, if the backend precomputes on upload
+        formData.append('model', autoSegmentToolSetting);
 
         const response = await Endpoint.post('upload/', formData);
 
@@ -153,6 +155,7 @@ const App = () => {
 
           const newImage = {
             src: image.file, // URL of the image
+            thumbnailSrc: image.thumbnail, // downsized copy for the image list
             name: image.name, // Name of the image
             file_hash: image.file_hash,
             annotations: [],
@@ -13,7 +13,7 @@ const Thumbnail = ({ image, index, isSelected, onSelect, onDelete }) => (
       }}
     />
     <img
-      src={image.src}
+      src={image.thumbnailSrc || image.src}
       alt={`Source image #${index + 1}`}
       className={isSelected ? 'selected' : ''}
     />
@@ -26,6 +26,7 @@ const Thumbnail = ({ image, index, isSelected, onSelect, onDelete }) => (
 Thumbnail.propTypes = {
   image: PropTypes.shape({
     src: PropTypes.string.isRequired,
+    thumbnailSrc: PropTypes.string,
     name: PropTypes.string.isRequired,
   }).isRequired,
   index: PropTypes.number.isRequired,